@@ -11,13 +11,26 @@ from .models import (
     OrderItem,
     Contact,
     ConfirmEmailToken,
+    ImportRun,
+    ImportBatch,
+    refresh_attributes,
 )
-from django.urls import path
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.urls import path, reverse
 from django.shortcuts import render
 from django.contrib import messages
 from django import forms
-from django.http import HttpResponseRedirect
-from .tasks import update_partner_price
+from django.http import HttpResponseRedirect, JsonResponse
+from django.utils.decorators import method_decorator
+from django.utils.html import format_html, format_html_join
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from .feeds import PriceFeedError, read_price_feed
+from .preview import preview_price_feed
+from .tasks import start_price_import, start_import_batch, start_uploaded_price_import, replay_price_import, \
+    preview_partner_price
+from .catalog import rollback_catalog_version
+from .storefront import refresh_storefront
 from .models import Shop
 
 
@@ -31,38 +44,100 @@ class UserAdmin(admin.ModelAdmin):
 
 @admin.register(Shop)
 class ShopAdmin(admin.ModelAdmin):
-    list_display = ['name', 'url', 'user', 'state', ]
+    list_display = ['name', 'url', 'user', 'state', 'refresh_interval', 'next_refresh_at', 'catalog_version', ]
     list_filter = ['state', ]
     search_fields = ['name', 'user']
     search_help_text = 'Введите название магазина или пользователя для поиска'
-    actions = ['update_price_action']
+    readonly_fields = ['catalog_version', 'previous_version', 'get_import_metrics', ]
+    actions = ['update_price_action', 'import_prices_action', 'rollback_catalog_action']
+
+    def get_import_metrics(self, obj):
+        runs = obj.import_runs.exclude(metrics={}).order_by('-created')[:10]
+        rows = format_html_join('', '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>', (
+            (
+                run.created.strftime('%d.%m.%Y %H:%M'),
+                run.status,
+                run.metrics.get('rows', 0),
+                run.metrics.get('seconds', 0),
+                run.metrics.get('rows_per_second', 0),
+                run.metrics.get('queries', 0),
+                run.metrics.get('peak_rss_kb') or '-',
+            ) for run in runs
+        ))
+        phases = format_html_join('', '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>', (
+            (name, phase['seconds'], phase['rows'], phase['rows_per_second'], phase['queries'])
+            for name, phase in runs[0].metrics.get('phases', {}).items()
+        )) if runs else ''
+        return format_html(
+            '<table><tr><th>Начат</th><th>Статус</th><th>Строк</th><th>Время, с</th><th>Строк/с</th>'
+            '<th>Запросов</th><th>Пик RSS импорта, КБ</th></tr>{}</table>'
+            '<p>Этапы последнего импорта:</p>'
+            '<table><tr><th>Этап</th><th>Время, с</th><th>Строк</th><th>Строк/с</th><th>Запросов</th></tr>{}</table>',
+            rows, phases,
+        )
+
+    get_import_metrics.short_description = 'Показатели импорта прайсов'
 
     def get_urls(self):
         urls = super().get_urls()
         custom_urls = [
             path(
                 '<path:object_id>/update-price/',
-                self.admin_site.admin_view(self.update_price_view),
+                # CSRF проверяется в update_price_form_view, после выбора обработчиков загрузки
+                self.admin_site.admin_view(csrf_exempt(self.update_price_view)),
                 name='update_price'
             ),
         ]
         return custom_urls + urls
 
     def update_price_view(self, request, object_id):
+        # загружаемый прайс пишется во временный файл на диске по мере приема, а не в память
+        request.upload_handlers = [TemporaryFileUploadHandler(request)]
+        return self.update_price_form_view(request, object_id)
+
+    @method_decorator(csrf_protect)
+    def update_price_form_view(self, request, object_id):
         shop = Shop.objects.get(id=object_id)
+        # форма, отправленная скриптом страницы, получает ответ в JSON и следит за импортом сама
+        ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
 
         if request.method == 'POST':
-            form = ShopAdminForm(request.POST)
+            form = ShopAdminForm(request.POST, request.FILES)
+            if form.is_valid() and form.cleaned_data['dry_run']:
+                # предпросмотр ничего не записывает и выполняется сразу
+                result = self.preview_price(shop, form.cleaned_data)
+                if result['status'] != 'success':
+                    messages.error(request, result['message'])
+                return render(request, 'admin/shop_update_price.html', {
+                    'form': form,
+                    'shop': shop,
+                    'opts': self.model._meta,
+                    'preview': result.get('preview'),
+                })
             if form.is_valid():
-                task = update_partner_price.delay(
-                    shop_id=shop.id,
-                    url=form.cleaned_data['yaml_url']
-                )
-                messages.success(
-                    request,
-                    f'Обновление прайса для "{shop.name}" запущено. Task ID: {task.id}'
-                )
+                feed_file = form.cleaned_data['feed_file']
+                if feed_file:
+                    task_id, started = start_uploaded_price_import(shop, feed_file)
+                else:
+                    task_id, started = start_price_import(shop, form.cleaned_data['yaml_url'])
+                if started:
+                    message = f'Обновление прайса для "{shop.name}" запущено. Task ID: {task_id}'
+                else:
+                    message = f'Обновление прайса для "{shop.name}" уже выполняется. Task ID: {task_id}'
+                if ajax:
+                    return JsonResponse({
+                        'task_id': task_id,
+                        'started': started,
+                        'message': message,
+                        'status_url': f"{reverse('api_v1:task-status')}?task_id={task_id}",
+                    })
+                if started:
+                    messages.success(request, message)
+                else:
+                    messages.warning(request, message)
                 return HttpResponseRedirect(f'/admin/backend/shop/{object_id}/')
+            if ajax:
+                return JsonResponse({'errors': form.errors}, status=400)
 
         else:
             form = ShopAdminForm()
@@ -73,6 +148,19 @@ class ShopAdmin(admin.ModelAdmin):
             'opts': self.model._meta,
         })
 
+    @staticmethod
+    def preview_price(shop, data):
+        """Предпросмотр прайса по ссылке или из загруженного файла"""
+        feed_file = data['feed_file']
+        if not feed_file:
+            return preview_partner_price.apply(args=(shop.id, data['yaml_url'], data['price_threshold'])).get()
+        try:
+            summary = preview_price_feed(
+                shop, read_price_feed(feed_file.file, feed_file.content_type), data['price_threshold'])
+        except PriceFeedError as e:
+            return {'status': 'error', 'message': str(e)}
+        return {'status': 'success', 'message': 'Price list preview', 'preview': summary}
+
     def update_price_action(self, request, queryset):
         if queryset.count() != 1:
             self.message_user(request, "Выберите ровно один магазин", level='ERROR')
@@ -83,7 +171,32 @@ class ShopAdmin(admin.ModelAdmin):
             f'/admin/backend/shop/{shop.id}/update-price/'
         )
 
-    update_price_action.short_description = "♻️ Обновить прайс из YAML"
+    update_price_action.short_description = "♻️ Обновить прайс по ссылке или из файла"
+
+    def import_prices_action(self, request, queryset):
+        shops = list(queryset.exclude(url=None).exclude(url=''))
+        if not shops:
+            self.message_user(request, "У выбранных магазинов нет адреса прайса", level='ERROR')
+            return
+
+        batch = start_import_batch(shops, user=request.user)
+        skipped = queryset.count() - len(shops)
+        self.message_user(
+            request,
+            f'Запущено обновление прайсов {len(shops)} магазинов, пакет {batch.id}'
+            + (f', без адреса прайса пропущено: {skipped}' if skipped else '')
+        )
+
+    import_prices_action.short_description = "♻️ Обновить прайсы выбранных магазинов по их адресам"
+
+    def rollback_catalog_action(self, request, queryset):
+        rolled_back = [shop.name for shop in queryset if rollback_catalog_version(shop)]
+        if rolled_back:
+            self.message_user(request, f'Каталог возвращен к предыдущей версии: {", ".join(rolled_back)}')
+        else:
+            self.message_user(request, "У выбранных магазинов нет предыдущей версии каталога", level='WARNING')
+
+    rollback_catalog_action.short_description = "↩️ Откатить каталог к предыдущей версии"
 
 
 @admin.register(Category)
@@ -101,6 +214,7 @@ class CategoryAdmin(admin.ModelAdmin):
 class ProductInfoInline(admin.TabularInline):
     model = ProductInfo
     extra = 0
+    exclude = ['attributes']
 
 
 class ProductParameterInline(admin.TabularInline):
@@ -111,10 +225,18 @@ class ProductParameterInline(admin.TabularInline):
 @admin.register(ProductInfo)
 class ProductInfoAdmin(admin.ModelAdmin):
     inlines = [ProductParameterInline, ]
-    list_display = ['product', 'external_id', 'shop', 'quantity', 'price', 'price_rrc']
+    list_display = ['product', 'external_id', 'shop', 'quantity', 'price', 'price_rrc', 'is_active', 'version',
+                    'retired_version']
     search_fields = ['product', 'external_id', 'shop']
     search_help_text = 'Введите название продукта или внешний ID для поиска'
-    list_filter = ['shop', ]
+    list_filter = ['shop', 'is_active', 'version', ]
+    readonly_fields = ['attributes']
+
+    def save_related(self, request, form, formsets, change):
+        # attributes - копия параметров, правятся строки параметров в таблице ниже, включая удаление
+        super().save_related(request, form, formsets, change)
+        refresh_attributes([form.instance.id])
+        refresh_storefront([form.instance.id])
 
 
 @admin.register(Product)
@@ -132,6 +254,14 @@ class ParameterAdmin(admin.ModelAdmin):
     search_fields = ['name', ]
     search_help_text = 'Введите название параметра для поиска'
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change and 'name' in form.changed_data:
+            # новое имя попадает в копии параметров предложений и в витрину
+            product_info_ids = list(obj.product_params.values_list('product_info_id', flat=True))
+            refresh_attributes(product_info_ids)
+            refresh_storefront(product_info_ids)
+
 
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
@@ -179,5 +309,48 @@ class ConfirmEmailTokenAdmin(admin.ModelAdmin):
     list_display = ['user', 'key', 'created', ]
 
 
+@admin.register(ImportRun)
+class ImportRunAdmin(admin.ModelAdmin):
+    list_display = ['shop', 'task_id', 'status', 'offset', 'chunks', 'feed_size', 'created', 'finished', ]
+    list_filter = ['status', 'shop', ]
+    search_fields = ['task_id', 'url', 'feed_hash', ]
+    search_help_text = 'Введите ID задачи, адрес или хэш прайса для поиска'
+    readonly_fields = ['metrics', 'created', 'updated', ]
+    actions = ['replay_import_action']
+
+    def replay_import_action(self, request, queryset):
+        runs = queryset.exclude(feed_path='')
+        for run in runs:
+            replay_price_import.delay(run.id)
+        if runs:
+            self.message_user(request, f'Запущен повторный импорт из архива: {len(runs)}')
+        else:
+            self.message_user(request, "У выбранных запусков нет архива прайса", level='WARNING')
+
+    replay_import_action.short_description = "🔁 Повторить импорт из архива прайса"
+
+
+@admin.register(ImportBatch)
+class ImportBatchAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'concurrency', 'force', 'created', ]
+    readonly_fields = ['pending', 'tasks', 'created', ]
+
+
 class ShopAdminForm(forms.Form):
-    yaml_url = forms.URLField(label='URL YAML-файла')
+    yaml_url = forms.URLField(label='URL прайса', required=False)
+    feed_file = forms.FileField(label='Или файл прайса', required=False,
+                                help_text='YAML, CSV или JSON Lines, в том числе сжатый gzip')
+    dry_run = forms.BooleanField(label='Только показать изменения, без записи', required=False)
+    price_threshold = forms.FloatField(label='Порог изменения цены, %', required=False, min_value=0)
+
+    def clean_feed_file(self):
+        feed_file = self.cleaned_data['feed_file']
+        if feed_file and feed_file.size > settings.PRICE_FEED_MAX_BYTES:
+            raise forms.ValidationError(f'Размер прайса превышает {settings.PRICE_FEED_MAX_BYTES} байт')
+        return feed_file
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('yaml_url') and not cleaned_data.get('feed_file') and not self.errors:
+            raise forms.ValidationError('Укажите URL прайса или выберите файл')
+        return cleaned_data
@@ -0,0 +1,120 @@
+"""
+Архив загруженных прайс-листов.
+
+Каждый загруженный прайс сохраняется в default_storage сжатым gzip под
+именем price_feeds/<sha256>.gz, где sha256 - хэш исходного содержимого,
+поэтому одинаковые прайсы хранятся один раз. Прайс любого формата (см.
+backend.feeds) хранится как есть, уже сжатый gzip прайс повторно не сжимается. Путь и размер архива
+записываются в ImportRun: по нему повтор задачи продолжает импорт, а
+replay_price_import повторяет импорт без обращения к поставщику.
+Срок и общий объем архива ограничены PRICE_FEED_ARCHIVE_DAYS и
+PRICE_FEED_ARCHIVE_MAX_BYTES.
+"""
+import gzip
+import hashlib
+import shutil
+from contextlib import contextmanager
+from datetime import timedelta
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db.models import Max
+from django.utils import timezone
+
+from backend.feeds import GZIP_MAGIC
+from backend.fetcher import FetchedFeed
+from backend.models import ImportRun
+
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+def archive_price_feed(feed):
+    """
+    Сохраняет загруженный прайс в архив.
+
+    Аргументы:
+        feed (FetchedFeed): загруженный прайс
+
+    Возвращает:
+        str: путь к сжатому прайсу в хранилище
+    """
+    path = f'price_feeds/{feed.sha256}.gz'
+    if default_storage.exists(path):
+        return path
+
+    feed.file.seek(0)
+    compressed_feed = feed.file.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    feed.file.seek(0)
+    if compressed_feed:
+        return default_storage.save(path, File(feed.file))
+
+    with SpooledTemporaryFile(max_size=settings.PRICE_FEED_SPOOL_SIZE) as compressed:
+        # mtime=0: одинаковое содержимое дает одинаковый архив
+        with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as archive:
+            feed.file.seek(0)
+            shutil.copyfileobj(feed.file, archive, COPY_BUFFER_SIZE)
+        compressed.seek(0)
+        return default_storage.save(path, File(compressed))
+
+
+def archive_uploaded_feed(uploaded):
+    """
+    Сохраняет в архив прайс, загруженный файлом через форму.
+
+    Аргументы:
+        uploaded (UploadedFile): загруженный файл, большие файлы Django
+            записывает во временный файл на диске
+
+    Возвращает:
+        tuple: путь к прайсу в хранилище и хэш SHA-256 содержимого
+    """
+    digest = hashlib.sha256()
+    for chunk in uploaded.chunks(COPY_BUFFER_SIZE):
+        digest.update(chunk)
+    feed = FetchedFeed(file=uploaded.file, sha256=digest.hexdigest(), size=uploaded.size,
+                       content_type=uploaded.content_type or '')
+    return archive_price_feed(feed), feed.sha256
+
+
+@contextmanager
+def open_price_feed(path):
+    """Открывает прайс из хранилища для чтения, распаковывая архив gzip"""
+    with default_storage.open(path, 'rb') as f:
+        if path.endswith('.gz'):
+            with gzip.GzipFile(fileobj=f, mode='rb') as archive:
+                yield archive
+        else:
+            yield f
+
+
+def purge_price_feed_archive():
+    """
+    Удаляет из архива прайсы старше PRICE_FEED_ARCHIVE_DAYS и самые старые
+    прайсы сверх PRICE_FEED_ARCHIVE_MAX_BYTES. Прайсы незавершенных импортов
+    не удаляются.
+
+    Возвращает:
+        list: пути удаленных прайсов
+    """
+    cutoff = timezone.now() - timedelta(days=settings.PRICE_FEED_ARCHIVE_DAYS)
+    in_use = set(ImportRun.objects.filter(
+        status__in=('running', 'failed'), finished__isnull=True).values_list('feed_path', flat=True))
+
+    feeds = list(ImportRun.objects.exclude(feed_path='').values('feed_path').annotate(
+        last_used=Max('created'), size=Max('feed_size')).order_by('-last_used'))
+    # прайсы незавершенных импортов занимают место в первую очередь
+    total = sum(feed['size'] for feed in feeds if feed['feed_path'] in in_use)
+    deleted = []
+    for feed in feeds:
+        if feed['feed_path'] in in_use:
+            continue
+        if feed['last_used'] < cutoff or total + feed['size'] > settings.PRICE_FEED_ARCHIVE_MAX_BYTES:
+            default_storage.delete(feed['feed_path'])
+            deleted.append(feed['feed_path'])
+        else:
+            total += feed['size']
+
+    ImportRun.objects.filter(feed_path__in=deleted).update(feed_path='')
+    return deleted
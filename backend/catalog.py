@@ -0,0 +1,195 @@
+"""
+Версии каталога магазина (blue-green).
+
+Импорт собирает новую версию предложений магазина рядом с опубликованной
+копированием при записи: строка предложения действует с версии version до
+retired_version. Новая версия ничего не копирует заранее - неизмененные
+предложения берутся из опубликованной, а изменившиеся и снятые с продажи
+копируются в новую версию (clone_offers), старая строка закрывается
+версией импорта. Поэтому импорт почти неизмененного прайса пишет только
+изменившиеся строки, а id неизмененных предложений не меняются.
+
+Покупатели видят только опубликованную версию (ProductInfo.objects.published()
+и витрина каталога, см. backend.storefront), поэтому незавершенный импорт
+им не виден. Публикация - обновление указателя Shop.catalog_version одной
+строкой; предыдущая версия сохраняется в Shop.previous_version для
+мгновенного отката.
+"""
+from cachalot.api import invalidate
+from django.db import connection, transaction
+from django.db.models import F, Max
+from django.utils import timezone
+
+from backend.models import ImportRun, OrderItem, ProductInfo, ProductParameter, Shop, delete_product_params
+from backend.storefront import sync_storefront
+
+CLONE_BATCH_SIZE = 1000
+
+
+def create_catalog_version(shop):
+    """
+    Создает новую версию каталога магазина на основе опубликованной.
+
+    Незавершенные версии новее опубликованной (неудачный импорт или версия,
+    с которой откатились) отменяются: иначе их строки попали бы в новую версию.
+
+    Возвращает:
+        int: номер новой версии
+    """
+    with transaction.atomic():
+        shop = Shop.objects.select_for_update().get(id=shop.id)
+        version = 1 + max(
+            shop.catalog_version,
+            shop.previous_version or 0,
+            ProductInfo.objects.filter(shop=shop).aggregate(Max('version'))['version__max'] or 0,
+            ImportRun.objects.filter(shop=shop).aggregate(Max('version'))['version__max'] or 0,
+        )
+        discard_catalog_versions(shop)
+    return version
+
+
+def discard_catalog_versions(shop):
+    """Отменяет версии каталога магазина новее опубликованной"""
+    published = shop.catalog_version
+    offers = ProductInfo.objects.filter(shop=shop)
+    abandoned = offers.filter(version__gt=published)
+    deleted = abandoned.exclude(id__in=OrderItem.objects.values('product_info_id'))
+    delete_product_params(deleted)
+    deleted.delete()
+    # строки из заказов остаются, но не действуют ни в одной версии
+    abandoned.update(retired_version=F('version'))
+    offers.filter(version__lte=published, retired_version__gt=published).update(retired_version=None)
+
+    if shop.previous_version and shop.previous_version > published:
+        shop.previous_version = None
+        shop.save(update_fields=['previous_version'])
+    ImportRun.objects.filter(shop=shop, version__gt=published, finished__isnull=True).update(
+        status='failed', error='Версия каталога отменена новым импортом', finished=timezone.now())
+    invalidate(ProductInfo, ProductParameter)
+
+
+def clone_offers(product_info_ids, version):
+    """
+    Копирует предложения с параметрами в версию version и закрывает
+    исходные строки этой версией.
+
+    Возвращает:
+        dict: id исходного предложения -> id копии
+    """
+    offers = ProductInfo._meta.db_table
+    params = ProductParameter._meta.db_table
+    columns = ', '.join(
+        connection.ops.quote_name(field.column) for field in ProductInfo._meta.concrete_fields
+        if field.column not in ('id', 'version', 'retired_version')
+    )
+
+    clones = {}
+    with connection.cursor() as cursor:
+        product_info_ids = list(product_info_ids)
+        for start in range(0, len(product_info_ids), CLONE_BATCH_SIZE):
+            batch = product_info_ids[start:start + CLONE_BATCH_SIZE]
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute(f'''
+                INSERT INTO {offers} ({columns}, version)
+                SELECT {columns}, %s FROM {offers} WHERE id IN ({placeholders})
+            ''', [version, *batch])
+            cursor.execute(f'''
+                SELECT src.id, dst.id FROM {offers} src
+                JOIN {offers} dst ON dst.shop_id = src.shop_id AND dst.external_id = src.external_id
+                    AND dst.product_id = src.product_id AND dst.version = %s
+                WHERE src.id IN ({placeholders})
+            ''', [version, *batch])
+            clones.update(cursor.fetchall())
+            cursor.execute(f'''
+                INSERT INTO {params} (product_info_id, parameter_id, value, value_number)
+                SELECT dst.id, pp.parameter_id, pp.value, pp.value_number
+                FROM {params} pp
+                JOIN {offers} src ON src.id = pp.product_info_id
+                JOIN {offers} dst ON dst.shop_id = src.shop_id AND dst.external_id = src.external_id
+                    AND dst.product_id = src.product_id AND dst.version = %s
+                WHERE src.id IN ({placeholders})
+            ''', [version, *batch])
+            cursor.execute(f'UPDATE {offers} SET retired_version = %s WHERE id IN ({placeholders})', [version, *batch])
+    invalidate(ProductInfo, ProductParameter)
+    return clones
+
+
+def publish_catalog_version(shop, version):
+    """
+    Публикует версию каталога магазина и переносит на нее корзины покупателей.
+
+    Строки, не нужные ни опубликованной, ни предыдущей версии, удаляются
+    (см. purge_catalog_versions), витрина каталога обновляется до новой версии.
+    """
+    with transaction.atomic():
+        locked = Shop.objects.select_for_update().get(id=shop.id)
+        if locked.catalog_version == version:
+            return
+        source = locked.catalog_version
+        locked.previous_version = source
+        locked.catalog_version = version
+        locked.save(update_fields=['catalog_version', 'previous_version'])
+        move_baskets(locked, version)
+
+    shop.catalog_version = locked.catalog_version
+    shop.previous_version = locked.previous_version
+    purge_catalog_versions(locked)
+    sync_storefront(locked)
+
+
+def rollback_catalog_version(shop):
+    """
+    Возвращает опубликованной предыдущую версию каталога.
+
+    Возвращает:
+        bool: False, если предыдущей версии нет
+    """
+    shop.refresh_from_db(fields=['catalog_version', 'previous_version'])
+    if not shop.previous_version:
+        return False
+    publish_catalog_version(shop, shop.previous_version)
+    return True
+
+
+def move_baskets(shop, target):
+    """Переводит позиции корзин с предложений, не действующих в версии target, на те же предложения этой версии"""
+    items = [
+        (item_id, external_id, product_id)
+        for item_id, external_id, product_id, version, retired_version in OrderItem.objects.filter(
+            order__state='basket', product_info__shop=shop).values_list(
+            'id', 'product_info__external_id', 'product_info__product_id',
+            'product_info__version', 'product_info__retired_version')
+        if not (version <= target and (retired_version is None or retired_version > target))
+    ]
+    if not items:
+        return
+
+    targets = {
+        (external_id, product_id): product_info_id
+        for product_info_id, external_id, product_id in ProductInfo.objects.visible(target).filter(
+            shop=shop, external_id__in={external_id for _, external_id, _ in items}
+        ).values_list('id', 'external_id', 'product_id')
+    }
+    # позиции без предложения в новой версии остаются на старом и не оформляются в заказ
+    OrderItem.objects.bulk_update([
+        OrderItem(id=item_id, product_info_id=targets[(external_id, product_id)])
+        for item_id, external_id, product_id in items if (external_id, product_id) in targets
+    ], ['product_info'])
+
+
+def purge_catalog_versions(shop):
+    """
+    Удаляет строки предложений, не действующие ни в опубликованной,
+    ни в предыдущей версии, ни в версиях идущих импортов.
+
+    Предложения, на которые ссылаются позиции заказов, сохраняются.
+    """
+    keep = {shop.catalog_version, shop.previous_version}
+    keep.update(ImportRun.objects.filter(
+        shop=shop, status__in=('running', 'failed'), finished__isnull=True, version__isnull=False
+    ).values_list('version', flat=True))
+
+    deleted = ProductInfo.objects.filter(shop=shop, retired_version__lte=min(keep - {None})).exclude(
+        id__in=OrderItem.objects.values('product_info_id'))
+    delete_product_params(deleted)
+    deleted.delete()
@@ -0,0 +1,373 @@
+"""
+Фасеты каталога: фильтры по значениям параметров и число предложений
+у каждого значения.
+
+Фасеты считаются не соединениями с ProductParameter, а по заранее
+построенному инвертированному индексу CatalogFacet: для каждого магазина,
+категории и пары (параметр, значение) хранится битовая карта id показанных
+предложений витрины. Фильтр - это ИЛИ карт выбранных значений параметра
+и И по разным параметрам, число предложений - число единичных битов
+пересечения (int.bit_count), поэтому запрос фасетов читает одну таблицу
+и не зависит от числа строк ProductParameter.
+
+Карты магазина в категории отсчитываются от общего base - наименьшего
+id показанного предложения, поэтому их размер определяется разбросом id
+предложений магазина, а не числом предложений всех магазинов. Операции
+над картами идут внутри магазина в категории, результаты складываются.
+
+Индекс обновляется вместе с витриной (backend.storefront): при пересборке
+строк витрины update_facets снимает биты прежних строк и ставит биты
+новых, при смене статуса магазина его строки индекса строятся заново
+(rebuild_shop_facets).
+"""
+import re
+import zlib
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import Q, Sum
+
+from backend.models import CatalogEntry, CatalogFacet, parse_number
+
+# параметр и значение строки индекса со всеми показанными предложениями
+FACET_ALL = ('', '')
+FILTER_RE = re.compile(r'(?P<parameter>[^<>=]*[^<>=\s])\s*(?P<operator>>=|<=|>|<|=)\s*(?P<value>.*)')
+RANGE_LOOKUPS = {'>': 'gt', '>=': 'gte', '<': 'lt', '<=': 'lte'}
+# нулевых младших битов, после которых base магазина в категории сдвигается вперед
+REBASE_SLACK = 8 * 4096
+
+
+def encode_bitmap(bits):
+    """Битовая карта (int) в сжатые байты для CatalogFacet.bitmap"""
+    return zlib.compress(bits.to_bytes((bits.bit_length() + 7) // 8, 'little'))
+
+
+def decode_bitmap(data):
+    """Битовая карта (int) из сжатых байтов CatalogFacet.bitmap"""
+    return int.from_bytes(zlib.decompress(data), 'little')
+
+
+def ids_bitmap(ids, base):
+    """Битовая карта id не меньше base"""
+    offsets = [product_info_id - base for product_info_id in ids if product_info_id >= base]
+    if not offsets:
+        return 0
+    data = bytearray(max(offsets) // 8 + 1)
+    for offset in offsets:
+        data[offset >> 3] |= 1 << (offset & 7)
+    return int.from_bytes(data, 'little')
+
+
+def bitmap_ids(bits, base, after=None, before=None, limit=None, reverse=False):
+    """
+    id, отмеченные в битовой карте.
+
+    Аргументы:
+        bits (int): битовая карта
+        base (int): id нулевого бита
+        after (int): только id больше этого
+        before (int): только id меньше этого
+        limit (int): не больше стольких id
+        reverse (bool): по убыванию id
+    """
+    if after is not None and after >= base:
+        shift = after - base + 1
+        bits = bits >> shift << shift
+    if before is not None:
+        if before <= base:
+            return []
+        bits &= (1 << (before - base)) - 1
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    positions = range(len(data) - 1, -1, -1) if reverse else range(len(data))
+    bit_order = range(7, -1, -1) if reverse else range(8)
+    ids = []
+    for position in positions:
+        byte = data[position]
+        if not byte:
+            continue
+        for bit in bit_order:
+            if byte >> bit & 1:
+                ids.append(base + position * 8 + bit)
+                if limit is not None and len(ids) >= limit:
+                    return ids
+    return ids
+
+
+def facet_keys(parameters):
+    """Пары (параметр, значение) строки витрины, включая FACET_ALL"""
+    return [FACET_ALL, *((item['parameter'], item['value']) for item in parameters)]
+
+
+def visible_entries(entries):
+    """Показанные покупателям строки витрины (словари) в виде для update_facets"""
+    return [
+        (entry['product_info_id'], entry['shop_id'], entry['category_id'], entry['parameters'])
+        for entry in entries if entry['shop_state'] and entry['is_active']
+    ]
+
+
+def update_facets(removed, added):
+    """
+    Переносит в индекс фасетов изменения строк витрины.
+
+    Аргументы:
+        removed: прежние показанные строки витрины - кортежи
+            (product_info_id, shop_id, category_id, parameters)
+        added: новые показанные строки витрины в том же виде; строка,
+            попавшая в оба списка, сначала снимается, потом ставится
+    """
+    changes = defaultdict(lambda: (defaultdict(list), defaultdict(list)))
+    for entries, index in ((removed, 0), (added, 1)):
+        for product_info_id, shop_id, category_id, parameters in entries:
+            postings = changes[(shop_id, category_id)][index]
+            for key in facet_keys(parameters):
+                postings[key].append(product_info_id)
+
+    with transaction.atomic():
+        for (shop_id, category_id), (clear, put) in changes.items():
+            update_scope_facets(shop_id, category_id, clear, put)
+
+
+def update_scope_facets(shop_id, category_id, clear, put):
+    """Снимает и ставит биты карт магазина в категории: clear и put - (параметр, значение) -> id"""
+    scope = CatalogFacet.objects.select_for_update().filter(shop_id=shop_id, category_id=category_id)
+    keys = set(clear) | set(put)
+    rows = {
+        (row.parameter, row.value): row
+        for row in scope.filter(parameter__in={parameter for parameter, _ in keys})
+    }
+    bits = {key: decode_bitmap(row.bitmap) for key, row in rows.items()}
+    changed = set()
+
+    base = rows[FACET_ALL].base if FACET_ALL in rows else None
+    lowest = min(put[FACET_ALL]) if put.get(FACET_ALL) else None
+    if base is None:
+        if lowest is None:
+            return
+        base = lowest & ~7
+    elif lowest is not None and lowest < base:
+        # предложение старше начала карт, например после отката версии каталога
+        base = rebase(scope, rows, bits, base, lowest & ~7)
+        changed.update(bits)
+
+    for key in keys:
+        current = bits.get(key, 0)
+        value = current & ~ids_bitmap(clear.get(key, ()), base) | ids_bitmap(put.get(key, ()), base)
+        if value != current:
+            bits[key] = value
+            changed.add(key)
+
+    shown = bits.get(FACET_ALL, 0)
+    if not shown:
+        # карты значений - подмножества карты всех предложений
+        scope.delete()
+        return
+    offset = ((shown & -shown).bit_length() - 1) & ~7
+    if offset >= REBASE_SLACK:
+        base = rebase(scope, rows, bits, base, base + offset)
+        changed.update(bits)
+
+    created, updated, emptied = [], [], []
+    for key in changed:
+        row, value = rows.get(key), bits[key]
+        if row is None:
+            if value:
+                created.append(CatalogFacet(
+                    shop_id=shop_id, category_id=category_id, parameter=key[0], value=key[1], base=base,
+                    bitmap=encode_bitmap(value), count=value.bit_count()))
+        elif value:
+            row.base, row.bitmap, row.count = base, encode_bitmap(value), value.bit_count()
+            updated.append(row)
+        else:
+            emptied.append(row.id)
+    CatalogFacet.objects.filter(id__in=emptied).delete()
+    CatalogFacet.objects.bulk_update(updated, ['base', 'bitmap', 'count'])
+    CatalogFacet.objects.bulk_create(created)
+
+
+def rebase(scope, rows, bits, base, new_base):
+    """Загружает все карты магазина в категории и сдвигает их к new_base, возвращает new_base"""
+    for row in scope:
+        key = (row.parameter, row.value)
+        if key not in rows:
+            rows[key] = row
+            bits[key] = decode_bitmap(row.bitmap)
+    shift = base - new_base
+    for key, value in bits.items():
+        bits[key] = value << shift if shift > 0 else value >> -shift
+    return new_base
+
+
+def rebuild_shop_facets(shop):
+    """Строит индекс фасетов магазина заново по его показанным строкам витрины"""
+    entries = CatalogEntry.objects.filter(shop_id=shop.id, shop_state=True, is_active=True)
+    with transaction.atomic():
+        CatalogFacet.objects.filter(shop_id=shop.id).delete()
+        for category_id in entries.order_by().values_list('category_id', flat=True).distinct():
+            postings = defaultdict(list)
+            for product_info_id, parameters in entries.filter(category_id=category_id).values_list(
+                    'product_info_id', 'parameters').iterator():
+                for key in facet_keys(parameters):
+                    postings[key].append(product_info_id)
+            base = min(postings[FACET_ALL]) & ~7
+            facets = []
+            for (parameter, value), ids in postings.items():
+                bits = ids_bitmap(ids, base)
+                facets.append(CatalogFacet(shop_id=shop.id, category_id=category_id, parameter=parameter,
+                                           value=value, base=base, bitmap=encode_bitmap(bits),
+                                           count=bits.bit_count()))
+            CatalogFacet.objects.bulk_create(facets)
+
+
+def parse_parameter_filters(values):
+    """
+    Разбирает фильтры параметров вида "Цвет=черный" и "Диагональ (дюйм)>=10".
+
+    Возвращает:
+        tuple: словарь имя параметра -> множество значений (значения
+            одного параметра объединяются по ИЛИ, разные параметры - по И)
+            и список диапазонов (имя параметра, lookup, число), где
+            lookup - gt, gte, lt или lte
+
+    Исключения:
+        ValueError: фильтр без знака сравнения или без имени параметра,
+            диапазон с нечисловой границей
+    """
+    selected = defaultdict(set)
+    ranges = []
+    for text in values:
+        match = FILTER_RE.fullmatch(text.strip())
+        if match is None:
+            raise ValueError(f'Неверный фильтр параметра: {text}')
+        parameter, operator, value = match.group('parameter', 'operator', 'value')
+        if operator == '=':
+            selected[parameter].add(value)
+            continue
+        number = parse_number(value)
+        if number is None:
+            raise ValueError(f'Граница диапазона параметра не число: {text}')
+        ranges.append((parameter, RANGE_LOOKUPS[operator], number))
+    return dict(selected), ranges
+
+
+def facet_scope(shop_id=None, category_id=None):
+    """Строки индекса фасетов для фильтров каталога shop_id и category_id"""
+    facets = CatalogFacet.objects.all()
+    if shop_id:
+        facets = facets.filter(shop_id=shop_id)
+    if category_id:
+        facets = facets.filter(category_id=category_id)
+    return facets
+
+
+def load_postings(facets):
+    """Карты строк индекса: (магазин, категория) -> (base, {(параметр, значение): int})"""
+    scopes = {}
+    for shop_id, category_id, parameter, value, base, bitmap in facets.values_list(
+            'shop_id', 'category_id', 'parameter', 'value', 'base', 'bitmap'):
+        scopes.setdefault((shop_id, category_id), (base, {}))[1][(parameter, value)] = decode_bitmap(bitmap)
+    return scopes
+
+
+def filter_bitmap(postings, selected, skip=None):
+    """Карта предложений под фильтрами selected, кроме фильтра параметра skip"""
+    bits = postings.get(FACET_ALL, 0)
+    for parameter, values in selected.items():
+        if parameter != skip:
+            bits &= reduce(or_, (postings.get((parameter, value), 0) for value in values), 0)
+    return bits
+
+
+def restrict_postings(scopes, restrict):
+    """Оставляет в картах всех предложений только id из restrict (None - без ограничения)"""
+    if restrict is not None:
+        for base, postings in scopes.values():
+            postings[FACET_ALL] = postings.get(FACET_ALL, 0) & ids_bitmap(restrict, base)
+    return scopes
+
+
+def select_offers(selected, shop_id=None, category_id=None, restrict=None):
+    """
+    Показанные предложения под фильтрами параметров. Из индекса читаются
+    только карты выбранных значений.
+
+    Аргументы:
+        restrict: только предложения с этими id, например под фильтрами
+            диапазонов числовых параметров
+
+    Возвращает:
+        list: пары (base, битовая карта) по магазинам и категориям
+    """
+    keys = Q(parameter='', value='')
+    for parameter, values in selected.items():
+        keys |= Q(parameter=parameter, value__in=values)
+    selection = []
+    scopes = load_postings(facet_scope(shop_id, category_id).filter(keys))
+    for base, postings in restrict_postings(scopes, restrict).values():
+        bits = filter_bitmap(postings, selected)
+        if bits:
+            selection.append((base, bits))
+    return selection
+
+
+def selection_ids(selection, after=None, before=None, limit=None, reverse=False):
+    """id предложений из select_offers по порядку, аргументы - как у bitmap_ids"""
+    ids = []
+    for base, bits in selection:
+        ids.extend(bitmap_ids(bits, base, after, before, limit, reverse))
+    ids.sort(reverse=reverse)
+    return ids[:limit] if limit is not None else ids
+
+
+def count_facets(selected=None, shop_id=None, category_id=None, restrict=None):
+    """
+    Число показанных предложений у каждого значения каждого параметра.
+
+    Значения выбранного параметра считаются без учета его собственного
+    фильтра, чтобы можно было добавить к выбору другие значения.
+
+    Аргументы:
+        selected (dict): фильтры, см. parse_parameter_filters
+        shop_id (int), category_id (int): фильтры каталога
+        restrict: только предложения с этими id, как в select_offers
+
+    Возвращает:
+        tuple: число предложений под фильтрами и список
+            [{'parameter': имя, 'values': [{'value': ..., 'count': ...}]}]
+            по имени параметра и убыванию числа предложений
+    """
+    facets = facet_scope(shop_id, category_id)
+    counts = defaultdict(lambda: defaultdict(int))
+    total = 0
+    if selected or restrict is not None:
+        selected = selected or {}
+        for _, postings in restrict_postings(load_postings(facets), restrict).values():
+            total += filter_bitmap(postings, selected).bit_count()
+            bases = {}
+            for (parameter, value), bits in postings.items():
+                if (parameter, value) == FACET_ALL:
+                    continue
+                if parameter not in bases:
+                    bases[parameter] = filter_bitmap(postings, selected, skip=parameter)
+                count = (bits & bases[parameter]).bit_count()
+                if count:
+                    counts[parameter][value] += count
+    else:
+        # без фильтров хватает сохраненных чисел предложений
+        for parameter, value, count in facets.values_list('parameter', 'value').annotate(
+                total=Sum('count')).order_by():
+            if (parameter, value) == FACET_ALL:
+                total = count
+            else:
+                counts[parameter][value] = count
+
+    return total, [
+        {
+            'parameter': parameter,
+            'values': [{'value': value, 'count': count}
+                       for value, count in sorted(values.items(), key=lambda item: (-item[1], item[0]))],
+        }
+        for parameter, values in sorted(counts.items())
+    ]
@@ -0,0 +1,137 @@
+"""
+Генератор синтетических прайс-листов для замеров импорта.
+
+Прайс строится по схеме data/shop.yaml детерминированно по номеру товара,
+поэтому одинаковые параметры дают одинаковый прайс. Ревизия r получается
+из ревизии r - 1 изменением цены и остатка у доли changed товаров, что
+позволяет замерять как полный, так и дельта-импорт. Товары генерируются
+и записываются по одному, так что прайс на миллион позиций не собирается
+в памяти. Прайс записывается в YAML, CSV или JSON Lines (см. backend.feeds).
+"""
+import csv
+import json
+from random import Random
+
+# ИД категорий синтетических прайсов, чтобы не пересекаться с настоящими
+CATEGORY_ID_BASE = 900000
+COLORS = ('черный', 'белый', 'серый', 'синий', 'красный', 'зеленый')
+
+
+def category_ids(categories):
+    """ИД категорий синтетического прайса"""
+    return [CATEGORY_ID_BASE + index for index in range(categories)]
+
+
+def generate_price_feed(skus, categories=10, parameters=4, changed=0.0, revision=0, seed=0,
+                        shop='Benchmark Shop'):
+    """
+    Собирает синтетический прайс.
+
+    Аргументы:
+        skus (int): число товаров
+        categories (int): число категорий
+        parameters (int): параметров у каждого товара
+        changed (float): доля товаров, изменившихся относительно предыдущей ревизии
+        revision (int): ревизия прайса, 0 - исходный прайс
+        seed (int): зерно выбора изменившихся товаров
+        shop (str): название магазина
+
+    Возвращает:
+        dict: shop, categories и goods - генератор товаров
+    """
+    return {
+        'shop': shop,
+        'categories': [
+            {'id': category_id, 'name': f'Категория {index}'}
+            for index, category_id in enumerate(category_ids(categories))
+        ],
+        'goods': _generate_goods(skus, categories, parameters, changed, revision, seed),
+    }
+
+
+def _generate_goods(skus, categories, parameters, changed, revision, seed):
+    # каждая ревизия выбирает свои изменившиеся товары независимой последовательностью
+    revisions = [Random(f'{seed}:{number}') for number in range(1, revision + 1)]
+    for index in range(skus):
+        bumps = sum(rng.random() < changed for rng in revisions)
+        yield {
+            'id': 1 + index,
+            'category': CATEGORY_ID_BASE + index % categories,
+            'model': f'bench/{index % 1000}/{index}',
+            'name': f'Товар {index}',
+            'price': 1000 + (index * 7919) % 100000 + bumps * 10,
+            'price_rrc': 1200 + (index * 7919) % 100000 + bumps * 10,
+            'quantity': (index + bumps) % 50,
+            'parameters': {
+                f'Параметр {number}': COLORS[(index + number) % len(COLORS)] if number % 2 else index % 512
+                for number in range(parameters)
+            },
+        }
+
+
+FEED_FORMATS = ('yaml', 'csv', 'jsonl')
+
+
+def write_price_feed(f, data, feed_format='yaml'):
+    """
+    Записывает прайс в текстовый файл.
+
+    Аргументы:
+        f: текстовый файл
+        data (dict): прайс с ключами shop, categories и goods
+        feed_format (str): yaml (как data/shop.yaml), csv или jsonl
+    """
+    if feed_format == 'csv':
+        return _write_csv_feed(f, data)
+    if feed_format == 'jsonl':
+        return _write_jsonl_feed(f, data)
+
+    # строки записываются в двойных кавычках JSON, что является корректной записью строки YAML
+    f.write(f'shop: {json.dumps(data["shop"], ensure_ascii=False)}\ncategories:\n')
+    for category in data['categories']:
+        f.write(f'  - id: {category["id"]}\n    name: {json.dumps(category["name"], ensure_ascii=False)}\n')
+    f.write('goods:\n')
+    for item in data['goods']:
+        lines = [
+            f'  - id: {item["id"]}',
+            f'    category: {item["category"]}',
+            f'    model: {json.dumps(item["model"], ensure_ascii=False)}',
+            f'    name: {json.dumps(item["name"], ensure_ascii=False)}',
+            f'    price: {item["price"]}',
+            f'    price_rrc: {item["price_rrc"]}',
+            f'    quantity: {item["quantity"]}',
+            '    parameters:' if item['parameters'] else '    parameters: {}',
+        ]
+        lines.extend(
+            f'      {json.dumps(name, ensure_ascii=False)}: {json.dumps(value, ensure_ascii=False)}'
+            for name, value in item['parameters'].items()
+        )
+        f.write('\n'.join(lines))
+        f.write('\n')
+
+
+def _write_jsonl_feed(f, data):
+    header = {'shop': data['shop'], 'categories': data['categories']}
+    f.write(json.dumps(header, ensure_ascii=False))
+    f.write('\n')
+    for item in data['goods']:
+        f.write(json.dumps(item, ensure_ascii=False))
+        f.write('\n')
+
+
+def _write_csv_feed(f, data):
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow(['#shop', data['shop']])
+    for category in data['categories']:
+        writer.writerow(['#category', category['id'], category['name']])
+
+    columns = None
+    for item in data['goods']:
+        if columns is None:
+            # столбцы параметров берутся по первому товару, у синтетических товаров они одинаковые
+            columns = list(item['parameters'])
+            writer.writerow(['id', 'category', 'model', 'name', 'price', 'price_rrc', 'quantity', *columns])
+        writer.writerow([
+            item['id'], item['category'], item['model'], item['name'], item['price'], item['price_rrc'],
+            item['quantity'], *(item['parameters'].get(name, '') for name in columns),
+        ])
@@ -0,0 +1,352 @@
+"""
+Потоковое чтение прайс-листов поставщиков.
+
+Прайс в формате data/shop.yaml разбирается по событиям YAML: заголовок
+(shop, categories) читается целиком, а товары из раздела goods отдаются
+по одному, поэтому потребление памяти не зависит от размера прайса.
+Если PyYAML собран с libyaml, используется быстрый CSafeLoader.
+
+Та же схема товаров принимается в CSV и JSON Lines, которые разбираются
+намного быстрее YAML, и в сжатом gzip виде любого из форматов. Формат
+определяется по Content-Type ответа поставщика, а если он не задан или
+неизвестен - по первым байтам прайса:
+
+* JSON Lines - первая строка {"shop": ..., "categories": [...]},
+  далее по одному товару в строке;
+* CSV - строки #shop,<название> и #category,<ИД>,<название>, затем строка
+  заголовков id,category,model,name,price,price_rrc,quantity, остальные
+  столбцы - параметры товара (пустое значение - параметра нет);
+* gzip - сигнатура 1f 8b, содержимое распаковывается на лету.
+"""
+import csv
+import gzip
+from io import BufferedReader, RawIOBase, TextIOWrapper
+
+from ujson import loads
+from yaml import SafeLoader
+from yaml.events import (
+    AliasEvent,
+    DocumentStartEvent,
+    MappingEndEvent,
+    MappingStartEvent,
+    ScalarEvent,
+    SequenceEndEvent,
+    SequenceStartEvent,
+    StreamStartEvent,
+)
+from yaml.nodes import MappingNode, ScalarNode, SequenceNode
+
+try:
+    from yaml import CSafeLoader as FeedLoader
+except ImportError:
+    FeedLoader = SafeLoader
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+# байтов начала прайса, по которым определяется формат
+DETECT_SIZE = 4096
+CONTENT_TYPES = {
+    'text/csv': 'csv',
+    'application/csv': 'csv',
+    'application/jsonl': 'jsonl',
+    'application/x-jsonlines': 'jsonl',
+    'application/x-ndjson': 'jsonl',
+    'application/jsonlines': 'jsonl',
+    'application/yaml': 'yaml',
+    'application/x-yaml': 'yaml',
+    'text/yaml': 'yaml',
+    'text/x-yaml': 'yaml',
+}
+CSV_COLUMNS = ('id', 'category', 'model', 'name', 'price', 'price_rrc', 'quantity')
+CSV_INT_COLUMNS = ('id', 'category', 'price', 'price_rrc', 'quantity')
+
+
+class PriceFeedError(ValueError):
+    """Прайс не соответствует ожидаемой структуре"""
+
+
+class PrefixedReader(RawIOBase):
+    """Файловый объект, отдающий сначала уже прочитанное начало потока, затем остаток потока"""
+
+    def __init__(self, head, stream):
+        self.buffer = head
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.buffer:
+            chunk = self.stream.read(len(b))
+            # текстовые потоки (например, StringIO в тестах) перекодируются в байты
+            self.buffer = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def detect_feed_format(head, content_type=None):
+    """
+    Определяет формат прайса.
+
+    Аргументы:
+        head (bytes): начало распакованного прайса
+        content_type (str): Content-Type ответа поставщика
+
+    Возвращает:
+        str: yaml, csv или jsonl
+    """
+    media_type = (content_type or '').split(';')[0].strip().lower()
+    if media_type in CONTENT_TYPES:
+        return CONTENT_TYPES[media_type]
+
+    head = head.removeprefix(b'\xef\xbb\xbf').lstrip()
+    if head.startswith(b'{'):
+        return 'jsonl'
+    if head.startswith((b'#shop', b'"#shop"')):
+        return 'csv'
+    return 'yaml'
+
+
+def read_price_feed(stream, content_type=None):
+    """
+    Начинает потоковое чтение прайса любого поддерживаемого формата.
+
+    Аргументы:
+        stream: файловый объект (байты или текст) с прайсом
+        content_type (str): Content-Type ответа поставщика, если известен
+
+    Возвращает:
+        dict: shop и categories из заголовка прайса и goods -
+        генератор товаров, читающий поток по мере обхода
+    """
+    head = stream.read(DETECT_SIZE)
+    if isinstance(head, str):
+        head = head.encode('utf-8')
+    stream = BufferedReader(PrefixedReader(head, stream))
+    if head.startswith(GZIP_MAGIC):
+        stream = BufferedReader(gzip.GzipFile(fileobj=stream, mode='rb'))
+        try:
+            head = stream.peek(DETECT_SIZE)
+        except (OSError, EOFError) as e:
+            raise PriceFeedError(f'Поврежденный архив gzip: {e}')
+
+    feed_format = detect_feed_format(head, content_type)
+    if feed_format == 'csv':
+        return check_header(read_csv_feed(stream))
+    if feed_format == 'jsonl':
+        return check_header(read_jsonl_feed(stream))
+    return check_header(read_yaml_feed(stream))
+
+
+def check_header(header):
+    """
+    Проверяет заголовок прайса любого формата: непустое название магазина
+    shop и список категорий с id и name. Ошибка заголовка - PriceFeedError,
+    а не KeyError или ошибка базы при импорте, и импорт не повторяется.
+    """
+    shop = header.get('shop')
+    categories = header.get('categories')
+    error = None
+    if shop is None or not str(shop).strip():
+        error = 'В прайсе не указано название магазина shop'
+    elif not isinstance(categories, list):
+        error = 'В прайсе нет списка категорий categories'
+    elif not all(isinstance(category, dict) and {'id', 'name'} <= set(category) for category in categories):
+        error = 'Каждая категория прайса должна содержать id и name'
+    if error:
+        header['goods'].close()
+        raise PriceFeedError(error)
+    return header
+
+
+def read_jsonl_feed(stream):
+    """
+    Начинает потоковое чтение прайса в формате JSON Lines.
+
+    Аргументы:
+        stream: файловый объект с байтами прайса
+
+    Возвращает:
+        dict: shop, categories и генератор goods
+    """
+    lines = _iter_json_lines(stream)
+    try:
+        number, header = next(lines)
+    except StopIteration:
+        raise PriceFeedError('Пустой прайс')
+    if not isinstance(header, dict) or 'goods' in header:
+        raise PriceFeedError('Первая строка прайса JSON Lines должна быть словарем с shop и categories')
+    header['goods'] = (item for _, item in lines)
+    return header
+
+
+def _iter_json_lines(stream):
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield number, loads(line)
+        except ValueError as e:
+            raise PriceFeedError(f'Строка {number}: некорректный JSON ({e})')
+
+
+def read_csv_feed(stream):
+    """
+    Начинает потоковое чтение прайса в формате CSV.
+
+    Аргументы:
+        stream: файловый объект с байтами прайса
+
+    Возвращает:
+        dict: shop, categories и генератор goods
+    """
+    text = TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text)
+    header = {'shop': None, 'categories': []}
+    for row in reader:
+        if not row or not any(row):
+            continue
+        marker = row[0].strip()
+        if marker == '#shop' and len(row) >= 2:
+            header['shop'] = row[1]
+        elif marker == '#category' and len(row) >= 3:
+            header['categories'].append({'id': _to_int(row[1]), 'name': row[2]})
+        elif marker.startswith('#'):
+            raise PriceFeedError(f'Строка {reader.line_num}: неизвестная строка заголовка {marker}')
+        else:
+            columns = [column.strip() for column in row]
+            break
+    else:
+        header['goods'] = iter(())
+        return header
+
+    missing = [column for column in CSV_COLUMNS if column not in columns]
+    if missing:
+        raise PriceFeedError(f'В CSV-прайсе нет столбцов: {", ".join(missing)}')
+    header['goods'] = _iter_csv_goods(reader, columns)
+    return header
+
+
+def _iter_csv_goods(reader, columns):
+    parameters = [(index, name) for index, name in enumerate(columns) if name not in CSV_COLUMNS]
+    positions = {name: columns.index(name) for name in CSV_COLUMNS}
+    width = len(columns)
+    for row in reader:
+        if not row or not any(row):
+            continue
+        if len(row) != width:
+            # строка другой длины отдается проверке с теми полями, что есть
+            row = (row + [''] * width)[:width]
+        item = {name: row[index] for name, index in positions.items()}
+        for name in CSV_INT_COLUMNS:
+            item[name] = _to_int(item[name])
+        item['parameters'] = {name: row[index] for index, name in parameters if row[index] != ''}
+        yield item
+
+
+def _to_int(value):
+    """Целое из строки CSV; нечисловая строка остается как есть и отклоняется проверкой"""
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def read_yaml_feed(stream):
+    """
+    Начинает потоковое чтение прайса в формате YAML.
+
+    Аргументы:
+        stream: файловый объект (байты или текст) с YAML-прайсом
+
+    Возвращает:
+        dict: shop и categories из заголовка прайса и goods -
+        генератор товаров, читающий поток по мере обхода
+    """
+    loader = FeedLoader(stream)
+    # якоря действуют в пределах всего документа
+    anchors = {}
+    try:
+        for event_class in (StreamStartEvent, DocumentStartEvent, MappingStartEvent):
+            if not loader.check_event(event_class):
+                raise PriceFeedError('Прайс должен быть YAML-словарем с разделами shop, categories и goods')
+            loader.get_event()
+
+        header = {}
+        while not loader.check_event(MappingEndEvent):
+            key = _construct(loader, anchors)
+            if key == 'goods':
+                header['goods'] = _iter_goods(loader, anchors)
+                return header
+            header[key] = _construct(loader, anchors)
+    except Exception:
+        loader.dispose()
+        raise
+
+    loader.dispose()
+    header['goods'] = iter(())
+    return header
+
+
+def _iter_goods(loader, anchors):
+    try:
+        if loader.check_event(SequenceStartEvent):
+            loader.get_event()
+            while not loader.check_event(SequenceEndEvent):
+                yield _construct(loader, anchors)
+            loader.get_event()
+        elif _construct(loader, anchors) is not None:
+            raise PriceFeedError('Раздел goods должен быть списком')
+
+        if not loader.check_event(MappingEndEvent):
+            raise PriceFeedError('Раздел goods должен быть последним в прайсе')
+    finally:
+        loader.dispose()
+
+
+def _construct(loader, anchors):
+    """Собирает узел из очередных событий и превращает его в объект Python"""
+    return loader.construct_document(_compose(loader, loader.get_event(), anchors))
+
+
+def _compose(loader, event, anchors):
+    if isinstance(event, AliasEvent):
+        if event.anchor not in anchors:
+            raise PriceFeedError(f'Неизвестный якорь {event.anchor}')
+        return anchors[event.anchor]
+
+    if isinstance(event, ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(ScalarNode, event.value, event.implicit)
+        node = ScalarNode(tag, event.value, event.start_mark, event.end_mark, style=event.style)
+
+    elif isinstance(event, SequenceStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(SequenceNode, None, event.implicit)
+        node = SequenceNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        while not loader.check_event(SequenceEndEvent):
+            node.value.append(_compose(loader, loader.get_event(), anchors))
+        node.end_mark = loader.get_event().end_mark
+
+    elif isinstance(event, MappingStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(MappingNode, None, event.implicit)
+        node = MappingNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        while not loader.check_event(MappingEndEvent):
+            key = _compose(loader, loader.get_event(), anchors)
+            value = _compose(loader, loader.get_event(), anchors)
+            node.value.append((key, value))
+        node.end_mark = loader.get_event().end_mark
+
+    else:
+        raise PriceFeedError(f'Неожиданное событие YAML: {event}')
+
+    if event.anchor is not None:
+        anchors[event.anchor] = node
+    return node
@@ -0,0 +1,139 @@
+"""
+Загрузка прайс-листов поставщиков по HTTP.
+
+Запросы идут через общую сессию с пулом соединений, ответ потоково
+пишется во временный файл (в памяти до PRICE_FEED_SPOOL_SIZE, дальше на диск)
+с ограничением размера PRICE_FEED_MAX_BYTES. Валидаторы ETag/Last-Modified
+последней загрузки хранятся в магазине и отправляются в условном запросе.
+"""
+import hashlib
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 64 * 1024
+
+_session = None
+
+
+class FeedTooLarge(Exception):
+    """Прайс превышает допустимый размер"""
+
+
+class FetchedFeed:
+    """
+    Результат загрузки прайса.
+
+    Атрибуты:
+        file: временный файл с телом ответа, None если прайс не изменился
+        sha256 (str): хэш содержимого
+        etag (str), last_modified (str): валидаторы из заголовков ответа
+        content_type (str): Content-Type ответа, подсказка формата прайса (см. backend.feeds)
+        size (int): размер прайса в байтах
+        not_modified (bool): сервер ответил 304 Not Modified
+    """
+
+    def __init__(self, file=None, sha256='', etag='', last_modified='', size=0, not_modified=False,
+                 content_type=''):
+        self.file = file
+        self.sha256 = sha256
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+        self.size = size
+        self.not_modified = not_modified
+
+    def is_unchanged(self, shop):
+        """Прайс совпадает с последним импортированным для магазина"""
+        return self.not_modified or bool(shop.feed_hash) and self.sha256 == shop.feed_hash
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_session():
+    """Сессия requests, общая для всех загрузок в процессе"""
+    global _session
+    if _session is None:
+        adapter = HTTPAdapter(
+            pool_connections=settings.PRICE_FEED_POOL_SIZE,
+            pool_maxsize=settings.PRICE_FEED_POOL_SIZE,
+            max_retries=2,
+        )
+        _session = Session()
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def fetch_price_feed(shop, url, force=False):
+    """
+    Загружает прайс магазина.
+
+    Аргументы:
+        shop (Shop): магазин, валидаторы которого используются в условном запросе
+        url (str): адрес прайса
+        force (bool): не отправлять валидаторы и всегда загружать прайс
+
+    Возвращает:
+        FetchedFeed: загруженный прайс или признак not_modified
+    """
+    headers = {}
+    # валидаторы относятся к адресу, с которого был последний импорт
+    if not force and url == shop.url:
+        if shop.feed_etag:
+            headers['If-None-Match'] = shop.feed_etag
+        if shop.feed_last_modified:
+            headers['If-Modified-Since'] = shop.feed_last_modified
+
+    limit = settings.PRICE_FEED_MAX_BYTES
+    with get_session().get(url, headers=headers, stream=True, timeout=settings.PRICE_FEED_TIMEOUT) as response:
+        if response.status_code == 304:
+            return FetchedFeed(not_modified=True)
+        response.raise_for_status()
+
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            raise FeedTooLarge(f'Размер прайса {content_length} байт превышает {limit} байт')
+
+        file = SpooledTemporaryFile(max_size=settings.PRICE_FEED_SPOOL_SIZE)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                size += len(chunk)
+                if size > limit:
+                    raise FeedTooLarge(f'Размер прайса превышает {limit} байт')
+                digest.update(chunk)
+                file.write(chunk)
+        except Exception:
+            file.close()
+            raise
+        file.seek(0)
+
+        return FetchedFeed(
+            file=file,
+            sha256=digest.hexdigest(),
+            etag=response.headers.get('ETag', ''),
+            last_modified=response.headers.get('Last-Modified', ''),
+            size=size,
+            content_type=response.headers.get('Content-Type', '')[:100],
+        )
+
+
+def remember_feed(shop, url, feed):
+    """Сохраняет в магазине адрес, хэш и валидаторы импортированного прайса"""
+    shop.url = url
+    shop.feed_hash = feed.sha256
+    shop.feed_etag = feed.etag
+    shop.feed_last_modified = feed.last_modified
+    shop.save(update_fields=['url', 'feed_hash', 'feed_etag', 'feed_last_modified'])
@@ -0,0 +1,318 @@
+"""
+Пакетный импорт прайс-листов поставщиков.
+
+Категории, продукты и параметры разрешаются несколькими групповыми запросами
+на пачку товаров, а строки ProductInfo/ProductParameter пишет загрузчик из
+backend.loaders: через bulk_create/bulk_update или, на PostgreSQL, через COPY.
+Число запросов к базе растет с числом пачек, а не строк.
+
+Импорт сравнивает прайс с текущим каталогом магазина по (shop, external_id):
+новые товары добавляются, изменившиеся обновляются, а пропавшие из прайса
+снимаются с продажи (is_active=False) без удаления, чтобы не затронуть заказы.
+
+Товары проверяются по схеме (backend.validation): строки с ошибками
+откладываются с причинами в errors, остальные импортируются в том же запуске.
+
+Каждая пачка фиксируется отдельной транзакцией, а число записанных товаров
+сохраняется в контрольной точке ImportRun, с которой продолжается повтор.
+Время и запросы по этапам считаются в metrics (backend.metrics).
+"""
+from itertools import islice
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from ujson import dumps, loads
+
+from backend.catalog import clone_offers
+from backend.loaders import get_loader
+from backend.metrics import ImportMetrics
+from backend.models import Category, Product, ProductInfo, Parameter
+from backend.storefront import sync_storefront
+from backend.validation import GoodsValidator
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def get_external_id(item):
+    """Внешний ИД товара прайса или None, если его нельзя прочитать"""
+    external_id = item.get('id') if isinstance(item, dict) else None
+    return external_id if isinstance(external_id, int) else None
+
+
+def batched(iterable, size):
+    """Разбивает итерируемый объект на списки длиной не больше size"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class PriceImporter:
+    """
+    Импорт прайса одного магазина.
+
+    Аргументы:
+        shop (Shop): магазин, для которого загружается прайс
+        batch_size (int): размер пачки товаров, по умолчанию PRICE_IMPORT_BATCH_SIZE
+        checkpoint (ImportRun): запуск импорта, в котором сохраняется прогресс
+        version (int): версия каталога, в которую пишется прайс; по умолчанию
+            версия из checkpoint, а без нее - опубликованная версия магазина
+    """
+
+    def __init__(self, shop, batch_size=None, checkpoint=None, version=None):
+        self.shop = shop
+        if version is None and checkpoint is not None:
+            version = checkpoint.version
+        self.version = version or shop.catalog_version
+        self.batch_size = batch_size or getattr(settings, 'PRICE_IMPORT_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+        self.checkpoint = checkpoint
+        # кэш имя параметра -> id, общий для всех пачек
+        self.parameters = {}
+        self.stats = {
+            'categories': 0, 'goods': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'removed': 0, 'invalid': 0,
+        }
+        # отложенные строки: номер в прайсе, внешний ИД и причины
+        self.errors = []
+        # число товаров прайса, прочитанных до текущей пачки
+        self.position = 0
+        # внешние ИД отложенных строк: такие товары не снимаются с продажи
+        self.skipped = set()
+        self.validator = None
+        self.loader = get_loader(shop, self.version, self.batch_size)
+        self.metrics = ImportMetrics(checkpoint.metrics if checkpoint is not None else None)
+        if checkpoint is not None:
+            self.stats.update(checkpoint.stats)
+            self.errors = list(checkpoint.errors)
+
+    def run(self, data):
+        """
+        Приводит каталог магазина в соответствие с прайсом.
+
+        Аргументы:
+            data (dict): прайс с ключами shop, categories и goods;
+                goods может быть генератором, например из read_price_feed
+
+        Возвращает:
+            dict: количество категорий, товаров и добавленных/обновленных/
+            неизмененных/снятых с продажи/отложенных позиций
+        """
+        offset = self.checkpoint.offset if self.checkpoint is not None else 0
+        goods = iter(data['goods'])
+        self.position = offset
+
+        if offset:
+            # записанные до сбоя товары пропускаются, но их ИД нужны для снятия пропавших
+            seen = {get_external_id(item) for item in islice(goods, offset)}
+        else:
+            seen = set()
+            with transaction.atomic():
+                self.import_header(data)
+
+        for batch in batched(goods, self.batch_size):
+            with transaction.atomic():
+                self.import_goods(batch)
+                self.save_checkpoint(len(batch))
+            seen.update(get_external_id(item) for item in batch)
+
+        with transaction.atomic(), self.metrics.phase('retire'):
+            self.retire_missing(seen)
+        if self.version == self.shop.catalog_version:
+            # прайс записан прямо в опубликованную версию: изменившиеся строки сохранили id
+            with self.metrics.phase('storefront'):
+                sync_storefront(self.shop, rebuild=True)
+        return self.stats
+
+    def save_checkpoint(self, count):
+        """Сохраняет прогресс в той же транзакции, что и пачку товаров"""
+        if self.checkpoint is not None:
+            with self.metrics.phase('checkpoint'):
+                self.checkpoint.offset += count
+                self.checkpoint.stats = self.stats
+                self.checkpoint.errors = self.errors
+                self.checkpoint.metrics = self.metrics.as_dict()
+                self.checkpoint.save(update_fields=['offset', 'stats', 'errors', 'metrics', 'updated'])
+
+    def import_header(self, data):
+        """Обновляет название магазина и категории из заголовка прайса"""
+        with self.metrics.phase('header'):
+            self.update_shop(data['shop'])
+            self.import_categories(data['categories'])
+
+    def update_shop(self, name):
+        if self.shop.name != name:
+            self.shop.name = name
+            self.shop.save(update_fields=['name'])
+
+    def import_categories(self, categories):
+        """Создает недостающие категории и привязывает их к магазину одной вставкой"""
+        names = {category['id']: category['name'] for category in categories}
+        existing = set(Category.objects.filter(id__in=names).values_list('id', flat=True))
+
+        Category.objects.bulk_create(
+            [Category(id=category_id, name=name) for category_id, name in names.items()
+             if category_id not in existing],
+            batch_size=self.batch_size
+        )
+
+        through = Category.shops.through
+        through.objects.bulk_create(
+            [through(category_id=category_id, shop_id=self.shop.id) for category_id in names],
+            ignore_conflicts=True
+        )
+        self.stats['categories'] += len(names)
+
+    def validate(self, goods):
+        """Возвращает корректные товары пачки, откладывая остальные в errors"""
+        with self.metrics.phase('validate') as phase:
+            if self.validator is None:
+                # категории магазина известны после import_header
+                self.validator = GoodsValidator(
+                    Category.objects.filter(shops=self.shop).values_list('id', flat=True),
+                    errors=self.errors,
+                    max_errors=getattr(settings, 'PRICE_IMPORT_MAX_ERRORS', 100),
+                )
+            valid = self.validator.filter(goods, self.position)
+            phase['rows'] += len(goods)
+        if len(valid) < len(goods):
+            self.skipped.update({get_external_id(item) for item in goods} - {item['id'] for item in valid})
+        self.position += len(goods)
+        self.stats['goods'] += len(goods) - len(valid)
+        self.stats['invalid'] += len(goods) - len(valid)
+        return valid
+
+    def import_goods(self, goods):
+        """Сравнивает пачку товаров с каталогом и записывает только отличия"""
+        goods = self.validate(goods)
+        # при повторе внешнего ИД в пачке действует последнее вхождение
+        goods = list({item['id']: item for item in goods}.values())
+        with self.metrics.phase('resolve') as phase:
+            products = self.resolve_products(goods)
+            parameters = self.resolve_parameters(goods)
+            phase['rows'] += len(goods)
+        rows = [
+            (
+                item['id'],
+                {
+                    'product_id': products[(item['name'], item['category'])],
+                    'model': item['model'],
+                    'price': item['price'],
+                    'price_rrc': item['price_rrc'],
+                    'quantity': item['quantity'],
+                },
+                {parameters[name]: str(value) for name, value in item['parameters'].items()},
+            )
+            for item in goods
+        ]
+        with self.metrics.phase('write') as phase:
+            created, changed = self.loader.write(rows)
+            phase['rows'] += len(rows)
+
+        self.stats['goods'] += len(goods)
+        self.stats['inserted'] += len(created)
+        self.stats['updated'] += len(changed)
+        self.stats['unchanged'] += len(goods) - len(created) - len(changed)
+
+    def retire_missing(self, seen):
+        """Снимает с продажи товары магазина, которых нет в прайсе"""
+        self.retire(self.find_stale(seen))
+
+    def find_stale(self, seen):
+        """Возвращает id товаров магазина в продаже, внешних ИД которых нет в seen"""
+        active = ProductInfo.objects.visible(self.version).filter(
+            shop_id=self.shop.id, is_active=True).values_list('id', 'external_id')
+        return [product_info_id for product_info_id, external_id in active if external_id not in seen]
+
+    def retire(self, product_info_ids):
+        for batch in batched(product_info_ids, self.batch_size):
+            # предложения прежних версий снимаются с продажи в своей копии в этой версии
+            previous = ProductInfo.objects.filter(id__in=batch, version__lt=self.version).values_list('id', flat=True)
+            clones = clone_offers(list(previous), self.version)
+            ProductInfo.objects.filter(id__in=[clones.get(product_info_id, product_info_id)
+                                               for product_info_id in batch]).update(is_active=False)
+        self.stats['removed'] += len(product_info_ids)
+
+    def resolve_products(self, goods):
+        """
+        Возвращает словарь (название, категория) -> id продукта,
+        создавая недостающие продукты одной вставкой.
+        """
+        keys = {(item['name'], item['category']) for item in goods}
+        products = self._fetch_products(keys)
+
+        missing = keys - products.keys()
+        if missing:
+            Product.objects.bulk_create([Product(name=name, category_id=category_id) for name, category_id in missing])
+            products.update(self._fetch_products(missing))
+
+        return products
+
+    @staticmethod
+    def _fetch_products(keys):
+        names = {name for name, _ in keys}
+        category_ids = {category_id for _, category_id in keys}
+        products = {}
+        queryset = Product.objects.filter(name__in=names, category_id__in=category_ids).order_by('id')
+        for product_id, name, category_id in queryset.values_list('id', 'name', 'category_id'):
+            if (name, category_id) in keys:
+                products.setdefault((name, category_id), product_id)
+        return products
+
+    def resolve_parameters(self, goods):
+        """Возвращает словарь имя параметра -> id, создавая недостающие имена"""
+        return self.resolve_parameter_names({name for item in goods for name in item['parameters']})
+
+    def resolve_parameter_names(self, names):
+        names = set(names) - self.parameters.keys()
+        if names:
+            self._load_parameters(names)
+            missing = names - self.parameters.keys()
+            if missing:
+                Parameter.objects.bulk_create([Parameter(name=name) for name in missing])
+                self._load_parameters(missing)
+        return self.parameters
+
+    def _load_parameters(self, names):
+        queryset = Parameter.objects.filter(name__in=names).order_by('id')
+        for parameter_id, name in queryset.values_list('id', 'name'):
+            self.parameters.setdefault(name, parameter_id)
+
+
+def stage_price_chunks(goods, prefix, chunk_size):
+    """
+    Раскладывает товары прайса по файлам JSON Lines в default_storage
+    для параллельной обработки. Имена частей постоянны: повтор раскладки
+    перезаписывает файлы прошлой попытки, а не создает новые рядом.
+
+    Аргументы:
+        goods: итерируемый объект с товарами
+        prefix (str): каталог в хранилище для файлов частей
+        chunk_size (int): число товаров в одной части
+
+    Возвращает:
+        dict: paths - пути к частям, external_ids - внешние ИД всех товаров,
+        parameters - имена всех параметров
+    """
+    manifest = {'paths': [], 'external_ids': set(), 'parameters': set()}
+    for index, chunk in enumerate(batched(goods, chunk_size)):
+        with SpooledTemporaryFile(max_size=settings.PRICE_FEED_SPOOL_SIZE) as f:
+            for item in chunk:
+                manifest['external_ids'].add(item['id'])
+                manifest['parameters'].update(item['parameters'])
+                f.write(dumps(item, ensure_ascii=False).encode())
+                f.write(b'\n')
+            f.seek(0)
+            path = f'{prefix}/chunk-{index:05d}.jsonl'
+            if default_storage.exists(path):
+                default_storage.delete(path)
+            path = default_storage.save(path, File(f))
+        manifest['paths'].append(path)
+    return manifest
+
+
+def read_price_chunk(path):
+    """Читает товары из части, подготовленной stage_price_chunks"""
+    with default_storage.open(path, 'rb') as f:
+        for line in f:
+            yield loads(line)
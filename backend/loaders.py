@@ -0,0 +1,292 @@
+"""
+Запись пачки товаров прайса в каталог.
+
+OrmLoader сравнивает пачку с каталогом в Python и пишет отличия через
+bulk_create/bulk_update. CopyLoader (только PostgreSQL) передает пачку во
+временные таблицы командой COPY FROM STDIN и сливает ее с каталогом
+несколькими запросами над множествами строк, не создавая объекты моделей.
+Загрузчик выбирается настройкой PRICE_IMPORT_LOADER; на других СУБД
+всегда используется OrmLoader.
+
+Строка пачки - кортеж (внешний ИД, поля ProductInfo, параметры), где поля -
+словарь product_id/model/price/price_rrc/quantity, а параметры - словарь
+id параметра -> строковое значение. Загрузчик пишет в одну версию каталога
+магазина копированием при записи (см. backend.catalog): изменившееся
+предложение из прежней версии сначала копируется в новую, неизмененные
+не затрагиваются. Вместе с параметрами пересобирается их копия
+ProductInfo.attributes у предложений, параметры которых изменились.
+write возвращает id созданных и id изменившихся предложений.
+"""
+import csv
+from io import StringIO
+
+from cachalot.api import invalidate
+from django.conf import settings
+from django.db import connection
+
+from backend.catalog import clone_offers
+from backend.models import Parameter, ProductInfo, ProductParameter, delete_product_params, parse_number, \
+    refresh_attributes
+
+OFFER_FIELDS = ('product_id', 'model', 'price', 'price_rrc', 'quantity')
+
+
+def get_loader(shop, version, batch_size):
+    """Загрузчик по настройке PRICE_IMPORT_LOADER с учетом СУБД"""
+    if getattr(settings, 'PRICE_IMPORT_LOADER', 'orm') == 'copy' and connection.vendor == 'postgresql':
+        return CopyLoader(shop, version)
+    return OrmLoader(shop, version, batch_size)
+
+
+class OrmLoader:
+    """Запись пачки через ORM с предварительной загрузкой текущих строк"""
+
+    def __init__(self, shop, version, batch_size):
+        self.shop = shop
+        self.version = version
+        self.batch_size = batch_size
+
+    def write(self, rows):
+        existing = self.load_existing([external_id for external_id, _, _ in rows])
+
+        created, updated, changed_params, stale = [], [], [], []
+        for external_id, fields, params in rows:
+            product_info = existing.get(external_id)
+
+            if product_info is None:
+                product_info = ProductInfo(shop_id=self.shop.id, external_id=external_id, version=self.version, **fields)
+                created.append((product_info, params))
+                continue
+
+            is_changed = not product_info.is_active or any(
+                getattr(product_info, name) != value for name, value in fields.items())
+            if is_changed or product_info.params != params:
+                stale.append(product_info)
+            if is_changed:
+                for name, value in fields.items():
+                    setattr(product_info, name, value)
+                product_info.is_active = True
+                updated.append(product_info)
+            if product_info.params != params:
+                changed_params.append((product_info, params))
+
+        # предложения прежних версий меняются в своей копии в этой версии
+        clones = clone_offers([product_info.id for product_info in stale if product_info.version != self.version],
+                              self.version)
+        for product_info in stale:
+            if product_info.id in clones:
+                product_info.id = clones[product_info.id]
+                product_info.version = self.version
+
+        ProductInfo.objects.bulk_create([product_info for product_info, _ in created])
+        ProductInfo.objects.bulk_update(
+            updated,
+            ['product', 'model', 'price', 'price_rrc', 'quantity', 'is_active'],
+            batch_size=self.batch_size
+        )
+
+        # параметры изменившихся товаров пересоздаются целиком
+        delete_product_params([product_info.id for product_info, _ in changed_params])
+        ProductParameter.objects.bulk_create([
+            ProductParameter(product_info_id=product_info.id, parameter_id=parameter_id, value=value,
+                             value_number=parse_number(value))
+            for product_info, params in created + changed_params
+            for parameter_id, value in params.items()
+        ], batch_size=self.batch_size)
+        refresh_attributes([product_info.id for product_info, _ in created + changed_params], self.batch_size)
+
+        changed = {product_info.id for product_info in updated} | {product_info.id for product_info, _ in changed_params}
+        return {product_info.id for product_info, _ in created}, changed
+
+    def load_existing(self, external_ids):
+        """
+        Возвращает словарь внешний ИД -> ProductInfo магазина
+        с параметрами в атрибуте params (id параметра -> значение).
+        """
+        existing = {}
+        queryset = ProductInfo.objects.visible(self.version).filter(
+            shop_id=self.shop.id, external_id__in=external_ids).only(
+            'id', 'external_id', 'product_id', 'model', 'price', 'price_rrc', 'quantity', 'is_active',
+            'version').order_by('id')
+        for product_info in queryset:
+            product_info.params = {}
+            existing.setdefault(product_info.external_id, product_info)
+
+        by_id = {product_info.id: product_info for product_info in existing.values()}
+        params = ProductParameter.objects.filter(product_info_id__in=by_id).values_list(
+            'product_info_id', 'parameter_id', 'value')
+        for product_info_id, parameter_id, value in params:
+            by_id[product_info_id].params[parameter_id] = value
+
+        return existing
+
+
+class CopyLoader:
+    """
+    Запись пачки через COPY во временные таблицы и слияние SQL-запросами.
+
+    Временные таблицы создаются один раз на соединение и очищаются перед
+    каждой пачкой. Как и в OrmLoader, при нескольких предложениях магазина
+    с одним внешним ИД обновляется предложение с наименьшим id.
+    """
+
+    def __init__(self, shop, version):
+        self.shop = shop
+        self.version = version
+        self.offers = ProductInfo._meta.db_table
+        self.params = ProductParameter._meta.db_table
+
+    def write(self, rows):
+        with connection.cursor() as cursor:
+            self.prepare(cursor)
+            self.copy(cursor, 'price_import_offers', (
+                (external_id, *(fields[name] for name in OFFER_FIELDS)) for external_id, fields, _ in rows))
+            self.copy(cursor, 'price_import_params', (
+                (external_id, parameter_id, value, parse_number(value))
+                for external_id, _, params in rows for parameter_id, value in params.items()),
+                force_null=['value_number'])
+
+            created = self.insert_offers(cursor)
+            self.fill_map(cursor)
+            # изменившиеся предложения прежних версий копируются в эту версию
+            if clone_offers(self.find_stale(cursor), self.version):
+                cursor.execute('TRUNCATE price_import_map')
+                self.fill_map(cursor)
+            changed_params = self.merge_params(cursor)
+            self.update_attributes(cursor, created | changed_params)
+            changed = self.update_offers(cursor) | changed_params
+
+        invalidate(ProductInfo, ProductParameter)
+        return created, changed - created
+
+    @staticmethod
+    def prepare(cursor):
+        # ключи моделей - BigAutoField (DEFAULT_AUTO_FIELD), поэтому столбцы с id - bigint
+        cursor.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS price_import_offers (
+                external_id integer PRIMARY KEY, product_id bigint, model varchar(80),
+                price integer, price_rrc integer, quantity integer
+            );
+            CREATE TEMP TABLE IF NOT EXISTS price_import_params (
+                external_id integer, parameter_id bigint, value varchar(50), value_number double precision
+            );
+            CREATE TEMP TABLE IF NOT EXISTS price_import_map (external_id integer PRIMARY KEY, id bigint);
+            TRUNCATE price_import_offers, price_import_params, price_import_map;
+        ''')
+
+    @staticmethod
+    def copy(cursor, table, rows, force_null=()):
+        """
+        Передает строки в таблицу одной командой COPY в формате CSV.
+        None в столбцах force_null записывается как NULL.
+        """
+        buffer = StringIO()
+        # строки в кавычках: пустая строка не превращается в NULL
+        csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n').writerows(rows)
+        buffer.seek(0)
+        options = f', FORCE_NULL ({", ".join(force_null)})' if force_null else ''
+        cursor.copy_expert(f'COPY {table} FROM STDIN WITH (FORMAT csv{options})', buffer)
+
+    def fill_map(self, cursor):
+        """Сопоставляет внешние ИД пачки с предложениями, действующими в версии"""
+        cursor.execute(f'''
+            INSERT INTO price_import_map (external_id, id)
+            SELECT DISTINCT ON (p.external_id) p.external_id, p.id
+            FROM {self.offers} p JOIN price_import_offers s ON s.external_id = p.external_id
+            WHERE p.shop_id = %s AND p.version <= %s AND (p.retired_version IS NULL OR p.retired_version > %s)
+            ORDER BY p.external_id, p.id
+        ''', [self.shop.id, self.version, self.version])
+
+    def find_stale(self, cursor):
+        """id предложений прежних версий, которые отличаются от пачки"""
+        cursor.execute(f'''
+            SELECT p.id
+            FROM {self.offers} p
+            JOIN price_import_map m ON m.id = p.id
+            JOIN price_import_offers s ON s.external_id = m.external_id
+            WHERE p.version < %s AND (
+                (p.product_id, p.model, p.price, p.price_rrc, p.quantity, p.is_active)
+                    IS DISTINCT FROM (s.product_id, s.model, s.price, s.price_rrc, s.quantity, true)
+                OR EXISTS (
+                    SELECT 1 FROM {self.params} pp WHERE pp.product_info_id = p.id AND NOT EXISTS (
+                        SELECT 1 FROM price_import_params sp
+                        WHERE sp.external_id = m.external_id AND sp.parameter_id = pp.parameter_id
+                            AND sp.value = pp.value
+                    )
+                )
+                OR EXISTS (
+                    SELECT 1 FROM price_import_params sp WHERE sp.external_id = m.external_id AND NOT EXISTS (
+                        SELECT 1 FROM {self.params} pp
+                        WHERE pp.product_info_id = p.id AND pp.parameter_id = sp.parameter_id
+                    )
+                )
+            )
+        ''', [self.version])
+        return [row[0] for row in cursor.fetchall()]
+
+    def insert_offers(self, cursor):
+        cursor.execute(f'''
+            INSERT INTO {self.offers} (
+                shop_id, version, external_id, product_id, model, price, price_rrc, quantity, is_active, attributes
+            )
+            SELECT %s, %s, s.external_id, s.product_id, s.model, s.price, s.price_rrc, s.quantity, true, '[]'::jsonb
+            FROM price_import_offers s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {self.offers} p
+                WHERE p.shop_id = %s AND p.external_id = s.external_id
+                    AND p.version <= %s AND (p.retired_version IS NULL OR p.retired_version > %s)
+            )
+            RETURNING id
+        ''', [self.shop.id, self.version, self.shop.id, self.version, self.version])
+        return {row[0] for row in cursor.fetchall()}
+
+    def update_offers(self, cursor):
+        cursor.execute(f'''
+            UPDATE {self.offers} p
+            SET product_id = s.product_id, model = s.model, price = s.price, price_rrc = s.price_rrc,
+                quantity = s.quantity, is_active = true
+            FROM price_import_offers s JOIN price_import_map m ON m.external_id = s.external_id
+            WHERE p.id = m.id
+              AND (p.product_id, p.model, p.price, p.price_rrc, p.quantity, p.is_active)
+                  IS DISTINCT FROM (s.product_id, s.model, s.price, s.price_rrc, s.quantity, true)
+            RETURNING p.id
+        ''')
+        return {row[0] for row in cursor.fetchall()}
+
+    def merge_params(self, cursor):
+        """Удаляет отличающиеся параметры и добавляет недостающие, возвращает id затронутых предложений"""
+        cursor.execute(f'''
+            DELETE FROM {self.params} pp
+            USING price_import_map m
+            WHERE pp.product_info_id = m.id AND NOT EXISTS (
+                SELECT 1 FROM price_import_params sp
+                WHERE sp.external_id = m.external_id AND sp.parameter_id = pp.parameter_id AND sp.value = pp.value
+            )
+            RETURNING pp.product_info_id
+        ''')
+        changed = {row[0] for row in cursor.fetchall()}
+
+        cursor.execute(f'''
+            INSERT INTO {self.params} (product_info_id, parameter_id, value, value_number)
+            SELECT m.id, sp.parameter_id, sp.value, sp.value_number
+            FROM price_import_params sp JOIN price_import_map m ON m.external_id = sp.external_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {self.params} pp WHERE pp.product_info_id = m.id AND pp.parameter_id = sp.parameter_id
+            )
+            RETURNING product_info_id
+        ''')
+        return changed | {row[0] for row in cursor.fetchall()}
+
+    def update_attributes(self, cursor, product_info_ids):
+        """Пересобирает attributes предложений одним UPDATE из их параметров"""
+        if not product_info_ids:
+            return
+        parameters = Parameter._meta.db_table
+        cursor.execute(f'''
+            UPDATE {self.offers} p SET attributes = COALESCE((
+                SELECT jsonb_agg(jsonb_build_object('parameter', n.name, 'value', pp.value) ORDER BY pp.id)
+                FROM {self.params} pp JOIN {parameters} n ON n.id = pp.parameter_id
+                WHERE pp.product_info_id = p.id
+            ), '[]'::jsonb)
+            WHERE p.id = ANY(%s)
+        ''', [list(product_info_ids)])
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import subprocess
+import time
+from io import TextIOWrapper
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from backend.archive import archive_price_feed
+from backend.catalog import create_catalog_version
+from backend.feedgen import FEED_FORMATS, category_ids, generate_price_feed, write_price_feed
+from backend.fetcher import FetchedFeed
+from backend.models import Category, ImportRun, ProductInfo, Shop, delete_product_params
+from backend.tasks import run_price_import
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+
+class Command(BaseCommand):
+    help = ('Замеряет полный и дельта-импорт синтетических прайсов разного размера '
+            'в настроенную базу данных и сохраняет результаты в JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Числа товаров в прайсах')
+        parser.add_argument('--categories', type=int, default=20, help='Число категорий')
+        parser.add_argument('--parameters', type=int, default=5, help='Параметров у товара')
+        parser.add_argument('--changed', type=float, default=0.1,
+                            help='Доля товаров, изменившихся для дельта-импорта')
+        parser.add_argument('--format', choices=FEED_FORMATS, default='yaml', help='Формат прайса')
+        parser.add_argument('--seed', type=int, default=0, help='Зерно выбора изменившихся товаров')
+        parser.add_argument('--output', help='Файл для результатов в JSON, по умолчанию вывод в консоль')
+        parser.add_argument('--keep', action='store_true', help='Не удалять тестовые магазины и прайсы')
+
+    def handle(self, *args, **options):
+        report = {
+            'commit': get_commit(),
+            'created': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'loader': settings.PRICE_IMPORT_LOADER,
+            'parse_process': settings.PRICE_IMPORT_PARSE_PROCESS,
+            'batch_size': settings.PRICE_IMPORT_BATCH_SIZE,
+            'format': options['format'],
+            'categories': options['categories'],
+            'parameters': options['parameters'],
+            'changed': options['changed'],
+            'results': [],
+        }
+
+        for size in options['sizes']:
+            shop = Shop.objects.create(name=f'Benchmark {size}')
+            result = {'skus': size}
+            try:
+                for name, revision in (('full', 0), ('delta', 1)):
+                    result[name] = self.import_feed(shop, size, revision, options)
+                    self.stdout.write(
+                        f"{size} {name}: {result[name]['seconds']} с, {result[name]['rows_per_second']} строк/с, "
+                        f"{result[name]['queries']} запросов"
+                    )
+            finally:
+                if not options['keep']:
+                    self.cleanup(shop, options['categories'])
+            report['results'].append(result)
+
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Результаты сохранены в {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+    def import_feed(self, shop, size, revision, options):
+        """Генерирует ревизию прайса и импортирует ее, возвращает замеры"""
+        started = time.perf_counter()
+        data = generate_price_feed(size, options['categories'], options['parameters'], options['changed'],
+                                   revision=revision, seed=options['seed'], shop=shop.name)
+        with SpooledTemporaryFile(max_size=settings.PRICE_FEED_SPOOL_SIZE) as f:
+            text = TextIOWrapper(f, encoding='utf-8', newline='')
+            write_price_feed(text, data, options['format'])
+            text.flush()
+            digest = hashlib.sha256()
+            f.seek(0)
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+            feed = FetchedFeed(file=f, sha256=digest.hexdigest(), size=f.tell())
+            path = archive_price_feed(feed)
+            text.detach()
+        generate_seconds = time.perf_counter() - started
+
+        run = ImportRun.objects.create(
+            shop=shop, feed_hash=feed.sha256, feed_path=path, feed_size=default_storage.size(path),
+            version=create_catalog_version(shop),
+        )
+        started = time.perf_counter()
+        # весь прайс импортируется в этом процессе, без раздачи частей воркерам
+        with override_settings(PRICE_IMPORT_CHUNK_SIZE=size + 1):
+            result = run_price_import(run)
+        seconds = time.perf_counter() - started
+
+        return {
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(size / seconds, 1) if seconds else 0.0,
+            'generate_seconds': round(generate_seconds, 3),
+            'feed_bytes': feed.size,
+            'archive_bytes': run.feed_size,
+            'queries': result['metrics']['queries'],
+            'peak_rss_kb': result['metrics']['peak_rss_kb'],
+            'stats': result['stats'],
+            'phases': result['metrics']['phases'],
+            'pipeline': result['pipeline'],
+        }
+
+    @staticmethod
+    def cleanup(shop, categories):
+        paths = set(shop.import_runs.values_list('feed_path', flat=True))
+        delete_product_params(ProductInfo.objects.filter(shop=shop))
+        shop.delete()
+        # продукты синтетических категорий удаляются вместе с ними
+        Category.objects.filter(id__in=category_ids(categories), shops__isnull=True).delete()
+        for path in paths - {''}:
+            if not ImportRun.objects.filter(feed_path=path).exists():
+                default_storage.delete(path)
+
+
+def get_commit():
+    """Текущий коммит git или None вне репозитория"""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=settings.BASE_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from backend.models import ProductParameter, parse_number
+
+
+class Command(BaseCommand):
+    help = ('Заполняет числовые значения параметров (ProductParameter.value_number) у строк, '
+            'записанных до их появления; импорт прайса заполняет их сам')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Строк в одном UPDATE')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        parameters = ProductParameter.objects.filter(value_number__isnull=True).order_by('id')
+        filled = 0
+        after = 0
+        while batch := list(parameters.filter(id__gt=after).only('id', 'value')[:batch_size]):
+            after = batch[-1].id
+            numeric = []
+            for parameter in batch:
+                parameter.value_number = parse_number(parameter.value)
+                if parameter.value_number is not None:
+                    numeric.append(parameter)
+            ProductParameter.objects.bulk_update(numeric, ['value_number'])
+            filled += len(numeric)
+        self.stdout.write(self.style.SUCCESS(f'Заполнено числовых значений: {filled}'))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from backend.models import ProductInfo, refresh_attributes
+from backend.storefront import refresh_storefront
+
+
+class Command(BaseCommand):
+    help = ('Заполняет параметры предложений одним документом (ProductInfo.attributes) из строк ProductParameter '
+            'у предложений, записанных до его появления; импорт прайса заполняет их сам')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Предложений в одном UPDATE')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        offers = ProductInfo.objects.filter(product_params__isnull=False).distinct().order_by('id')
+        filled = 0
+        after = 0
+        while batch := list(offers.filter(id__gt=after).values_list('id', flat=True)[:batch_size]):
+            after = batch[-1]
+            refresh_attributes(batch)
+            refresh_storefront(batch)
+            filled += len(batch)
+        self.stdout.write(self.style.SUCCESS(f'Заполнено предложений: {filled}'))
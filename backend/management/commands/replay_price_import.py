@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.models import ImportRun
+from backend.tasks import replay_price_import
+
+
+class Command(BaseCommand):
+    help = 'Повторяет импорт прайса из архива запуска ImportRun без обращения к поставщику'
+
+    def add_arguments(self, parser):
+        parser.add_argument('run_id', type=int, help='ID запуска импорта с архивом прайса')
+        parser.add_argument('--async', action='store_true', dest='is_async',
+                            help='Передать импорт воркеру Celery вместо выполнения в команде')
+
+    def handle(self, *args, **options):
+        run_id = options['run_id']
+        if not ImportRun.objects.filter(id=run_id).exists():
+            raise CommandError(f'Запуск импорта {run_id} не найден')
+
+        if options['is_async']:
+            task = replay_price_import.delay(run_id)
+            self.stdout.write(self.style.SUCCESS(f'Импорт передан воркеру, задача {task.id}'))
+            return
+
+        result = replay_price_import.apply(args=(run_id,)).get()
+        if result['status'] in ('success', 'started'):
+            self.stdout.write(self.style.SUCCESS(f'Импорт выполнен: {result}'))
+        else:
+            raise CommandError(result['message'])
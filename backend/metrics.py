@@ -0,0 +1,192 @@
+"""
+Показатели импорта прайса.
+
+ImportMetrics считает время и число SQL-запросов по этапам импорта
+(загрузка, разбор, категории, проверка, запись и т.д.), скорость обработки
+строк и пиковое потребление памяти. Показатели сохраняются в
+ImportRun.metrics и показываются в TaskStatus и в карточке магазина в админке.
+
+Разбор прайса идет одновременно с записью (backend.pipeline), а части
+параллельного импорта - на разных воркерах, поэтому сумма времени этапов
+может быть больше общего времени импорта.
+
+Этапы могут быть вложены (например, проверка внутри подготовки части):
+время и запросы вложенного этапа учитываются только в нем и вычитаются
+из объемлющего, поэтому сумма этапов не считает их дважды.
+
+Пиковая память относится к одному импорту: в начале импорта пик RSS
+процесса сбрасывается (запись 5 в /proc/self/clear_refs), а затем
+читается VmHWM из /proc/self/status, так что учитываются и всплески
+внутри этапа. ru_maxrss не подходит: в долго живущем воркере это
+максимум за всю жизнь процесса, включая прошлые импорты. Если сбросить
+пик нельзя, замеряется текущий RSS (VmRSS) на границах этапов. Процесс
+разбора прайса создается заново для каждого импорта, поэтому его пик
+берется из ru_maxrss (см. backend.pipeline).
+При PRICE_IMPORT_TRACEMALLOC дополнительно считается пик памяти Python
+за время импорта через tracemalloc, что заметно замедляет импорт.
+"""
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+
+class QueryCounter:
+    """Обертка выполнения запросов (connection.execute_wrapper), считающая их число"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def get_rss_kb(field='VmRSS'):
+    """RSS процесса из /proc/self/status (VmRSS - текущий, VmHWM - пик), КБ, или None, если /proc недоступен"""
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Сбрасывает пик RSS процесса (VmHWM) до текущего RSS, возвращает False, если это недоступно"""
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return get_rss_kb('VmHWM') is not None
+
+
+class ImportMetrics:
+    """
+    Показатели одного импорта.
+
+    Аргументы:
+        data (dict): сохраненные показатели (ImportRun.metrics),
+            к которым добавляются новые, например при продолжении импорта
+    """
+
+    def __init__(self, data=None):
+        data = data or {}
+        self.phases = {}
+        # время и запросы вложенных этапов по открытым этапам
+        self.nested = []
+        self.tracemalloc_peak = None
+        self.track_hwm = reset_peak_rss()
+        self.rss_start = get_rss_kb()
+        self.rss_peak = self.rss_start
+        self.rss_growth = None
+        self.merge(data)
+        self.tracing = False
+        if getattr(settings, 'PRICE_IMPORT_TRACEMALLOC', False):
+            self.tracing = not tracemalloc.is_tracing()
+            if self.tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Учитывает время и запросы блока в этапе name. Внутри with доступен
+        словарь этапа: в его ключ rows можно прибавить число обработанных строк.
+        """
+        phase = self.phases.setdefault(name, {'seconds': 0.0, 'queries': 0, 'rows': 0})
+        counter = QueryCounter()
+        nested = {'seconds': 0.0, 'queries': 0}
+        self.nested.append(nested)
+        started = time.monotonic()
+        self.sample_rss()
+        try:
+            with connection.execute_wrapper(counter):
+                yield phase
+        finally:
+            self.nested.pop()
+            seconds = time.monotonic() - started
+            phase['seconds'] += seconds - nested['seconds']
+            phase['queries'] += counter.count - nested['queries']
+            if self.nested:
+                self.nested[-1]['seconds'] += seconds
+                self.nested[-1]['queries'] += counter.count
+            self.sample_rss()
+
+    def sample_rss(self):
+        """Учитывает в пике импорта пик RSS с начала импорта или, если он недоступен, текущий RSS"""
+        rss = get_rss_kb('VmHWM' if self.track_hwm else 'VmRSS')
+        if rss is not None:
+            self.rss_peak = max(self.rss_peak or 0, rss)
+
+    def add_phase(self, name, seconds, rows=0, queries=0):
+        """Добавляет этап, измеренный вне ImportMetrics, например этап конвейера"""
+        phase = self.phases.setdefault(name, {'seconds': 0.0, 'queries': 0, 'rows': 0})
+        phase['seconds'] += seconds
+        phase['rows'] += rows
+        phase['queries'] += queries
+
+    def merge(self, data):
+        """Добавляет показатели другого импорта, например части параллельного импорта"""
+        for name, phase in data.get('phases', {}).items():
+            self.add_phase(name, phase['seconds'], phase.get('rows', 0), phase.get('queries', 0))
+        if data.get('tracemalloc_peak_kb'):
+            self.tracemalloc_peak = max(self.tracemalloc_peak or 0, data['tracemalloc_peak_kb'])
+        # пик и рост - наибольшие по всем процессам и попыткам импорта
+        if data.get('peak_rss_kb'):
+            self.rss_peak = max(self.rss_peak or 0, data['peak_rss_kb'])
+        if data.get('rss_growth_kb') is not None:
+            self.rss_growth = max(self.rss_growth or 0, data['rss_growth_kb'])
+
+    def update_peak(self):
+        """Запоминает текущий пик tracemalloc, если трассировка включена"""
+        if tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1] // 1024
+            self.tracemalloc_peak = max(self.tracemalloc_peak or 0, peak)
+
+    def stop(self):
+        """Запоминает пик tracemalloc и останавливает трассировку, если ее запустил этот импорт"""
+        self.update_peak()
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def as_dict(self, rows=None, seconds=None):
+        """
+        Показатели в виде словаря для ImportRun.metrics.
+
+        Аргументы:
+            rows (int): строк прайса, по умолчанию строк этапа write
+            seconds (float): общее время импорта, по умолчанию сумма этапов
+        """
+        self.update_peak()
+        self.sample_rss()
+        if self.rss_start is not None and self.rss_peak is not None:
+            self.rss_growth = max(self.rss_growth or 0, self.rss_peak - self.rss_start)
+        phases = {}
+        for name, phase in self.phases.items():
+            phases[name] = {
+                'seconds': round(phase['seconds'], 3),
+                'queries': phase['queries'],
+                'rows': phase['rows'],
+                'rows_per_second': round(phase['rows'] / phase['seconds'], 1) if phase['seconds'] else 0.0,
+            }
+        if rows is None:
+            rows = self.phases.get('write', {}).get('rows', 0)
+        if seconds is None:
+            seconds = sum(phase['seconds'] for phase in self.phases.values())
+        return {
+            'phases': phases,
+            'seconds': round(seconds, 3),
+            'rows': rows,
+            'rows_per_second': round(rows / seconds, 1) if seconds else 0.0,
+            'queries': sum(phase['queries'] for phase in self.phases.values()),
+            'peak_rss_kb': self.rss_peak,
+            'rss_growth_kb': self.rss_growth,
+            'tracemalloc_peak_kb': self.tracemalloc_peak,
+        }
@@ -1,13 +1,16 @@
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
 from django.db.models import Sum
 from django.utils.html import format_html
-from django.db import models
+from django.db import connection, models
 from django.utils.translation import gettext_lazy as _
 from django_rest_passwordreset.tokens import get_token_generator
 from django.core.exceptions import ValidationError
 import os
+import re
 import time
 from imagekit.models import ImageSpecField
 from imagekit.processors import ResizeToFill
@@ -59,6 +62,13 @@ USER_TYPE_CHOICES = (
 
 )
 
+IMPORT_STATUS_CHOICES = (
+    ('running', 'Выполняется'),
+    ('success', 'Завершен'),
+    ('skipped', 'Пропущен'),
+    ('failed', 'Ошибка'),
+)
+
 class UserManager(BaseUserManager):
     use_in_migrations = True
 
@@ -148,6 +158,15 @@ class Shop(models.Model):
                                 blank=True, null=True,
                                 on_delete=models.CASCADE)
     state = models.BooleanField(verbose_name='статус получения заказов', default=True)
+    feed_hash = models.CharField(verbose_name='SHA-256 последнего прайса', max_length=64, blank=True)
+    feed_etag = models.CharField(verbose_name='ETag последнего прайса', max_length=255, blank=True)
+    feed_last_modified = models.CharField(verbose_name='Last-Modified последнего прайса', max_length=64, blank=True)
+    refresh_interval = models.PositiveIntegerField(verbose_name='Интервал обновления прайса, мин', null=True,
+                                                   blank=True)
+    next_refresh_at = models.DateTimeField(verbose_name='Следующее обновление прайса', null=True, blank=True,
+                                           db_index=True)
+    catalog_version = models.PositiveIntegerField(verbose_name='Опубликованная версия каталога', default=1)
+    previous_version = models.PositiveIntegerField(verbose_name='Предыдущая версия каталога', null=True, blank=True)
 
     class Meta:
         verbose_name = 'Магазин'
@@ -189,8 +208,35 @@ class Product(models.Model):
         return f"{self.name}"
 
 
+def postgresql_indexes(*indexes):
+    """Индексы, которые создаются только в PostgreSQL (GIN и т.п.), в других базах - пустой список"""
+    if connection.vendor != 'postgresql':
+        return []
+    return list(indexes)
+
+
+class ProductInfoQuerySet(models.QuerySet):
+    """
+    Версии каталога строятся копированием при записи: строка предложения
+    действует с версии version до версии retired_version (не включая ее),
+    поэтому неизмененные предложения общие для всех версий магазина.
+    """
+
+    def visible(self, version):
+        """Предложения, действующие в версии каталога version"""
+        return self.filter(
+            models.Q(retired_version__isnull=True) | models.Q(retired_version__gt=version), version__lte=version)
+
+    def published(self):
+        """Предложения опубликованных версий каталогов магазинов"""
+        catalog_version = models.F('shop__catalog_version')
+        return self.filter(
+            models.Q(retired_version__isnull=True) | models.Q(retired_version__gt=catalog_version),
+            version__lte=catalog_version)
+
+
 class ProductInfo(models.Model):
-    objects = models.manager.Manager()
+    objects = ProductInfoQuerySet.as_manager()
     model = models.CharField(max_length=80, verbose_name='Модель', blank=True)
     external_id = models.PositiveIntegerField(verbose_name='Внешний ИД')
     product = models.ForeignKey(Product, verbose_name='Продукт', related_name='product_info', blank=True,
@@ -200,6 +246,13 @@ class ProductInfo(models.Model):
     quantity = models.PositiveIntegerField(verbose_name="Количество")
     price = models.PositiveIntegerField(verbose_name='Цена')
     price_rrc = models.PositiveIntegerField(verbose_name="Рекомендуемая розничная цена")
+    is_active = models.BooleanField(verbose_name='В продаже', default=True)
+    # копия параметров из ProductParameter одним документом [{"parameter": имя, "value": значение}, ...]
+    # для чтения карточки без соединений; пересобирается refresh_attributes, правятся параметры в ProductParameter
+    attributes = models.JSONField(verbose_name='Параметры', default=list, blank=True)
+    version = models.PositiveIntegerField(verbose_name='Версия каталога', default=1, db_index=True)
+    retired_version = models.PositiveIntegerField(verbose_name='Заменено в версии каталога', null=True, blank=True,
+                                                  db_index=True)
     image = models.ImageField(
         upload_to=product_image_upload_to,
         verbose_name='Изображение товара',
@@ -230,12 +283,20 @@ class ProductInfo(models.Model):
         verbose_name = 'Информация о продукте'
         verbose_name_plural = "Список информации о продуктах"
         constraints = [
-            models.UniqueConstraint(fields=['product', 'shop', 'external_id'], name='unique_product_info'),
+            models.UniqueConstraint(fields=['product', 'shop', 'external_id', 'version'], name='unique_product_info'),
+        ]
+        indexes = [
+            # запросы по вхождению: attributes @> '[{"parameter": "Цвет", "value": "черный"}]'
+            *postgresql_indexes(GinIndex(fields=['attributes'], name='product_info_attributes')),
         ]
 
     def __str__(self):
         return f'{self.product.name} - {self.shop.name} - {self.price}'
 
+    def in_version(self, version):
+        """Действует ли предложение в версии каталога version"""
+        return self.version <= version and (self.retired_version is None or self.retired_version > version)
+
 
 class Parameter(models.Model):
     objects = models.manager.Manager()
@@ -250,6 +311,18 @@ class Parameter(models.Model):
         return f"{self.name}"
 
 
+# число в значении параметра: 11, -2, 10.9 или 10,9
+NUMBER_RE = re.compile(r'[+-]?(\d+([.,]\d*)?|[.,]\d+)')
+
+
+def parse_number(value):
+    """Числовое значение параметра или None, если значение не число (например, "черный" или "64 Гб")"""
+    text = str(value).strip()
+    if not NUMBER_RE.fullmatch(text):
+        return None
+    return float(text.replace(',', '.'))
+
+
 class ProductParameter(models.Model):
     objects = models.manager.Manager()
     product_info = models.ForeignKey(ProductInfo, verbose_name='Информация о продукте', related_name='product_params',
@@ -257,6 +330,8 @@ class ProductParameter(models.Model):
     parameter = models.ForeignKey(Parameter, verbose_name='Имя параметра', related_name='product_params',
                                   on_delete=models.CASCADE)
     value = models.CharField(max_length=50, verbose_name='Значение')
+    # value, если это число (см. parse_number): для фильтров по диапазону и сортировки по параметру
+    value_number = models.FloatField(verbose_name='Числовое значение', null=True, blank=True)
 
     class Meta:
         verbose_name = 'Параметр'
@@ -264,6 +339,142 @@ class ProductParameter(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['product_info', 'parameter'], name='unique_product_param'),
         ]
+        indexes = [
+            # диапазон значений параметра и сортировка по нему - просмотром индекса
+            models.Index(fields=['parameter', 'value_number', 'product_info'], name='product_param_number'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.value_number = parse_number(self.value)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'value' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'value_number'}
+        super().save(*args, **kwargs)
+
+
+def refresh_attributes(product_info_ids, batch_size=None):
+    """
+    Пересобирает ProductInfo.attributes предложений из строк ProductParameter.
+
+    Аргументы:
+        product_info_ids: id предложений
+        batch_size (int): размер пачки bulk_update
+    """
+    attributes = {product_info_id: [] for product_info_id in product_info_ids}
+    if not attributes:
+        return
+    for product_info_id, name, value in ProductParameter.objects.filter(product_info_id__in=attributes).order_by(
+            'id').values_list('product_info_id', 'parameter__name', 'value'):
+        attributes[product_info_id].append({'parameter': name, 'value': value})
+    ProductInfo.objects.bulk_update([
+        ProductInfo(id=product_info_id, attributes=params) for product_info_id, params in attributes.items()
+    ], ['attributes'], batch_size=batch_size)
+
+
+def delete_product_params(product_infos):
+    """
+    Удаляет параметры предложений одним DELETE без сигналов post_delete
+    (см. backend.signals): для массовых операций, которые сами пересобирают
+    attributes или удаляют и сами предложения.
+
+    Аргументы:
+        product_infos: id предложений или QuerySet ProductInfo
+    """
+    params = ProductParameter.objects.filter(product_info__in=product_infos)
+    # delete() при подписанном post_delete загружает и удаляет строки по одной
+    params._raw_delete(params.db)
+
+
+# конфигурация полнотекстового поиска PostgreSQL для витрины каталога
+SEARCH_CONFIG = 'russian'
+
+
+def catalog_search_indexes():
+    """
+    Индексы поиска по витрине: GIN по tsvector текста поиска и триграммный
+    GIN для поиска с опечатками (расширение pg_trgm). Индексы создаются
+    только в PostgreSQL, в других базах поиск идет без них.
+    """
+    return postgresql_indexes(
+        GinIndex(SearchVector('search_document', config=SEARCH_CONFIG), name='catalog_entry_search'),
+        GinIndex(fields=['search_document'], opclasses=['gin_trgm_ops'], name='catalog_entry_search_trgm'),
+    )
+
+
+class CatalogEntry(models.Model):
+    """
+    Строка витрины каталога: предложение опубликованной версии каталога
+    со всеми полями выдачи, чтобы каталог читался из одной таблицы без
+    соединений. Витрина обновляется в backend.storefront.
+    """
+    objects = models.manager.Manager()
+    product_info = models.OneToOneField(ProductInfo, verbose_name='Информация о продукте', primary_key=True,
+                                        related_name='catalog_entry', on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='catalog_entries', on_delete=models.CASCADE)
+    shop_name = models.CharField(max_length=50, verbose_name='Название магазина')
+    shop_state = models.BooleanField(verbose_name='Магазин принимает заказы', default=True)
+    product = models.ForeignKey(Product, verbose_name='Продукт', related_name='catalog_entries',
+                                on_delete=models.CASCADE)
+    product_name = models.CharField(max_length=80, verbose_name='Название продукта')
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='catalog_entries',
+                                 on_delete=models.CASCADE)
+    category_name = models.CharField(max_length=50, verbose_name='Название категории')
+    external_id = models.PositiveIntegerField(verbose_name='Внешний ИД')
+    model = models.CharField(max_length=80, verbose_name='Модель', blank=True)
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+    price = models.PositiveIntegerField(verbose_name='Цена')
+    price_rrc = models.PositiveIntegerField(verbose_name='Рекомендуемая розничная цена')
+    is_active = models.BooleanField(verbose_name='В продаже', default=True)
+    parameters = models.JSONField(verbose_name='Параметры', default=list, blank=True)
+    images = models.JSONField(verbose_name='Адреса изображения и миниатюр', default=dict, blank=True)
+    # название продукта, модель и значения параметров в нижнем регистре
+    search_document = models.TextField(verbose_name='Текст для поиска', blank=True)
+
+    class Meta:
+        verbose_name = 'Строка витрины каталога'
+        verbose_name_plural = 'Витрина каталога'
+        indexes = [
+            # фильтры каталога с порядком постраничного вывода по ключу
+            models.Index(fields=['shop', 'product_info'], name='catalog_entry_shop'),
+            models.Index(fields=['category', 'product_info'], name='catalog_entry_category'),
+            *catalog_search_indexes(),
+        ]
+
+    def __str__(self):
+        return f'{self.product_name} - {self.shop_name} - {self.price}'
+
+
+class CatalogFacet(models.Model):
+    """
+    Строка инвертированного индекса фасетов: предложения витрины магазина
+    в категории с данным значением параметра в виде битовой карты id,
+    сжатой zlib (бит n - предложение с id base + n; base общий для всех
+    строк магазина в категории). Строка с пустыми параметром и значением
+    отмечает все показанные предложения магазина в категории. Индекс
+    обновляется вместе с витриной, см. backend.facets.
+    """
+    objects = models.manager.Manager()
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='catalog_facets', on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='catalog_facets',
+                                 on_delete=models.CASCADE)
+    parameter = models.CharField(max_length=50, verbose_name='Имя параметра', blank=True)
+    value = models.CharField(max_length=50, verbose_name='Значение', blank=True)
+    base = models.PositiveBigIntegerField(verbose_name='id предложения нулевого бита')
+    bitmap = models.BinaryField(verbose_name='Битовая карта предложений')
+    count = models.PositiveIntegerField(verbose_name='Количество предложений')
+
+    class Meta:
+        verbose_name = 'Значение фасета'
+        verbose_name_plural = 'Индекс фасетов каталога'
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'category', 'parameter', 'value'], name='unique_catalog_facet'),
+        ]
+        indexes = [
+            models.Index(fields=['category', 'parameter'], name='catalog_facet_category'),
+        ]
+
+    def __str__(self):
+        return f'{self.parameter}={self.value} - {self.count}'
 
 
 class Contact(models.Model):
@@ -330,6 +541,69 @@ class OrderItem(models.Model):
         ]
 
 
+class ImportRun(models.Model):
+    """
+    Запуск импорта прайса магазина с контрольной точкой.
+
+    offset - число товаров прайса, уже записанных в базу: повтор задачи
+    продолжает импорт с этого места по сохраненному файлу прайса.
+    """
+    objects = models.manager.Manager()
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='import_runs', on_delete=models.CASCADE)
+    task_id = models.CharField(verbose_name='ID задачи', max_length=255, blank=True, db_index=True)
+    url = models.URLField(verbose_name='Ссылка', blank=True)
+    feed_hash = models.CharField(verbose_name='SHA-256 прайса', max_length=64, blank=True)
+    feed_etag = models.CharField(verbose_name='ETag прайса', max_length=255, blank=True)
+    feed_last_modified = models.CharField(verbose_name='Last-Modified прайса', max_length=64, blank=True)
+    feed_path = models.CharField(verbose_name='Архив прайса', max_length=255, blank=True)
+    feed_size = models.PositiveBigIntegerField(verbose_name='Размер архива прайса, байт', default=0)
+    feed_content_type = models.CharField(verbose_name='Content-Type прайса', max_length=100, blank=True)
+    status = models.CharField(verbose_name='Статус', choices=IMPORT_STATUS_CHOICES, max_length=15, default='running')
+    offset = models.PositiveIntegerField(verbose_name='Обработано товаров', default=0)
+    chunks = models.PositiveIntegerField(verbose_name='Частей параллельного импорта', default=0)
+    version = models.PositiveIntegerField(verbose_name='Собираемая версия каталога', null=True, blank=True)
+    stats = models.JSONField(verbose_name='Статистика', default=dict, blank=True)
+    errors = models.JSONField(verbose_name='Отложенные строки', default=list, blank=True)
+    metrics = models.JSONField(verbose_name='Показатели импорта', default=dict, blank=True)
+    error = models.TextField(verbose_name='Ошибка', blank=True)
+    created = models.DateTimeField(verbose_name='Начат', auto_now_add=True)
+    updated = models.DateTimeField(verbose_name='Обновлен', auto_now=True)
+    finished = models.DateTimeField(verbose_name='Завершен', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Импорт прайса'
+        verbose_name_plural = 'Список импортов прайсов'
+        ordering = ('-created',)
+
+    def __str__(self):
+        return f'{self.shop} - {self.created} - {self.get_status_display()}'
+
+
+class ImportBatch(models.Model):
+    """
+    Пакетный импорт прайсов нескольких магазинов.
+
+    pending - ИД магазинов, импорт которых еще не запущен,
+    tasks - ИД магазина -> ИД задачи update_partner_price.
+    """
+    objects = models.manager.Manager()
+    user = models.ForeignKey(User, verbose_name='Пользователь', related_name='import_batches', null=True, blank=True,
+                             on_delete=models.SET_NULL)
+    concurrency = models.PositiveIntegerField(verbose_name='Одновременных импортов', default=4)
+    force = models.BooleanField(verbose_name='Без проверки изменений', default=False)
+    pending = models.JSONField(verbose_name='Ожидают запуска', default=list, blank=True)
+    tasks = models.JSONField(verbose_name='Задачи импорта', default=dict, blank=True)
+    created = models.DateTimeField(verbose_name='Создан', auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Пакетный импорт прайсов'
+        verbose_name_plural = 'Список пакетных импортов прайсов'
+        ordering = ('-created',)
+
+    def __str__(self):
+        return f'Пакет {self.id} ({self.created})'
+
+
 class ConfirmEmailToken(models.Model):
     objects = models.manager.Manager()
     class Meta:
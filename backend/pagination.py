@@ -0,0 +1,157 @@
+"""
+Постраничный вывод списков по ключу (keyset).
+
+Страница выбирается условием по индексированному уникальному полю
+(id > ИД последней строки предыдущей страницы) вместо OFFSET, поэтому
+первая и десятитысячная страницы выбираются одинаково быстро, а строки,
+добавленные между запросами, не сдвигают страницы. Курсор непрозрачный:
+позиция закодирована в base64 в параметре cursor ссылок next и previous.
+При порядке по неуникальному полю (сортировка по параметру, релевантность
+поиска) ключ составной - (значение поля, первичный ключ), и следующая
+страница выбирается условием (value, pk) > (v, id), а не OFFSET внутри
+одинаковых значений.
+Общее число строк (COUNT(*)) отдается в поле count, как и раньше; с
+count=false подсчет пропускается, что экономит запрос на больших списках.
+"""
+import json
+from collections import OrderedDict
+from distutils.util import strtobool
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+from rest_framework.response import Response
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Курсорная пагинация DRF по первичному ключу с необязательным подсчетом строк.
+
+    Порядок задается атрибутом представления pagination_ordering
+    (по умолчанию id): одно уникальное индексированное поле или несколько
+    полей, последнее из которых уникально, например ('-rank', 'pk').
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    count_query_param = 'count'
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, 'pagination_ordering', self.ordering)
+        return (ordering,) if isinstance(ordering, str) else tuple(ordering)
+
+    def with_count(self, request):
+        """Нужно ли общее число строк: по умолчанию да, count=false - нет"""
+        try:
+            return strtobool(request.query_params.get(self.count_query_param, 'true'))
+        except ValueError:
+            return True
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = queryset.count() if self.with_count(request) else None
+        self.links = None
+        ordering = self.get_ordering(request, queryset, view)
+        if len(ordering) > 1:
+            return self.paginate_keyset(queryset, request, ordering)
+        return super().paginate_queryset(queryset, request, view)
+
+    def paginate_keyset(self, queryset, request, ordering):
+        """
+        Страница по составному ключу: позиция курсора - JSON-список значений
+        полей ordering у последней (или первой для previous) строки страницы.
+        """
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.base_url = request.build_absolute_uri()
+        self.ordering = ordering
+
+        cursor = self.decode_cursor(request)
+        reverse = bool(cursor and cursor.reverse)
+        position = None
+        if cursor and cursor.position is not None:
+            try:
+                position = json.loads(cursor.position)
+            except ValueError:
+                raise NotFound(self.invalid_cursor_message)
+            if not isinstance(position, list) or len(position) != len(ordering):
+                raise NotFound(self.invalid_cursor_message)
+
+        # previous выбирает строки перед позицией в обратном порядке
+        fields = [(field.lstrip('-'), field.startswith('-') != reverse) for field in ordering]
+        queryset = queryset.order_by(*(f'-{name}' if descending else name for name, descending in fields))
+        if position is not None:
+            condition, equal = Q(), Q()
+            for (name, descending), value in zip(fields, position):
+                condition |= equal & Q(**{f'{name}__{"lt" if descending else "gt"}': value})
+                equal &= Q(**{name: value})
+            queryset = queryset.filter(condition)
+
+        results = list(queryset[:self.page_size + 1])
+        has_following = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+        has_next = reverse or has_following
+        has_previous = has_following if reverse else position is not None
+
+        # пустая страница previous означает, что перед позицией строк нет: next - с начала списка
+        next_position = self.keyset_position(results[-1]) if results else None
+        self.links = (
+            self.encode_cursor(Cursor(offset=0, reverse=False, position=next_position)) if has_next else None,
+            self.encode_cursor(Cursor(offset=0, reverse=True, position=self.keyset_position(results[0])))
+            if has_previous and results else None,
+        )
+        return results
+
+    def keyset_position(self, instance):
+        """Позиция курсора составного ключа для строки"""
+        return json.dumps([
+            instance[field.lstrip('-')] if isinstance(instance, dict) else getattr(instance, field.lstrip('-'))
+            for field in self.ordering
+        ])
+
+    def get_next_link(self):
+        if self.links is not None:
+            return self.links[0]
+        return super().get_next_link()
+
+    def get_previous_link(self):
+        if self.links is not None:
+            return self.links[1]
+        return super().get_previous_link()
+
+    def paginate_selection(self, queryset, request, select_ids, total, view=None):
+        """
+        Страница строк queryset из заранее отобранных первичных ключей,
+        например битовых карт фасетов (backend.facets). Порядок - по
+        возрастанию первичного ключа.
+
+        Аргументы:
+            select_ids: функция (after, before, limit, reverse) -> список
+                отобранных ключей; в запрос попадают только ключи возле
+                курсора, а не все отобранные
+            total (int): число отобранных строк для поля count
+        """
+        cursor = self.decode_cursor(request)
+        limit = self.get_page_size(request) + 1 + (cursor.offset if cursor else 0)
+        position = int(cursor.position) if cursor and cursor.position is not None else None
+        if cursor and cursor.reverse:
+            ids = select_ids(before=position, limit=limit, reverse=True)
+        else:
+            ids = select_ids(after=position, limit=limit)
+        self.count = total if self.with_count(request) else None
+        self.links = None
+        return super().paginate_queryset(queryset.filter(pk__in=ids), request, view)
+
+    def get_paginated_response(self, data):
+        response = OrderedDict([('next', self.get_next_link()), ('previous', self.get_previous_link())])
+        if self.count is not None:
+            response['count'] = self.count
+        response['results'] = data
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema):
+        schema = super().get_paginated_response_schema(schema)
+        schema['properties']['count'] = {'type': 'integer', 'example': 123}
+        return schema
@@ -0,0 +1,257 @@
+"""
+Конвейер импорта прайса.
+
+Чтение (с распаковкой) сохраненного прайса из архива, разбор прайса и запись в базу идут
+одновременно и связаны ограниченными очередями: быстрый этап упирается в
+заполненную очередь и ждет медленный, а не копит данные в памяти. Разбор
+(особенно YAML) нагружает процессор и по возможности выполняется в отдельном процессе,
+чтобы не делить GIL с записью в базу.
+
+Для каждого этапа считается число элементов, время работы, скорость и
+простой: ожидание входной очереди (предыдущий этап не успевает) и выходной
+(следующий этап не успевает).
+"""
+import multiprocessing
+import queue
+import resource
+import threading
+import time
+from io import RawIOBase, BufferedReader
+
+from django.conf import settings
+
+from backend.archive import open_price_feed
+from backend.feeds import read_price_feed, PriceFeedError
+from backend.importer import batched
+
+READ_CHUNK_SIZE = 256 * 1024
+# интервал, с которым заблокированный этап проверяет сигнал остановки
+POLL_INTERVAL = 0.1
+
+
+class PipelineStopped(Exception):
+    """Конвейер остановлен, пока этап ждал очередь"""
+
+
+class StageStats:
+    """Счетчики одного этапа конвейера"""
+
+    def __init__(self):
+        self.items = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self.input_wait = 0.0
+        self.output_wait = 0.0
+
+    def finish(self):
+        if self.finished is None:
+            self.finished = time.monotonic()
+
+    def as_dict(self):
+        seconds = (self.finished or time.monotonic()) - self.started
+        return {
+            'items': self.items,
+            'seconds': round(seconds, 3),
+            'rate': round(self.items / seconds, 1) if seconds else 0.0,
+            'input_wait': round(self.input_wait, 3),
+            'output_wait': round(self.output_wait, 3),
+        }
+
+
+def _put(out, item, stats, stop):
+    started = time.monotonic()
+    while True:
+        try:
+            out.put(item, timeout=POLL_INTERVAL)
+            break
+        except queue.Full:
+            if stop.is_set():
+                raise PipelineStopped
+    stats.output_wait += time.monotonic() - started
+
+
+def _get(inp, stats, stop):
+    started = time.monotonic()
+    while True:
+        try:
+            item = inp.get(timeout=POLL_INTERVAL)
+            break
+        except queue.Empty:
+            if stop.is_set():
+                raise PipelineStopped
+    stats.input_wait += time.monotonic() - started
+    return item
+
+
+class QueueReader(RawIOBase):
+    """Файловый объект, читающий куски байтов из очереди до пустого куска"""
+
+    def __init__(self, inp, stats, stop):
+        self.inp = inp
+        self.stats = stats
+        self.stop = stop
+        self.buffer = b''
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer and not self.eof:
+            self.buffer = _get(self.inp, self.stats, self.stop)
+            self.eof = not self.buffer
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def read_stage(path, out, stats, stop):
+    """Читает прайс из хранилища кусками в очередь, пустой кусок - конец файла"""
+    try:
+        with open_price_feed(path) as f:
+            while chunk := f.read(READ_CHUNK_SIZE):
+                stats.items += len(chunk)
+                _put(out, chunk, stats, stop)
+        _put(out, b'', stats, stop)
+    except PipelineStopped:
+        pass
+    finally:
+        stats.finish()
+
+
+def parse_stage(inp, out, stop, batch_size, content_type=None):
+    """
+    Разбирает прайс из очереди байтов и передает дальше заголовок и пачки товаров.
+
+    Сообщения в out: ('header', dict), ('goods', list), ('done', счетчики этапа)
+    или ('error', (тип, текст)). Выполняется в отдельном процессе или потоке.
+    """
+    stats = StageStats()
+    try:
+        data = read_price_feed(BufferedReader(QueueReader(inp, stats, stop)), content_type)
+        goods = data.pop('goods')
+        _put(out, ('header', data), stats, stop)
+        for batch in batched(goods, batch_size):
+            stats.items += len(batch)
+            _put(out, ('goods', batch), stats, stop)
+        stats.finish()
+        report = stats.as_dict()
+        if multiprocessing.parent_process() is not None:
+            # процесс разбора создается для одного импорта: ru_maxrss - его пик
+            report['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        _put(out, ('done', report), stats, stop)
+    except PipelineStopped:
+        pass
+    except Exception as e:
+        stats.finish()
+        try:
+            _put(out, ('error', (type(e).__name__, str(e))), stats, stop)
+        except PipelineStopped:
+            pass
+
+
+def can_use_process():
+    """Дочерний процесс можно запустить не из демонического процесса"""
+    return not multiprocessing.current_process().daemon
+
+
+class PricePipeline:
+    """
+    Конвейер чтение -> разбор -> запись для сохраненного прайса.
+
+    Внутри with атрибут data содержит shop, categories и генератор goods,
+    который отдает товары по мере разбора; его потребитель - этап записи,
+    который считается завершенным при выходе из with.
+
+    Аргументы:
+        path (str): путь к прайсу в default_storage
+        batch_size (int): товаров в одной пачке между разбором и записью
+        use_process (bool): разбирать прайс в отдельном процессе,
+            по умолчанию PRICE_IMPORT_PARSE_PROCESS
+        content_type (str): Content-Type прайса от поставщика, подсказка формата
+    """
+
+    def __init__(self, path, batch_size=None, use_process=None, content_type=None):
+        self.path = path
+        self.content_type = content_type
+        self.batch_size = batch_size or settings.PRICE_IMPORT_BATCH_SIZE
+        if use_process is None:
+            use_process = settings.PRICE_IMPORT_PARSE_PROCESS
+        self.use_process = use_process and can_use_process()
+        self.read_stats = StageStats()
+        self.parse_stats = None
+        self.write_stats = StageStats()
+        self.data = None
+
+    def __enter__(self):
+        size = settings.PRICE_IMPORT_QUEUE_SIZE
+        if self.use_process:
+            context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+            self.stop = context.Event()
+            self.raw = context.Queue(size)
+            self.parsed = context.Queue(size)
+            self.parser = context.Process(target=parse_stage, args=(
+                self.raw, self.parsed, self.stop, self.batch_size, self.content_type), daemon=True)
+        else:
+            self.stop = threading.Event()
+            self.raw = queue.Queue(size)
+            self.parsed = queue.Queue(size)
+            self.parser = threading.Thread(target=parse_stage, args=(
+                self.raw, self.parsed, self.stop, self.batch_size, self.content_type), daemon=True)
+        # процесс разбора создается до потоков, чтобы не копировать их при fork
+        self.parser.start()
+        self.reader = threading.Thread(
+            target=read_stage, args=(self.path, self.raw, self.read_stats, self.stop), daemon=True)
+        self.reader.start()
+
+        try:
+            _, header = self._receive()
+            self.data = dict(header, goods=self._iter_goods())
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _receive(self):
+        kind, payload = _get(self.parsed, self.write_stats, self.stop)
+        if kind == 'error':
+            error_type, message = payload
+            if error_type == 'PriceFeedError':
+                raise PriceFeedError(message)
+            raise RuntimeError(f'{error_type}: {message}')
+        return kind, payload
+
+    def _iter_goods(self):
+        while True:
+            kind, payload = self._receive()
+            if kind == 'done':
+                self.parse_stats = payload
+                return
+            self.write_stats.items += len(payload)
+            yield from payload
+
+    def close(self):
+        """Останавливает этапы и дожидается их завершения"""
+        self.stop.set()
+        self.write_stats.finish()
+        self.reader.join()
+        self.parser.join(timeout=5)
+        if self.use_process:
+            if self.parser.is_alive():
+                self.parser.terminate()
+                self.parser.join()
+            self.raw.cancel_join_thread()
+            self.parsed.cancel_join_thread()
+
+    def report(self):
+        """Счетчики этапов: для чтения items - байты, для разбора и записи - товары"""
+        return {
+            'mode': 'process' if self.use_process else 'thread',
+            'read': self.read_stats.as_dict(),
+            'parse': self.parse_stats,
+            'write': self.write_stats.as_dict(),
+        }
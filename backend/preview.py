@@ -0,0 +1,133 @@
+"""
+Предпросмотр импорта прайса без записи в базу.
+
+Прайс разбирается и проверяется так же, как при импорте, и сравнивается
+с опубликованной версией каталога магазина пачками: на пачку выполняется
+пара запросов чтения, поэтому время растет с числом пачек, а не строк.
+В итоге возвращаются число новых, изменившихся, неизмененных и снимаемых
+с продажи товаров, товары с изменением цены больше порога и примеры ИД.
+"""
+import time
+
+from django.conf import settings
+
+from backend.importer import batched, get_external_id
+from backend.models import Category, ProductInfo, ProductParameter
+from backend.validation import GoodsValidator
+
+
+def preview_price_feed(shop, data, price_threshold=None, batch_size=None):
+    """
+    Сравнивает прайс с опубликованным каталогом магазина, ничего не записывая.
+
+    Аргументы:
+        shop (Shop): магазин
+        data (dict): прайс с ключами shop, categories и goods
+        price_threshold (float): порог изменения цены в процентах,
+            по умолчанию PRICE_PREVIEW_PRICE_THRESHOLD
+        batch_size (int): товаров в пачке, по умолчанию PRICE_IMPORT_BATCH_SIZE
+
+    Возвращает:
+        dict: сводка изменений
+    """
+    started = time.monotonic()
+    if price_threshold is None:
+        price_threshold = settings.PRICE_PREVIEW_PRICE_THRESHOLD
+    batch_size = batch_size or settings.PRICE_IMPORT_BATCH_SIZE
+    sample_size = settings.PRICE_PREVIEW_SAMPLE_SIZE
+
+    shop_categories = set(Category.objects.filter(shops=shop).values_list('id', flat=True))
+    feed_categories = {category['id'] for category in data['categories']}
+    validator = GoodsValidator(shop_categories | feed_categories,
+                               max_errors=getattr(settings, 'PRICE_IMPORT_MAX_ERRORS', 100))
+
+    summary = {
+        'goods': 0, 'new': 0, 'changed': 0, 'unchanged': 0, 'removed': 0, 'invalid': 0,
+        'categories_new': len(feed_categories - shop_categories),
+        'price_threshold': price_threshold,
+        'price_moves': 0,
+        'samples': {'new': [], 'changed': [], 'removed': [], 'price_moves': []},
+    }
+    samples = summary['samples']
+    seen = set()
+    position = 0
+
+    for batch in batched(data['goods'], batch_size):
+        valid = validator.filter(batch, position)
+        position += len(batch)
+        summary['goods'] += len(batch)
+        summary['invalid'] += len(batch) - len(valid)
+        # отложенные строки не снимают товар с продажи, как и при импорте
+        seen.update(get_external_id(item) for item in batch)
+
+        goods = {item['id']: item for item in valid}
+        existing = load_published(shop, goods)
+        for external_id, item in goods.items():
+            current = existing.get(external_id)
+            if current is None:
+                summary['new'] += 1
+                add_sample(samples['new'], external_id, sample_size)
+                continue
+
+            if is_changed(current, item):
+                summary['changed'] += 1
+                add_sample(samples['changed'], external_id, sample_size)
+            else:
+                summary['unchanged'] += 1
+
+            if current['price'] and abs(item['price'] - current['price']) * 100 >= price_threshold * current['price']:
+                summary['price_moves'] += 1
+                add_sample(samples['price_moves'], {
+                    'id': external_id,
+                    'model': item['model'],
+                    'old': current['price'],
+                    'new': item['price'],
+                    'percent': round((item['price'] - current['price']) * 100 / current['price'], 1),
+                }, sample_size)
+
+    active = ProductInfo.objects.published().filter(shop=shop, is_active=True).values_list('external_id', flat=True)
+    for external_id in active.iterator():
+        if external_id not in seen:
+            summary['removed'] += 1
+            add_sample(samples['removed'], external_id, sample_size)
+
+    summary['errors'] = validator.errors
+    summary['seconds'] = round(time.monotonic() - started, 3)
+    return summary
+
+
+def add_sample(samples, value, size):
+    if len(samples) < size:
+        samples.append(value)
+
+
+def load_published(shop, goods):
+    """
+    Возвращает словарь внешний ИД -> поля опубликованного предложения магазина
+    с параметрами (имя -> значение) для товаров пачки.
+    """
+    existing = {}
+    queryset = ProductInfo.objects.published().filter(shop=shop, external_id__in=goods).values(
+        'id', 'external_id', 'product__name', 'product__category_id', 'model', 'price', 'price_rrc', 'quantity',
+        'is_active').order_by('id')
+    for row in queryset:
+        row['parameters'] = {}
+        existing.setdefault(row['external_id'], row)
+
+    by_id = {row['id']: row for row in existing.values()}
+    params = ProductParameter.objects.filter(product_info_id__in=by_id).values_list(
+        'product_info_id', 'parameter__name', 'value')
+    for product_info_id, name, value in params:
+        by_id[product_info_id]['parameters'][name] = value
+    return existing
+
+
+def is_changed(current, item):
+    """Отличается ли товар прайса от опубликованного предложения"""
+    return (
+        not current['is_active']
+        or current['product__name'] != item['name']
+        or current['product__category_id'] != item['category']
+        or any(current[name] != item[name] for name in ('model', 'price', 'price_rrc', 'quantity'))
+        or current['parameters'] != {name: str(value) for name, value in item['parameters'].items()}
+    )
@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from backend.models import User, Category, Shop, ProductInfo, Product, ProductParameter, OrderItem, Order, Contact
+from backend.models import User, Category, Shop, ProductInfo, Product, OrderItem, Order, Contact, \
+    CatalogEntry
 from django.core.exceptions import ObjectDoesNotExist
 
 class ContactSerializer(serializers.ModelSerializer):
@@ -55,17 +56,10 @@ class ProductSerializer(serializers.ModelSerializer):
         fields = ('name', 'category')
 
 
-class ProductParameterSerializer(serializers.ModelSerializer):
-    parameter = serializers.StringRelatedField()
-
-    class Meta:
-        model = ProductParameter
-        fields = ('parameter', 'value',)
-
-
 class ProductInfoSerializer(serializers.ModelSerializer):
     product = ProductSerializer(read_only=True)
-    product_params = ProductParameterSerializer(read_only=True, many=True)
+    # копия параметров в самом предложении, без запросов к ProductParameter
+    product_params = serializers.JSONField(source='attributes', read_only=True)
     image = serializers.SerializerMethodField()
     thumbnail_small = serializers.SerializerMethodField()
     thumbnail_medium = serializers.SerializerMethodField()
@@ -98,6 +92,51 @@ class ProductInfoSerializer(serializers.ModelSerializer):
         return image_field.url
 
 
+class CatalogEntrySerializer(serializers.ModelSerializer):
+    """
+    Строка витрины каталога в том же виде, что и ProductInfoSerializer,
+    но без обращений к связанным таблицам.
+    """
+    id = serializers.IntegerField(source='product_info_id', read_only=True)
+    product = serializers.SerializerMethodField()
+    shop = serializers.IntegerField(source='shop_id', read_only=True)
+    product_params = serializers.JSONField(source='parameters', read_only=True)
+    image = serializers.SerializerMethodField()
+    thumbnail_small = serializers.SerializerMethodField()
+    thumbnail_medium = serializers.SerializerMethodField()
+    thumbnail_large = serializers.SerializerMethodField()
+
+    class Meta:
+        model = CatalogEntry
+        fields = ('id', 'model', 'product', 'shop', 'quantity', 'price', 'price_rrc', 'product_params', 'image',
+                  'thumbnail_small', 'thumbnail_medium', 'thumbnail_large')
+
+    def get_product(self, obj):
+        return {'name': obj.product_name, 'category': obj.category_name}
+
+    def get_image(self, obj):
+        return self._get_image_url(obj, 'image')
+
+    def get_thumbnail_small(self, obj):
+        return self._get_image_url(obj, 'thumbnail_small')
+
+    def get_thumbnail_medium(self, obj):
+        return self._get_image_url(obj, 'thumbnail_medium')
+
+    def get_thumbnail_large(self, obj):
+        return self._get_image_url(obj, 'thumbnail_large')
+
+    def _get_image_url(self, obj, name):
+        url = obj.images.get(name)
+        if not url:
+            return None
+
+        request = self.context.get('request')
+        if request is not None:
+            return request.build_absolute_uri(url)
+        return url
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = OrderItem
@@ -107,6 +146,11 @@ class OrderItemSerializer(serializers.ModelSerializer):
             'order': {'write_only': True}
         }
 
+    def validate_product_info(self, value):
+        if not value.is_active or not value.in_version(value.shop.catalog_version):
+            raise serializers.ValidationError('Товар снят с продажи')
+        return value
+
 
 class OrderItemCreateSerializer(serializers.ModelSerializer):
     product_info = ProductInfoSerializer(read_only=True)
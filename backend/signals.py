@@ -1,8 +1,11 @@
-from django.db.models.signals import post_save
+from django.db import connections
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_migrate
 from django.dispatch import receiver, Signal
 from django_rest_passwordreset.signals import reset_password_token_created
 
-from backend.models import User
+from backend.models import Category, Product, ProductInfo, ProductParameter, Shop, User, refresh_attributes
+from backend.storefront import refresh_storefront, refresh_storefront_shops
 
 from .tasks import send_confirmation_email, send_order_email, send_password_reset_email
 
@@ -27,3 +30,41 @@ def new_user_registered_signal(sender, instance, created, **kwargs):
 def new_order_signal(user_id, **kwargs):
     send_order_email.delay(user_id)
 
+
+# витрина каталога (backend.storefront) для правок по одной строке: админка, изображения,
+# статус магазина; массовые операции импорта обновляют витрину сами
+@receiver(post_save, sender=Shop)
+def shop_saved_signal(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'name', 'state'} & set(update_fields):
+        refresh_storefront_shops([instance])
+
+
+@receiver(post_save, sender=ProductInfo)
+def product_info_saved_signal(sender, instance, **kwargs):
+    refresh_storefront([instance.id])
+
+
+@receiver(post_save, sender=ProductParameter)
+def product_parameter_saved_signal(sender, instance, **kwargs):
+    refresh_attributes([instance.product_info_id])
+    refresh_storefront([instance.product_info_id])
+
+
+# массовые операции каталога удаляют параметры без сигнала (models.delete_product_params)
+@receiver(post_delete, sender=ProductParameter)
+def product_parameter_deleted_signal(sender, instance, origin=None, **kwargs):
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    # при удалении самого предложения (или его магазина, продукта, категории) пересобирать нечего
+    if origin_model in (ProductInfo, Product, Shop, Category):
+        return
+    refresh_attributes([instance.product_info_id])
+    refresh_storefront([instance.product_info_id])
+
+
+@receiver(pre_migrate)
+def create_search_extensions(sender, using='default', **kwargs):
+    # триграммный индекс поиска по витрине (CatalogEntry) создается с классом операторов из pg_trgm
+    connection = connections[using]
+    if sender.name == 'backend' and connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
@@ -0,0 +1,123 @@
+"""
+Быстрое обновление цен и остатков предложений магазина.
+
+Партнер присылает строки (external_id, price, price_rrc, quantity) в JSON
+или CSV, в строке могут быть не все поля - например, только остаток.
+Строки обрабатываются пачками по PARTNER_STOCK_BATCH_SIZE: на пачку один
+запрос чтения текущих значений и один UPDATE с CASE по ИД изменившихся
+предложений, поэтому синхронизация остатков не перезаписывает каталог
+и не зависит от размера прайса.
+
+Обновляются предложения опубликованной версии каталога магазина. Строки
+неизмененных предложений общие для соседних версий (см. backend.catalog),
+так что новые цены и остатки видны и в собираемой импортом версии.
+Строки витрины каталога измененных предложений пересобираются сразу.
+"""
+import csv
+from io import StringIO
+
+from django.conf import settings
+from django.db.models import Case, F, IntegerField, Value, When
+
+from backend.importer import batched
+from backend.models import ProductInfo
+from backend.storefront import refresh_storefront
+from backend.validation import check_stock_row, STOCK_FIELDS
+
+
+def read_stock_csv(text):
+    """
+    Разбирает строки обновления из CSV с заголовком external_id,price,price_rrc,quantity.
+
+    Пустое значение означает, что поле не меняется; нечисловые значения
+    остаются строками и отклоняются проверкой.
+    """
+    rows = []
+    for row in csv.DictReader(StringIO(text.lstrip('\ufeff'))):
+        item = {}
+        for name, value in row.items():
+            if name is None or value is None or value.strip() == '':
+                continue
+            value = value.strip()
+            item[name.strip()] = int(value) if value.isdigit() else value
+        rows.append(item)
+    return rows
+
+
+def update_offer_stock(shop, rows, batch_size=None):
+    """
+    Обновляет цены и остатки предложений магазина.
+
+    Аргументы:
+        shop (Shop): магазин
+        rows (list): словари с external_id и хотя бы одним из полей price, price_rrc, quantity
+        batch_size (int): строк в пачке, по умолчанию PARTNER_STOCK_BATCH_SIZE
+
+    Возвращает:
+        dict: счетчики по статусам и results - исход каждой строки:
+        updated, unchanged, not_found или invalid с причинами
+    """
+    batch_size = batch_size or settings.PARTNER_STOCK_BATCH_SIZE
+    results = []
+    # повтор ИД в запросе неоднозначен: действует последняя строка
+    last_row = {}
+    for row, item in enumerate(rows, start=1):
+        if isinstance(item, dict) and type(item.get('external_id')) is int:
+            last_row[item['external_id']] = row
+
+    position = 0
+    for batch in batched(rows, batch_size):
+        valid = {}
+        for row, item in enumerate(batch, start=position + 1):
+            result = {'row': row, 'external_id': item.get('external_id') if isinstance(item, dict) else None}
+            results.append(result)
+            reasons = check_stock_row(item)
+            if not reasons and last_row[item['external_id']] != row:
+                reasons = [f'external_id: повторяется в строке {last_row[item["external_id"]]}']
+            if reasons:
+                result.update(status='invalid', errors=reasons)
+            else:
+                valid[item['external_id']] = (item, result)
+        position += len(batch)
+        if valid:
+            apply_stock_batch(shop, valid)
+
+    counts = {'updated': 0, 'unchanged': 0, 'not_found': 0, 'invalid': 0}
+    for result in results:
+        counts[result['status']] += 1
+    return dict(counts, results=results)
+
+
+def apply_stock_batch(shop, valid):
+    """
+    Применяет пачку проверенных строк одним UPDATE.
+
+    Аргументы:
+        valid (dict): external_id -> (строка, словарь исхода строки)
+    """
+    current = ProductInfo.objects.published().filter(shop=shop, external_id__in=valid).values_list(
+        'id', 'external_id', *STOCK_FIELDS)
+    changes = {}
+    found = set()
+    for product_info_id, external_id, *values in current:
+        found.add(external_id)
+        item = valid[external_id][0]
+        if any(name in item and item[name] != value for name, value in zip(STOCK_FIELDS, values)):
+            changes[product_info_id] = item
+
+    for external_id, (item, result) in valid.items():
+        result['status'] = 'not_found' if external_id not in found else 'unchanged'
+    for item in changes.values():
+        valid[item['external_id']][1]['status'] = 'updated'
+
+    if changes:
+        ProductInfo.objects.filter(id__in=changes).update(**{
+            name: Case(
+                *(When(id=product_info_id, then=Value(item[name]))
+                  for product_info_id, item in changes.items() if name in item),
+                default=F(name),
+                output_field=IntegerField(),
+            )
+            for name in STOCK_FIELDS if any(name in item for item in changes.values())
+        })
+        refresh_storefront(changes)
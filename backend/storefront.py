@@ -0,0 +1,229 @@
+"""
+Витрина каталога (CatalogEntry) - денормализованная копия опубликованного каталога.
+
+Каталог для покупателей читается из одной таблицы: в строке витрины уже
+есть название продукта и категории, магазин и его статус, цены, остаток,
+параметры в виде готового списка (копия ProductInfo.attributes) и адреса
+изображений. Витрина обновляется по частям:
+
+* при публикации версии каталога (sync_storefront) - удаляются строки
+  снятых предложений и добавляются строки новых; неизмененные предложения
+  при копировании при записи сохраняют id и содержимое, поэтому их строки
+  не пересобираются;
+* при записи прайса прямо в опубликованную версию, быстром обновлении цен
+  и остатков, загрузке изображения и правке предложения - пересборкой
+  строк затронутых предложений (refresh_storefront);
+* при смене названия или статуса магазина - одним UPDATE его строк
+  (refresh_storefront_shops).
+
+Вместе со строками витрины обновляется индекс фасетов (backend.facets).
+
+Фильтры по диапазонам числовых параметров и сортировка по числовому
+параметру (filter_parameter_ranges, order_by_parameter) соединяют витрину
+с ProductParameter по индексу (параметр, числовое значение, предложение).
+
+Поиск по витрине (search_storefront) идет по тексту search_document:
+в PostgreSQL - полнотекстовый по GIN-индексу tsvector и с опечатками по
+триграммному GIN-индексу (см. CatalogEntry), в других базах - по вхождению
+слов без ранжирования.
+"""
+from collections import defaultdict
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramWordSimilarity
+from django.db import connection, transaction
+from django.db.models import F, FilteredRelation, Q, Value
+from django.db.models.functions import Greatest
+
+from backend.facets import rebuild_shop_facets, update_facets, visible_entries
+from backend.models import CatalogEntry, Parameter, ProductInfo, SEARCH_CONFIG
+
+STOREFRONT_BATCH_SIZE = 1000
+IMAGE_FIELDS = ('image', 'thumbnail_small', 'thumbnail_medium', 'thumbnail_large')
+FACET_FIELDS = ('product_info_id', 'shop_id', 'category_id', 'parameters', 'shop_state', 'is_active')
+
+
+def sync_storefront(shop, rebuild=False):
+    """
+    Приводит витрину магазина к опубликованной версии каталога.
+
+    Аргументы:
+        shop (Shop): магазин с актуальным catalog_version
+        rebuild (bool): пересобрать и строки уже показанных предложений,
+            например после записи прайса прямо в опубликованную версию
+    """
+    published = set(ProductInfo.objects.visible(shop.catalog_version).filter(
+        shop_id=shop.id).values_list('id', flat=True))
+    existing = set(CatalogEntry.objects.filter(shop_id=shop.id).values_list('product_info_id', flat=True))
+
+    for batch in _batches(existing - published):
+        stale = CatalogEntry.objects.filter(product_info_id__in=batch)
+        with transaction.atomic():
+            update_facets(visible_entries(stale.values(*FACET_FIELDS)), [])
+            stale.delete()
+    refresh_storefront(published if rebuild else published - existing)
+
+
+def refresh_storefront(product_info_ids):
+    """
+    Пересобирает строки витрины предложений из основных таблиц.
+
+    Предложения, не действующие в опубликованной версии своего магазина,
+    из витрины удаляются.
+    """
+    for batch in _batches(product_info_ids):
+        offers = ProductInfo.objects.published().filter(id__in=batch).values(
+            'id', 'shop_id', 'shop__name', 'shop__state', 'product_id', 'product__name', 'product__category_id',
+            'product__category__name', 'external_id', 'model', 'quantity', 'price', 'price_rrc', 'is_active', 'image',
+            'attributes')
+
+        entries = [
+            CatalogEntry(
+                product_info_id=offer['id'],
+                shop_id=offer['shop_id'],
+                shop_name=offer['shop__name'],
+                shop_state=offer['shop__state'],
+                product_id=offer['product_id'],
+                product_name=offer['product__name'],
+                category_id=offer['product__category_id'],
+                category_name=offer['product__category__name'],
+                external_id=offer['external_id'],
+                model=offer['model'],
+                quantity=offer['quantity'],
+                price=offer['price'],
+                price_rrc=offer['price_rrc'],
+                is_active=offer['is_active'],
+                parameters=offer['attributes'],
+                images=render_images(offer['id'], offer['image']),
+                search_document=' '.join([
+                    offer['product__name'], offer['model'], *(item['value'] for item in offer['attributes'])
+                ]).lower(),
+            )
+            for offer in offers
+        ]
+        with transaction.atomic():
+            previous = CatalogEntry.objects.filter(product_info_id__in=batch)
+            update_facets(visible_entries(previous.values(*FACET_FIELDS)), [
+                (entry.product_info_id, entry.shop_id, entry.category_id, entry.parameters)
+                for entry in entries if entry.shop_state and entry.is_active
+            ])
+            previous.delete()
+            CatalogEntry.objects.bulk_create(entries)
+
+
+def _batches(ids):
+    # backend.importer.batched не используется: импорт импортера отсюда был бы циклическим
+    ids = sorted(ids)
+    for start in range(0, len(ids), STOREFRONT_BATCH_SIZE):
+        yield ids[start:start + STOREFRONT_BATCH_SIZE]
+
+
+def render_images(product_info_id, image):
+    """Адреса изображения предложения и его миниатюр относительно MEDIA_URL или пустой словарь"""
+    if not image:
+        return {}
+    info = ProductInfo(id=product_info_id, image=image)
+    images = {}
+    for name in IMAGE_FIELDS:
+        try:
+            images[name] = getattr(info, name).url
+        except OSError:
+            # миниатюра еще не создана из отсутствующего файла
+            images[name] = None
+    return images
+
+
+def refresh_storefront_shops(shops):
+    """Переносит в витрину названия и статусы магазинов"""
+    for shop in shops:
+        entries = CatalogEntry.objects.filter(shop_id=shop.id)
+        state_changed = entries.exclude(shop_state=shop.state).exists()
+        entries.exclude(shop_name=shop.name, shop_state=shop.state).update(shop_name=shop.name, shop_state=shop.state)
+        if state_changed:
+            rebuild_shop_facets(shop)
+
+
+def search_storefront(queryset, text):
+    """
+    Отбирает строки витрины, подходящие под строку поиска, и добавляет
+    к ним релевантность rank.
+
+    В PostgreSQL строка подходит, если совпадает по полнотекстовому поиску
+    (websearch: слова, "фраза", -исключение) или похожа на одно из слов
+    текста по триграммам (pg_trgm.word_similarity_threshold), что находит
+    слова с опечатками. Оба условия проверяются по GIN-индексам, rank -
+    наибольшее из ранга полнотекстового поиска и сходства по триграммам.
+    В других базах строка должна содержать все слова, rank равен 0.
+
+    Аргументы:
+        queryset (QuerySet): строки витрины
+        text (str): строка поиска
+
+    Возвращает:
+        QuerySet: строки витрины с полем rank
+    """
+    text = text.lower()
+    if connection.vendor != 'postgresql':
+        words = Q()
+        for word in text.split():
+            words &= Q(search_document__contains=word)
+        return queryset.filter(words).annotate(rank=Value(0.0))
+
+    query = SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+    vector = SearchVector('search_document', config=SEARCH_CONFIG)
+    return queryset.alias(document=vector).filter(
+        Q(document=query) | Q(search_document__trigram_word_similar=text)
+    ).annotate(rank=Greatest(SearchRank(vector, query), TrigramWordSimilarity(text, 'search_document')))
+
+
+def parameter_ids(names):
+    """id параметров по именам: имя -> список id"""
+    ids = defaultdict(list)
+    for parameter_id, name in Parameter.objects.filter(name__in=names).values_list('id', 'name'):
+        ids[name].append(parameter_id)
+    return ids
+
+
+def numeric_parameter(ids):
+    """Соединение строки витрины с числовым значением одного из параметров ids"""
+    return FilteredRelation('product_info__product_params', condition=Q(
+        product_info__product_params__parameter_id__in=ids, product_info__product_params__value_number__isnull=False))
+
+
+def filter_parameter_ranges(queryset, ranges):
+    """
+    Отбирает строки витрины по диапазонам числовых параметров.
+
+    Аргументы:
+        ranges: список (имя параметра, lookup, число), см.
+            backend.facets.parse_parameter_filters
+    """
+    ids = parameter_ids({name for name, _, _ in ranges})
+    for index, (name, lookup, number) in enumerate(ranges):
+        if not ids[name]:
+            return queryset.none()
+        alias = f'parameter_range_{index}'
+        queryset = queryset.annotate(**{alias: numeric_parameter(ids[name])}).filter(
+            **{f'{alias}__value_number__{lookup}': number})
+    return queryset
+
+
+def order_by_parameter(queryset, name):
+    """
+    Добавляет к строкам витрины числовое значение параметра name в поле
+    sort_value для сортировки по нему. Строки без числового значения
+    параметра не попадают в выдачу.
+    """
+    ids = parameter_ids({name})[name]
+    if not ids:
+        return queryset.none()
+    return queryset.annotate(sort_parameter=numeric_parameter(ids)).annotate(
+        sort_value=F('sort_parameter__value_number')).filter(sort_value__isnull=False)
+
+
+def parameter_range_ids(queryset, ranges):
+    """
+    id строк витрины queryset под всеми диапазонами числовых параметров:
+    одним запросом с соединениями по индексу значений (filter_parameter_ranges),
+    только среди показанных строк нужных магазина и категории.
+    """
+    return set(filter_parameter_ranges(queryset, ranges).values_list('pk', flat=True))
@@ -1,27 +1,38 @@
-from celery import shared_task
+import random
+from datetime import timedelta
+from itertools import chain, islice
+from uuid import uuid4
+
+from celery import chord, shared_task
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from django.conf import settings
 from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 from django_rest_passwordreset.models import ResetPasswordToken
-from requests import get
-from yaml import load as load_yaml, Loader
+from django.core.cache import cache
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 from io import BytesIO
 from PIL import Image
 import os
 
+from backend.archive import archive_price_feed, archive_uploaded_feed, purge_price_feed_archive
+from backend.catalog import create_catalog_version, publish_catalog_version
+from backend.feeds import PriceFeedError, read_price_feed
+from backend.fetcher import fetch_price_feed, remember_feed, FeedTooLarge, FetchedFeed
+from backend.metrics import ImportMetrics
+from backend.importer import PriceImporter, batched, read_price_chunk, stage_price_chunks
+from backend.pipeline import PricePipeline
+from backend.preview import preview_price_feed
 from backend.models import (
     User,
     ConfirmEmailToken,
     Shop,
-    Category,
-    Product,
-    ProductInfo,
-    Parameter,
-    ProductParameter,
+    ImportRun,
+    ImportBatch,
 )
 
 
@@ -114,60 +125,551 @@ def reset_password_request_token(user_id):
 
 
 @shared_task(bind=True)
-def update_partner_price(self, shop_id, url):
-    try:
-        with transaction.atomic():
-            shop = Shop.objects.get(id=shop_id)
+def update_partner_price(self, shop_id, url, force=False):
+    """
+    Импортирует прайс магазина.
 
-            # Загрузка и обработка YAML
-            stream = get(url).content
-            data = load_yaml(stream, Loader=Loader)
+    Загруженный прайс сохраняется в архив (backend.archive) и записывается в базу пачками
+    с контрольной точкой в ImportRun: повтор задачи после сбоя не загружает
+    прайс заново, а продолжает с последней записанной пачки.
 
-            # Обновление названия магазина
-            shop.name = data['shop']
-            shop.save()
+    Прайс до PRICE_IMPORT_CHUNK_SIZE товаров импортируется в этой задаче.
+    Большой прайс после импорта категорий и параметров делится на части,
+    которые обрабатываются группой задач import_price_chunk на всех
+    воркерах, а finish_price_import снимает с продажи пропавшие товары.
 
-            # Обработка категорий
-            for category in data['categories']:
-                category_obj, _ = Category.objects.get_or_create(
-                    id=category['id'],
-                    defaults={'name': category['name']}
+    Импорт магазина защищен блокировкой в кэше: задача, запущенная при уже
+    идущем импорте того же магазина, возвращает ИД идущей задачи.
+    """
+    if self.request.id:
+        holder = acquire_price_import_lock(shop_id, self.request.id)
+        if holder != self.request.id:
+            return {'status': 'duplicate', 'message': 'Price list import already running', 'task_id': holder}
+
+    try:
+        shop = Shop.objects.get(id=shop_id)
+        run = None
+        if self.request.id:
+            run = ImportRun.objects.filter(task_id=self.request.id, shop=shop).exclude(feed_path='').first()
+
+        if run is None:
+            metrics = ImportMetrics()
+            with metrics.phase('fetch'):
+                feed = fetch_price_feed(shop, url, force=force)
+            with feed:
+                # неизмененный прайс не импортируется повторно
+                if not force and feed.is_unchanged(shop):
+                    ImportRun.objects.create(shop=shop, task_id=self.request.id or '', url=url,
+                                             status='skipped', finished=timezone.now(), metrics=metrics.as_dict())
+                    release_price_import_lock(shop_id, self.request.id)
+                    return {'status': 'skipped', 'message': 'Price list not modified'}
+
+                with metrics.phase('archive'):
+                    feed_path = archive_price_feed(feed)
+                with metrics.phase('version'):
+                    # новая версия каталога собирается рядом с опубликованной
+                    version = create_catalog_version(shop)
+                run = ImportRun.objects.create(
+                    shop=shop,
+                    task_id=self.request.id or '',
+                    url=url,
+                    feed_hash=feed.sha256,
+                    feed_etag=feed.etag,
+                    feed_last_modified=feed.last_modified,
+                    feed_path=feed_path,
+                    feed_size=default_storage.size(feed_path),
+                    feed_content_type=feed.content_type,
+                    version=version,
+                    metrics=metrics.as_dict(),
                 )
-                category_obj.shops.add(shop)
-                category_obj.save()
+        elif run.chunks:
+            # части уже переданы воркерам, повторять нечего
+            return {'status': 'started', 'message': 'Price list import started', 'chunks': run.chunks}
+        else:
+            run.status = 'running'
+            run.error = ''
+            run.save(update_fields=['status', 'error', 'updated'])
+
+        result = run_price_import(run)
+        # при параллельном импорте блокировку снимает finish_price_import
+        if result['status'] != 'started':
+            release_price_import_lock(shop_id, self.request.id)
+        return result
+
+    except (FeedTooLarge, PriceFeedError) as e:
+        # повторная загрузка того же прайса не поможет
+        if self.request.id:
+            ImportRun.objects.filter(task_id=self.request.id).update(
+                status='failed', error=str(e), finished=timezone.now())
+        release_price_import_lock(shop_id, self.request.id)
+        return {'status': 'error', 'message': str(e)}
 
-            # Удаление старых товаров
-            ProductInfo.objects.filter(shop=shop).delete()
+    except Exception as e:
+        if self.request.id:
+            ImportRun.objects.filter(task_id=self.request.id).update(status='failed', error=str(e))
+        if self.request.retries >= 3:
+            if self.request.id:
+                ImportRun.objects.filter(task_id=self.request.id).update(finished=timezone.now())
+            release_price_import_lock(shop_id, self.request.id)
+        self.retry(exc=e, countdown=60, max_retries=3)
 
-            # Добавление новых товаров
-            for item in data['goods']:
-                product, _ = Product.objects.get_or_create(
-                    name=item['name'],
-                    category_id=item['category']
-                )
 
-                product_info = ProductInfo.objects.create(
-                    product=product,
-                    external_id=item['id'],
-                    model=item['model'],
-                    price=item['price'],
-                    price_rrc=item['price_rrc'],
-                    quantity=item['quantity'],
-                    shop=shop
-                )
+@shared_task(bind=True)
+def replay_price_import(self, run_id):
+    """
+    Повторяет импорт из архивного прайса запуска run_id без обращения к поставщику.
+
+    Создается новый запуск ImportRun с тем же прайсом и новой версией каталога,
+    дальше импорт идет так же, как в update_partner_price.
+    """
+    source = ImportRun.objects.select_related('shop').get(id=run_id)
+    if not source.feed_path or not default_storage.exists(source.feed_path):
+        return {'status': 'error', 'message': 'Archived price list not found'}
+
+    return import_stored_price(
+        self,
+        source.shop,
+        url=source.url,
+        feed_hash=source.feed_hash,
+        feed_etag=source.feed_etag,
+        feed_last_modified=source.feed_last_modified,
+        feed_path=source.feed_path,
+        feed_size=source.feed_size,
+        feed_content_type=source.feed_content_type,
+    )
+
+
+@shared_task(bind=True)
+def import_uploaded_price(self, shop_id, feed_path, feed_hash, content_type=''):
+    """
+    Импортирует прайс, загруженный файлом в админке (см. start_uploaded_price_import).
+
+    Сам файл не передается в сообщении Celery: задача получает путь к нему
+    в архиве прайсов, доступном всем воркерам через default_storage.
+    """
+    if not default_storage.exists(feed_path):
+        release_price_import_lock(shop_id, self.request.id)
+        return {'status': 'error', 'message': 'Uploaded price list not found'}
+
+    return import_stored_price(
+        self,
+        Shop.objects.get(id=shop_id),
+        feed_hash=feed_hash,
+        feed_path=feed_path,
+        feed_size=default_storage.size(feed_path),
+        feed_content_type=content_type,
+    )
+
+
+def import_stored_price(task, shop, **feed):
+    """
+    Импортирует прайс из архива в новую версию каталога магазина.
+
+    Аргументы:
+        task: выполняющаяся задача Celery (bind=True)
+        shop (Shop): магазин
+        **feed: поля ImportRun с адресом и архивом прайса (url, feed_path, feed_hash и т.д.)
+    """
+    shop_id = shop.id
+    if task.request.id:
+        holder = acquire_price_import_lock(shop_id, task.request.id)
+        if holder != task.request.id:
+            return {'status': 'duplicate', 'message': 'Price list import already running', 'task_id': holder}
+
+    result = None
+    try:
+        metrics = ImportMetrics()
+        with metrics.phase('version'):
+            version = create_catalog_version(shop)
+        run = ImportRun.objects.create(
+            shop=shop,
+            task_id=task.request.id or '',
+            version=version,
+            metrics=metrics.as_dict(),
+            **feed,
+        )
+        try:
+            result = run_price_import(run)
+        except Exception as e:
+            ImportRun.objects.filter(id=run.id).update(status='failed', error=str(e), finished=timezone.now())
+            if isinstance(e, PriceFeedError):
+                return {'status': 'error', 'message': str(e), 'run_id': run.id}
+            raise
+        return result
+    finally:
+        # при параллельном импорте блокировку снимает finish_price_import
+        if result is None or result['status'] != 'started':
+            release_price_import_lock(shop_id, task.request.id)
+
+
+@shared_task
+def preview_partner_price(shop_id, url, price_threshold=None):
+    """
+    Предпросмотр обновления прайса: загружает и проверяет прайс и сравнивает
+    его с опубликованным каталогом магазина, ничего не записывая в базу.
+    """
+    shop = Shop.objects.get(id=shop_id)
+    try:
+        with fetch_price_feed(shop, url, force=True) as feed:
+            summary = preview_price_feed(shop, read_price_feed(feed.file, feed.content_type), price_threshold)
+    except (FeedTooLarge, PriceFeedError) as e:
+        return {'status': 'error', 'message': str(e)}
+    return {'status': 'success', 'message': 'Price list preview', 'preview': summary}
+
+
+@shared_task
+def purge_price_feeds():
+    """Удаляет из архива прайсы сверх сроков и объема хранения"""
+    return {'deleted': purge_price_feed_archive()}
+
+
+def price_import_lock_key(shop_id):
+    return f'price-import-lock:{shop_id}'
+
+
+def acquire_price_import_lock(shop_id, task_id):
+    """
+    Захватывает блокировку импорта магазина для задачи task_id.
+
+    Возвращает:
+        str: ИД задачи, которая держит блокировку; совпадает с task_id,
+        если блокировка захвачена или кэш недоступен
+    """
+    key = price_import_lock_key(shop_id)
+    for _ in range(2):
+        if cache.add(key, task_id, timeout=settings.PRICE_IMPORT_LOCK_TIMEOUT):
+            return task_id
+        holder = cache.get(key)
+        if holder is not None:
+            return holder
+    return task_id
+
+
+def release_price_import_lock(shop_id, task_id):
+    """Снимает блокировку импорта магазина, если ее держит задача task_id"""
+    key = price_import_lock_key(shop_id)
+    if task_id and cache.get(key) == task_id:
+        cache.delete(key)
+
+
+def start_price_import(shop, url, force=False, countdown=None):
+    """
+    Запускает импорт прайса магазина, если он еще не идет.
+
+    Аргументы:
+        countdown (int): задержка запуска задачи в секундах
+
+    Возвращает:
+        tuple: ИД задачи импорта и признак того, что задача запущена сейчас,
+        а не присоединена к уже идущему импорту
+    """
+    task_id = str(uuid4())
+    holder = acquire_price_import_lock(shop.id, task_id)
+    if holder != task_id:
+        return holder, False
 
-                for name, value in item['parameters'].items():
-                    parameter, _ = Parameter.objects.get_or_create(name=name)
-                    ProductParameter.objects.create(
-                        product_info=product_info,
-                        parameter=parameter,
-                        value=value
-                    )
+    update_partner_price.apply_async(
+        kwargs={'shop_id': shop.id, 'url': url, 'force': force}, task_id=task_id, countdown=countdown)
+    return task_id, True
 
-        return {'status': 'success', 'message': 'Price list updated'}
+
+def start_uploaded_price_import(shop, uploaded):
+    """
+    Сохраняет загруженный файл прайса в архив и запускает его импорт,
+    если импорт магазина еще не идет.
+
+    Аргументы:
+        shop (Shop): магазин
+        uploaded (UploadedFile): файл прайса из формы
+
+    Возвращает:
+        tuple: ИД задачи импорта и признак того, что задача запущена сейчас
+    """
+    task_id = str(uuid4())
+    holder = acquire_price_import_lock(shop.id, task_id)
+    if holder != task_id:
+        return holder, False
+
+    try:
+        feed_path, feed_hash = archive_uploaded_feed(uploaded)
+    except Exception:
+        release_price_import_lock(shop.id, task_id)
+        raise
+    import_uploaded_price.apply_async(kwargs={
+        'shop_id': shop.id, 'feed_path': feed_path, 'feed_hash': feed_hash,
+        'content_type': uploaded.content_type or '',
+    }, task_id=task_id)
+    return task_id, True
+
+
+@shared_task
+def schedule_price_refresh():
+    """
+    Запускается Celery beat: обновляет прайсы магазинов, у которых подошло
+    время по refresh_interval, с адреса Shop.url.
+
+    Запуски разносятся случайной задержкой до PRICE_REFRESH_JITTER секунд
+    (не больше десятой части интервала), чтобы импорты не приходили на
+    воркеры одновременно. Неизмененный прайс пропускается задачей импорта
+    по ETag/Last-Modified или по хэшу содержимого.
+    """
+    now = timezone.now()
+    due = Shop.objects.filter(refresh_interval__gt=0, url__isnull=False).exclude(url='').filter(
+        Q(next_refresh_at__isnull=True) | Q(next_refresh_at__lte=now))
+
+    started = 0
+    for shop in due:
+        interval = timedelta(minutes=shop.refresh_interval)
+        # запуск закрепляется за этим вызовом, если время не сдвинул другой
+        claimed = Shop.objects.filter(id=shop.id, next_refresh_at=shop.next_refresh_at).update(
+            next_refresh_at=now + interval)
+        if not claimed:
+            continue
+
+        jitter = random.uniform(0, min(settings.PRICE_REFRESH_JITTER, interval.total_seconds() / 10))
+        _, is_new = start_price_import(shop, shop.url, countdown=jitter)
+        started += is_new
+
+    return {'status': 'success', 'due': len(due), 'started': started}
+
+
+def start_import_batch(shops, concurrency=None, force=False, user=None):
+    """
+    Запускает импорт прайсов нескольких магазинов с адресов из Shop.url.
+
+    Аргументы:
+        shops: магазины с заполненным url
+        concurrency (int): сколько импортов идет одновременно, по умолчанию PRICE_IMPORT_CONCURRENCY
+
+    Возвращает:
+        ImportBatch: пакет, по которому отслеживается общий статус
+    """
+    batch = ImportBatch.objects.create(
+        user=user,
+        concurrency=concurrency or settings.PRICE_IMPORT_CONCURRENCY,
+        force=force,
+        pending=[shop.id for shop in shops],
+    )
+    dispatch_import_batch.delay(batch.id)
+    return batch
+
+
+@shared_task
+def dispatch_import_batch(batch_id):
+    """
+    Запускает очередные импорты пакета, не превышая его concurrency,
+    и перезапускает себя, пока в пакете есть ожидающие магазины.
+    """
+    with transaction.atomic():
+        batch = ImportBatch.objects.select_for_update().get(id=batch_id)
+        # импорт магазина идет, пока его задача держит блокировку
+        active = sum(
+            1 for shop_id, task_id in batch.tasks.items()
+            if cache.get(price_import_lock_key(shop_id)) == task_id
+        )
+        while batch.pending and active < batch.concurrency:
+            shop = Shop.objects.filter(id=batch.pending.pop(0)).exclude(url=None).exclude(url='').first()
+            if shop is None:
+                continue
+            task_id, _ = start_price_import(shop, shop.url, force=batch.force)
+            batch.tasks[str(shop.id)] = task_id
+            active += 1
+        batch.save(update_fields=['pending', 'tasks'])
+
+    if batch.pending:
+        dispatch_import_batch.apply_async((batch_id,), countdown=settings.PRICE_IMPORT_BATCH_POLL)
+
+
+def run_price_import(run):
+    """
+    Импортирует прайс запуска run из сохраненного файла.
+
+    Чтение, разбор и запись выполняются конвейером PricePipeline,
+    счетчики его этапов возвращаются в результате под ключом pipeline,
+    а показатели импорта (ImportRun.metrics) - под ключом metrics.
+    """
+    chunk_size = settings.PRICE_IMPORT_CHUNK_SIZE
+    result = None
+
+    with PricePipeline(run.feed_path, content_type=run.feed_content_type) as pipeline:
+        data = pipeline.data
+
+        if not run.offset:
+            first = list(islice(data['goods'], chunk_size + 1))
+            if len(first) > chunk_size:
+                data['goods'] = chain(first, data['goods'])
+                result = start_chunked_price_import(run, data, pipeline)
+            else:
+                data['goods'] = first
+
+        if result is None:
+            importer = PriceImporter(run.shop, checkpoint=run)
+            importer.run(data)
+
+    if result is None:
+        complete_import_run(run, importer.stats, importer.errors, importer.metrics, pipeline.report())
+        result = {
+            'status': 'success',
+            'message': 'Price list updated',
+            'stats': importer.stats,
+            'errors': importer.errors,
+            'run_id': run.id,
+            'metrics': run.metrics,
+        }
+    result['pipeline'] = pipeline.report()
+    return result
+
+
+def start_chunked_price_import(run, data, pipeline):
+    importer = PriceImporter(run.shop, version=run.version)
+    importer.metrics.merge(run.metrics)
+    with transaction.atomic():
+        importer.import_header(data)
+
+    # строки с ошибками откладываются до раскладки по частям
+    goods = chain.from_iterable(importer.validate(batch) for batch in batched(data['goods'], importer.batch_size))
+    with importer.metrics.phase('stage') as phase:
+        manifest = stage_price_chunks(goods, f'price_imports/{run.id}', settings.PRICE_IMPORT_CHUNK_SIZE)
+        phase['rows'] += len(manifest['external_ids'])
+    with importer.metrics.phase('resolve'):
+        importer.resolve_parameter_names(manifest['parameters'])
+    with importer.metrics.phase('retire'):
+        stale = importer.find_stale(manifest['external_ids'] | importer.skipped)
+
+    # прайс уже разобран целиком: счетчики конвейера сохраняются до запуска частей
+    report = pipeline.report()
+    add_parse_metrics(importer.metrics, report)
+    run.metrics = dict(importer.metrics.as_dict(), pipeline=report)
+    run.save(update_fields=['metrics', 'updated'])
+
+    result = chord(
+        [import_price_chunk.s(run.shop_id, path, run.version) for path in manifest['paths']]
+    )(finish_price_import.s(run.id, stale, manifest['paths'], importer.stats, importer.errors).on_error(
+        fail_price_import.s(run.id, manifest['paths'])))
+    if result.parent is not None:
+        # группа сохраняется, чтобы TaskStatus мог показать прогресс по частям
+        result.parent.save()
+
+    run.chunks = len(manifest['paths'])
+    run.save(update_fields=['chunks', 'updated'])
+
+    return {
+        'status': 'started',
+        'message': 'Price list import started',
+        'chunks': run.chunks,
+        'group_id': result.parent.id if result.parent is not None else None,
+        'callback_id': result.id,
+        'run_id': run.id,
+    }
+
+
+def add_parse_metrics(metrics, report):
+    """Добавляет в показатели импорта этап разбора из счетчиков конвейера"""
+    if report['parse'] and 'parse' not in metrics.phases:
+        metrics.add_phase('parse', report['parse']['seconds'], rows=report['parse']['items'])
+
+
+def complete_import_run(run, stats, errors, metrics, pipeline=None):
+    """
+    Отмечает импорт завершенным, публикует собранную версию каталога
+    и запоминает прайс в магазине. Архив прайса остается для повтора импорта.
+
+    Аргументы:
+        metrics (ImportMetrics): показатели импорта
+        pipeline (dict): счетчики конвейера, по умолчанию сохраненные в run.metrics
+    """
+    pipeline = pipeline or run.metrics.get('pipeline')
+    if pipeline:
+        add_parse_metrics(metrics, pipeline)
+
+    with transaction.atomic():
+        with metrics.phase('publish'):
+            if run.version:
+                publish_catalog_version(run.shop, run.version)
+            if run.url:
+                remember_feed(run.shop, run.url, FetchedFeed(
+                    sha256=run.feed_hash, etag=run.feed_etag, last_modified=run.feed_last_modified))
+            else:
+                # загруженный файл: адрес магазина остается, но его валидаторы больше не описывают каталог
+                remember_feed(run.shop, run.shop.url, FetchedFeed(sha256=run.feed_hash))
+        run.status = 'success'
+        run.stats = stats
+        run.errors = errors
+        run.finished = timezone.now()
+        metrics.stop()
+        run.metrics = dict(
+            metrics.as_dict(rows=stats['goods'], seconds=(run.finished - run.created).total_seconds()),
+            pipeline=pipeline,
+        )
+        run.save(update_fields=['status', 'stats', 'errors', 'metrics', 'finished', 'updated'])
+
+
+@shared_task(bind=True)
+def import_price_chunk(self, shop_id, path, version=None):
+    """Импортирует одну часть прайса, подготовленную update_partner_price, в версию каталога version"""
+    try:
+        importer = PriceImporter(Shop.objects.get(id=shop_id), version=version)
+        with transaction.atomic():
+            for batch in batched(read_price_chunk(path), importer.batch_size):
+                importer.import_goods(batch)
+        importer.metrics.stop()
+        return dict(importer.stats, metrics=importer.metrics.as_dict())
 
     except Exception as e:
-        self.retry(exc=e, countdown=60, max_retries=3)
+        self.retry(exc=e, countdown=10, max_retries=3)
+
+
+@shared_task
+def fail_price_import(request, exc, traceback, run_id, paths):
+    """
+    Обработчик ошибки параллельного импорта: вызывается, если часть исчерпала
+    повторы или упал finish_price_import. Отмечает импорт неудачным,
+    удаляет файлы частей и снимает блокировку магазина.
+    """
+    ImportRun.objects.filter(id=run_id, finished__isnull=True).update(
+        status='failed', error=str(exc), finished=timezone.now())
+    for path in paths:
+        default_storage.delete(path)
+    run = ImportRun.objects.filter(id=run_id).first()
+    if run is not None:
+        release_price_import_lock(run.shop_id, run.task_id)
+
+
+@shared_task
+def finish_price_import(results, run_id, stale, paths, header_stats, errors):
+    """
+    Завершает параллельный импорт: снимает с продажи пропавшие товары,
+    запоминает прайс в магазине и удаляет файлы частей.
+    """
+    run = ImportRun.objects.select_related('shop').get(id=run_id)
+    importer = PriceImporter(run.shop, version=run.version)
+    importer.metrics.merge(run.metrics)
+    for chunk_stats in results:
+        importer.metrics.merge(chunk_stats['metrics'])
+    with transaction.atomic(), importer.metrics.phase('retire'):
+        importer.retire(stale)
+
+    stats = dict(header_stats)
+    for chunk_stats in results + [importer.stats]:
+        for key in ('goods', 'inserted', 'updated', 'unchanged', 'removed', 'invalid'):
+            stats[key] += chunk_stats[key]
+
+    run.offset = stats['goods']
+    run.save(update_fields=['offset', 'updated'])
+    complete_import_run(run, stats, errors, importer.metrics)
+
+    for path in paths:
+        default_storage.delete(path)
+    release_price_import_lock(run.shop_id, run.task_id)
+
+    return {
+        'status': 'success',
+        'message': 'Price list updated',
+        'stats': stats,
+        'errors': errors,
+        'run_id': run.id,
+        'metrics': run.metrics,
+    }
 
 
 @shared_task
@@ -1,4 +1,5 @@
 import os
+import threading
 import pytest
 from django import setup
 from django.contrib.auth import get_user_model
@@ -124,3 +125,16 @@ def create_order_item(create_order, create_product):
         quantity=5
     )
     return order_item
+
+@pytest.fixture
+def shop_server():
+    """Фикстура тестового сервера прайсов shop_server.py, возвращает его адрес"""
+    from werkzeug.serving import make_server
+    from shop_server import app
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    thread.join()
@@ -0,0 +1,1057 @@
+from datetime import timedelta
+import gzip
+from io import BytesIO, RawIOBase, StringIO
+from itertools import islice
+from json import loads as load_json
+
+import pytest
+from django.conf import settings
+from django.core.management import call_command
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from yaml import dump as dump_yaml, load as load_yaml, Loader
+
+from backend.archive import open_price_feed, purge_price_feed_archive
+from backend.celery_app import app as celery_app
+from backend.feedgen import generate_price_feed, write_price_feed
+from backend.feeds import detect_feed_format, read_price_feed, PriceFeedError
+from backend.fetcher import fetch_price_feed, FeedTooLarge
+from backend.facets import bitmap_ids, count_facets, decode_bitmap, encode_bitmap, ids_bitmap, select_offers, \
+    selection_ids
+from backend.catalog import create_catalog_version, publish_catalog_version, rollback_catalog_version
+from backend.importer import PriceImporter, stage_price_chunks
+from backend.loaders import CopyLoader, OrmLoader, get_loader
+from backend.metrics import ImportMetrics
+from backend.pipeline import PricePipeline
+from backend.preview import preview_price_feed
+from backend.validation import GoodsValidator
+from backend.models import CatalogEntry, Category, ImportBatch, ImportRun, Order, OrderItem, Parameter, Product, \
+    ProductInfo, ProductParameter, Shop
+from django.core.cache import cache
+from django.urls import reverse
+from django.utils import timezone
+
+from backend.tasks import fail_price_import, price_import_lock_key, preview_partner_price, schedule_price_refresh, \
+    start_price_import, update_partner_price
+
+
+def make_price(goods_count, shop='Test Shop'):
+    """Собирает прайс в формате data/shop.yaml с заданным числом товаров"""
+    return {
+        'shop': shop,
+        'categories': [{'id': 1, 'name': 'Смартфоны'}, {'id': 2, 'name': 'Планшеты'}],
+        'goods': [
+            {
+                'id': 1000 + index,
+                'category': 1 + index % 2,
+                'model': f'model/{index}',
+                'name': f'Товар {index}',
+                'price': 100 + index,
+                'price_rrc': 150 + index,
+                'quantity': index,
+                'parameters': {'Цвет': 'черный', 'Память (Гб)': 64 + index},
+            }
+            for index in range(goods_count)
+        ],
+    }
+
+
+@pytest.fixture(autouse=True)
+def media_root(settings, tmp_path):
+    """Архив прайсов и части импорта пишутся во временный каталог"""
+    settings.MEDIA_ROOT = str(tmp_path)
+
+
+class EndlessPriceStream(RawIOBase):
+    """Поток YAML-прайса с бесконечным разделом goods"""
+
+    def __init__(self):
+        self.buffer = 'shop: Test Shop\ncategories:\n  - id: 1\n    name: Смартфоны\ngoods:\n'.encode()
+        self.index = 0
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.buffer) < len(b):
+            self.buffer += (
+                f'  - id: {self.index}\n    category: 1\n    model: m/{self.index}\n    name: Товар {self.index}\n'
+                f'    price: 100\n    price_rrc: 120\n    quantity: 1\n    parameters:\n      Цвет: черный\n'
+            ).encode()
+            self.index += 1
+        size = len(b)
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        self.bytes_read += size
+        return size
+
+
+def test_read_price_feed_matches_yaml_load():
+    """Потоковое чтение дает тот же результат, что и загрузка YAML целиком"""
+    for name in ('shop.yaml', 'shop1.yaml'):
+        path = settings.BASE_DIR / 'data' / name
+        with open(path, encoding='utf-8') as f:
+            expected = load_yaml(f, Loader=Loader)
+        with open(path, 'rb') as f:
+            feed = read_price_feed(f)
+            assert feed['shop'] == expected['shop']
+            assert feed['categories'] == expected['categories']
+            assert list(feed['goods']) == expected['goods']
+
+
+def test_read_price_feed_is_lazy():
+    """Товары читаются из потока по мере обхода, а не целиком"""
+    stream = EndlessPriceStream()
+    feed = read_price_feed(stream)
+
+    goods = list(islice(feed['goods'], 3))
+
+    assert feed['shop'] == 'Test Shop'
+    assert [item['id'] for item in goods] == [0, 1, 2]
+    assert goods[0]['parameters'] == {'Цвет': 'черный'}
+    assert stream.bytes_read < 64 * 1024
+
+
+def dump_price_feed(data, feed_format, compress=False):
+    """Записывает прайс в байты в заданном формате, при compress - сжатым gzip"""
+    stream = StringIO()
+    write_price_feed(stream, data, feed_format)
+    content = stream.getvalue().encode()
+    return gzip.compress(content) if compress else content
+
+
+@pytest.mark.parametrize('feed_format', ['yaml', 'csv', 'jsonl'])
+@pytest.mark.parametrize('compress', [False, True])
+def test_read_price_feed_formats(feed_format, compress):
+    """CSV, JSON Lines и сжатые gzip прайсы определяются по первым байтам и дают ту же схему товаров"""
+    data = make_price(20)
+    feed = read_price_feed(BytesIO(dump_price_feed(data, feed_format, compress)))
+    goods = list(feed['goods'])
+
+    assert feed['shop'] == data['shop']
+    assert feed['categories'] == data['categories']
+    # в CSV значения параметров - строки, импорт все равно хранит их строками
+    assert [dict(item, parameters={name: str(value) for name, value in item['parameters'].items()})
+            for item in goods] == [
+        dict(item, parameters={name: str(value) for name, value in item['parameters'].items()})
+        for item in data['goods']
+    ]
+    assert len(GoodsValidator([1, 2]).filter(goods, 0)) == 20
+
+
+def test_detect_feed_format_prefers_content_type():
+    """Известный Content-Type важнее первых байтов, неизвестный не мешает определению по ним"""
+    assert detect_feed_format(b'#shop,Test', 'application/x-ndjson; charset=utf-8') == 'jsonl'
+    assert detect_feed_format(b'\xef\xbb\xbf#shop,Test', 'application/octet-stream') == 'csv'
+    assert detect_feed_format(b'  {"shop": "Test"}') == 'jsonl'
+    assert detect_feed_format(b'shop: Test') == 'yaml'
+
+
+def test_read_price_feed_rejects_broken_feeds():
+    """Некорректные CSV и JSON Lines отклоняются как PriceFeedError"""
+    with pytest.raises(PriceFeedError):
+        read_price_feed(BytesIO(b'#shop,Test\nid,name\n1,x\n'))
+    feed = read_price_feed(BytesIO(b'{"shop": "Test", "categories": []}\n{broken\n'))
+    with pytest.raises(PriceFeedError):
+        list(feed['goods'])
+
+
+@pytest.mark.parametrize('content', [
+    b'{"categories": []}\n{"id": 1}\n',
+    b'{"shop": "Test"}\n{"id": 1}\n',
+    b'{"shop": " ", "categories": []}\n',
+    b'#category,1,Phones\nid,category,model,name,price,price_rrc,quantity\n',
+    b'shop: Test\ncategories:\n  - id: 1\ngoods: []\n',
+])
+def test_read_price_feed_rejects_broken_header(content):
+    """Заголовок без shop или с неверными categories отклоняется как PriceFeedError, а не при импорте"""
+    with pytest.raises(PriceFeedError):
+        read_price_feed(BytesIO(content))
+
+
+@pytest.mark.django_db
+def test_price_pipeline_imports_compressed_csv(create_shop):
+    """Сжатый CSV-прайс импортируется через тот же конвейер, что и YAML"""
+    data = make_price(30)
+    path = default_storage.save('price_feeds/test.feed', ContentFile(dump_price_feed(data, 'csv', compress=True)))
+
+    with PricePipeline(path, batch_size=10, use_process=False, content_type='application/gzip') as pipeline:
+        stats = PriceImporter(create_shop, batch_size=10).run(pipeline.data)
+
+    assert stats['inserted'] == 30
+    info = ProductInfo.objects.get(shop=create_shop, external_id=1005)
+    assert info.price == 105
+    assert {param.parameter.name: param.value for param in info.product_params.all()} == {
+        'Цвет': 'черный', 'Память (Гб)': '69'}
+
+
+@pytest.mark.django_db
+def test_import_shop_yaml(create_shop):
+    """Тест импорта прайса из data/shop.yaml"""
+    with open(settings.BASE_DIR / 'data' / 'shop.yaml', encoding='utf-8') as f:
+        data = load_yaml(f, Loader=Loader)
+
+    with open(settings.BASE_DIR / 'data' / 'shop.yaml', 'rb') as f:
+        stats = PriceImporter(create_shop).run(read_price_feed(f))
+
+    create_shop.refresh_from_db()
+    assert create_shop.name == data['shop']
+    assert stats['goods'] == len(data['goods'])
+    assert ProductInfo.objects.filter(shop=create_shop).count() == len(data['goods'])
+    assert set(create_shop.categories.values_list('id', flat=True)) == {c['id'] for c in data['categories']}
+
+    item = data['goods'][0]
+    product_info = ProductInfo.objects.get(shop=create_shop, external_id=item['id'])
+    assert product_info.price == item['price']
+    params = dict(product_info.product_params.values_list('parameter__name', 'value'))
+    assert params == {name: str(value) for name, value in item['parameters'].items()}
+
+
+@pytest.mark.django_db
+def test_import_writes_product_attributes(create_shop):
+    """Импорт пишет копию параметров в attributes, в том числе у предложений, скопированных в новую версию"""
+    PriceImporter(create_shop).run(make_price(3))
+    info = ProductInfo.objects.get(shop=create_shop, external_id=1000)
+    assert info.attributes == [
+        {'parameter': name, 'value': value}
+        for name, value in info.product_params.order_by('id').values_list('parameter__name', 'value')
+    ]
+
+    data = make_price(3)
+    data['goods'][1]['parameters']['Цвет'] = 'белый'
+    PriceImporter(create_shop).run(data)
+
+    offers = {offer.external_id: offer for offer in ProductInfo.objects.published().filter(shop=create_shop)}
+    assert offers[1000].attributes == info.attributes
+    assert {'parameter': 'Цвет', 'value': 'белый'} in offers[1001].attributes
+    assert CatalogEntry.objects.get(product_info=offers[1001]).parameters == offers[1001].attributes
+
+
+@pytest.mark.django_db
+def test_import_query_count_does_not_grow_with_rows(create_shop):
+    """Число запросов зависит от числа пачек, а не от числа товаров"""
+    with CaptureQueriesContext(connection) as small:
+        PriceImporter(create_shop, batch_size=500).run(make_price(10))
+    with CaptureQueriesContext(connection) as large:
+        PriceImporter(create_shop, batch_size=500).run(make_price(300))
+
+    # SQLite делит bulk_create на INSERT по 999 параметров: идущие подряд INSERT в одну таблицу
+    # считаются одним запросом, как в PostgreSQL
+    def count(context):
+        statements = [query['sql'].split('(')[0] for query in context.captured_queries]
+        return sum(not (sql.startswith('INSERT') and sql == previous)
+                   for previous, sql in zip([None, *statements], statements))
+
+    assert count(large) <= count(small) + 2
+    assert ProductInfo.objects.filter(shop=create_shop).count() == 300
+    assert ProductParameter.objects.filter(product_info__shop=create_shop).count() == 600
+    assert Category.objects.filter(shops=create_shop).count() == 2
+
+
+@pytest.mark.django_db
+def test_reimport_unchanged_price_touches_nothing(create_shop):
+    """Повторный импорт того же прайса не изменяет строки"""
+    PriceImporter(create_shop).run(make_price(20))
+    ids = set(ProductInfo.objects.filter(shop=create_shop).values_list('id', flat=True))
+
+    stats = PriceImporter(create_shop).run(make_price(20))
+
+    assert stats['inserted'] == 0
+    assert stats['updated'] == 0
+    assert stats['unchanged'] == 20
+    assert stats['removed'] == 0
+    assert set(ProductInfo.objects.filter(shop=create_shop).values_list('id', flat=True)) == ids
+
+
+@pytest.mark.django_db
+def test_delta_import_keeps_ordered_items(create_shop, create_order):
+    """Дельта-импорт обновляет изменения и снимает пропавшие товары, не трогая заказы"""
+    PriceImporter(create_shop).run(make_price(5))
+    dropped = ProductInfo.objects.get(shop=create_shop, external_id=1004)
+    order_item = OrderItem.objects.create(order=create_order, product_info=dropped, quantity=1)
+
+    data = make_price(4)
+    data['goods'][0]['price'] = 999
+    data['goods'][1]['parameters']['Цвет'] = 'белый'
+    data['goods'].append(dict(data['goods'][3], id=2000, name='Новый товар'))
+
+    stats = PriceImporter(create_shop).run(data)
+
+    assert stats == {
+        'categories': 2, 'goods': 5, 'inserted': 1, 'updated': 2, 'unchanged': 2, 'removed': 1, 'invalid': 0,
+    }
+    assert ProductInfo.objects.get(shop=create_shop, external_id=1000).price == 999
+    assert ProductParameter.objects.get(
+        product_info__external_id=1001, parameter__name='Цвет').value == 'белый'
+    dropped.refresh_from_db()
+    assert dropped.is_active is False
+    assert OrderItem.objects.filter(id=order_item.id).exists()
+
+    # товар, вернувшийся в прайс, снова поступает в продажу
+    stats = PriceImporter(create_shop).run(make_price(5))
+    dropped.refresh_from_db()
+    assert dropped.is_active is True
+    assert stats['removed'] == 1
+
+
+@pytest.mark.django_db
+def test_invalid_rows_are_set_aside(create_shop):
+    """Строки с ошибками откладываются с причинами, остальные импортируются"""
+    PriceImporter(create_shop).run(make_price(6))
+    data = make_price(6)
+    del data['goods'][1]['price_rrc']
+    data['goods'][2]['category'] = 99
+    data['goods'][3]['price'] = 'дорого'
+    data['goods'][4] = 'не товар'
+
+    importer = PriceImporter(create_shop, batch_size=2)
+    stats = importer.run(data)
+
+    assert stats['goods'] == 6
+    assert stats['invalid'] == 4
+    assert stats['unchanged'] == 2
+    # товар 1004 заменен строкой без ИД и снимается с продажи
+    assert stats['removed'] == 1
+    assert importer.errors == [
+        {'row': 2, 'id': 1001, 'errors': ['price_rrc: обязательное поле']},
+        {'row': 3, 'id': 1002, 'errors': ['category: неизвестная категория 99']},
+        {'row': 4, 'id': 1003, 'errors': ['price: должно быть целым числом']},
+        {'row': 5, 'id': None, 'errors': ['товар должен быть словарем']},
+    ]
+    # у отложенных строк с известным ИД в каталоге остаются прежние предложения
+    assert ProductInfo.objects.filter(shop=create_shop, is_active=True).count() == 5
+    assert ProductInfo.objects.get(shop=create_shop, external_id=1003).price == 103
+
+
+@pytest.mark.django_db
+def test_update_partner_price_skips_unmodified_feed(create_shop, shop_server):
+    """Повторная загрузка неизмененного прайса пропускает импорт"""
+    url = f'{shop_server}/download_shop_yaml'
+
+    result = update_partner_price.apply(kwargs={'shop_id': create_shop.id, 'url': url}).get()
+    assert result['status'] == 'success'
+    assert result['stats']['inserted'] == ProductInfo.objects.filter(shop=create_shop).count()
+    assert result['pipeline']['write']['items'] == result['stats']['goods']
+
+    create_shop.refresh_from_db()
+    assert create_shop.url == url
+    assert create_shop.feed_etag
+    assert len(create_shop.feed_hash) == 64
+
+    # сервер отвечает 304 на условный запрос
+    result = update_partner_price.apply(kwargs={'shop_id': create_shop.id, 'url': url}).get()
+    assert result['status'] == 'skipped'
+
+    # без валидаторов прайс пропускается по совпадению хэша
+    Shop.objects.filter(id=create_shop.id).update(feed_etag='', feed_last_modified='')
+    result = update_partner_price.apply(kwargs={'shop_id': create_shop.id, 'url': url}).get()
+    assert result['status'] == 'skipped'
+
+    result = update_partner_price.apply(kwargs={'shop_id': create_shop.id, 'url': url, 'force': True}).get()
+    assert result['status'] == 'success'
+    assert result['stats']['unchanged'] == result['stats']['goods']
+
+
+@pytest.mark.django_db
+def test_nested_metrics_phases_are_exclusive():
+    """Время и запросы вложенного этапа не учитываются в объемлющем"""
+    metrics = ImportMetrics()
+    with connection.cursor() as cursor, metrics.phase('stage'):
+        cursor.execute('SELECT 1')
+        with metrics.phase('validate'):
+            cursor.execute('SELECT 1')
+            cursor.execute('SELECT 2')
+
+    data = metrics.as_dict()
+    assert data['phases']['stage']['queries'] == 1
+    assert data['phases']['validate']['queries'] == 2
+    assert data['queries'] == 3
+    assert data['peak_rss_kb'] >= data['rss_growth_kb'] >= 0
+
+
+@pytest.mark.django_db
+def test_import_records_metrics(api_client, create_shop, shop_server, settings, tmp_path):
+    """Импорт сохраняет время и запросы по этапам, скорость и пик памяти"""
+    settings.MEDIA_ROOT = str(tmp_path)
+    result = update_partner_price.apply(
+        kwargs={'shop_id': create_shop.id, 'url': f'{shop_server}/download_shop_yaml'}, task_id='metrics-task').get()
+
+    metrics = ImportRun.objects.get(id=result['run_id']).metrics
+    assert result['metrics'] == metrics
+    assert set(metrics['phases']) >= {'fetch', 'archive', 'version', 'header', 'parse', 'validate', 'resolve',
+                                      'write', 'checkpoint', 'retire', 'publish'}
+    assert metrics['rows'] == metrics['phases']['write']['rows'] == result['stats']['goods']
+    assert metrics['queries'] == sum(phase['queries'] for phase in metrics['phases'].values())
+    assert metrics['phases']['write']['queries'] > 0
+    assert metrics['rows_per_second'] > 0
+    assert metrics['peak_rss_kb'] > 0
+    assert 0 <= metrics['rss_growth_kb'] < metrics['peak_rss_kb']
+    assert metrics['pipeline']['mode'] == result['pipeline']['mode']
+
+    response = api_client.get(reverse('backend:task-status'), {'task_id': 'metrics-task'})
+    assert response.json()['import_run']['metrics']['rows'] == metrics['rows']
+
+
+@pytest.mark.django_db
+def test_fetch_price_feed_size_limit(create_shop, shop_server, settings):
+    """Прайс больше PRICE_FEED_MAX_BYTES не загружается"""
+    settings.PRICE_FEED_MAX_BYTES = 100
+
+    with pytest.raises(FeedTooLarge):
+        fetch_price_feed(create_shop, f'{shop_server}/download_shop_yaml')
+
+
+@pytest.fixture
+def celery_eager(monkeypatch):
+    """Фикстура для синхронного выполнения задач Celery"""
+    monkeypatch.setattr(celery_app.conf, 'task_always_eager', True)
+    monkeypatch.setattr(celery_app.conf, 'task_eager_propagates', True)
+
+
+@pytest.mark.django_db
+def test_update_partner_price_fans_out_chunks(create_shop, shop_server, settings, tmp_path, celery_eager):
+    """Большой прайс импортируется частями в группе задач"""
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.PRICE_IMPORT_CHUNK_SIZE = 3
+    PriceImporter(create_shop).run(make_price(2))
+
+    result = update_partner_price.delay(shop_id=create_shop.id, url=f'{shop_server}/download_shop_yaml').get()
+
+    assert result['status'] == 'started'
+    assert result['chunks'] == 3
+    assert ProductInfo.objects.published().filter(shop=create_shop, is_active=True).count() == 7
+    assert ProductInfo.objects.published().filter(shop=create_shop, is_active=False).count() == 2
+    # показатели частей складываются в показатели запуска
+    assert ImportRun.objects.get(id=result['run_id']).metrics['phases']['write']['rows'] == 7
+    create_shop.refresh_from_db()
+    assert create_shop.feed_hash
+    assert not list(tmp_path.rglob('*.jsonl'))
+
+
+@pytest.mark.django_db
+def test_failed_chunked_import_is_cleaned_up(create_shop, tmp_path):
+    """Ошибка части отмечает импорт неудачным, удаляет части и снимает блокировку"""
+    goods = make_price(5)['goods']
+    paths = stage_price_chunks(goods, 'price_imports/1', 2)['paths']
+    # повтор раскладки перезаписывает те же файлы
+    assert stage_price_chunks(goods, 'price_imports/1', 2)['paths'] == paths
+    assert len(list(tmp_path.rglob('*.jsonl'))) == 3
+
+    run = ImportRun.objects.create(shop=create_shop, task_id='chunked-task', chunks=3)
+    cache.set(price_import_lock_key(create_shop.id), 'chunked-task')
+
+    fail_price_import(None, RuntimeError('chunk failed'), None, run.id, paths)
+
+    run.refresh_from_db()
+    assert run.status == 'failed'
+    assert run.error == 'chunk failed'
+    assert run.finished is not None
+    assert not list(tmp_path.rglob('*.jsonl'))
+    assert cache.get(price_import_lock_key(create_shop.id)) is None
+
+
+@pytest.mark.django_db
+def test_import_resumes_from_checkpoint(create_shop, monkeypatch):
+    """Повтор импорта после сбоя продолжает с последней записанной пачки"""
+    run = ImportRun.objects.create(shop=create_shop, task_id='resume')
+    import_goods = PriceImporter.import_goods
+    calls = []
+    failed = []
+
+    def failing_import_goods(self, goods):
+        calls.append([item['id'] for item in goods])
+        if len(calls) == 2 and not failed:
+            failed.append(True)
+            raise RuntimeError('Сбой базы')
+        import_goods(self, goods)
+
+    monkeypatch.setattr(PriceImporter, 'import_goods', failing_import_goods)
+    with pytest.raises(RuntimeError):
+        PriceImporter(create_shop, batch_size=4, checkpoint=run).run(make_price(10))
+
+    run.refresh_from_db()
+    assert run.offset == 4
+    assert ProductInfo.objects.filter(shop=create_shop).count() == 4
+
+    calls.clear()
+    stats = PriceImporter(create_shop, batch_size=4, checkpoint=run).run(make_price(10))
+
+    # первая пачка не записывается повторно
+    assert calls == [[1004, 1005, 1006, 1007], [1008, 1009]]
+    assert stats['goods'] == 10
+    assert stats['inserted'] == 10
+    assert stats['removed'] == 0
+    assert ProductInfo.objects.filter(shop=create_shop, is_active=True).count() == 10
+    run.refresh_from_db()
+    assert run.offset == 10
+
+
+@pytest.mark.django_db
+def test_update_partner_price_retry_uses_stored_feed(create_shop, settings, tmp_path):
+    """Повтор задачи читает сохраненный прайс и не загружает его заново"""
+    settings.MEDIA_ROOT = str(tmp_path)
+    data = make_price(6)
+    PriceImporter(create_shop, batch_size=2).run(dict(data, goods=data['goods'][:2]))
+    path = default_storage.save('price_feeds/test.feed', ContentFile(dump_yaml(data, allow_unicode=True, sort_keys=False).encode()))
+    ImportRun.objects.create(shop=create_shop, task_id='retry-task', url='http://unreachable.invalid/shop.yaml',
+                             feed_hash='0' * 64, feed_path=path, offset=2, status='failed')
+
+    result = update_partner_price.apply(
+        kwargs={'shop_id': create_shop.id, 'url': 'http://unreachable.invalid/shop.yaml'}, task_id='retry-task').get()
+
+    assert result['status'] == 'success'
+    run = ImportRun.objects.get(task_id='retry-task')
+    assert run.status == 'success'
+    assert run.offset == 6
+    assert run.finished is not None
+    assert ProductInfo.objects.filter(shop=create_shop).count() == 6
+    create_shop.refresh_from_db()
+    assert create_shop.feed_hash == '0' * 64
+    # архив прайса сохраняется для повтора импорта
+    assert default_storage.exists(path)
+
+
+@pytest.mark.django_db
+def test_replay_price_import_from_archive(create_shop, shop_server, settings, tmp_path, monkeypatch):
+    """Импорт повторяется из сжатого архива прайса без обращения к поставщику"""
+    settings.MEDIA_ROOT = str(tmp_path)
+    result = update_partner_price.apply(kwargs={'shop_id': create_shop.id, 'url': f'{shop_server}/download_shop_yaml'}).get()
+    run = ImportRun.objects.get(id=result['run_id'])
+
+    assert run.feed_path == f'price_feeds/{run.feed_hash}.gz'
+    assert run.feed_size == default_storage.size(run.feed_path)
+    create_shop.refresh_from_db()
+    with open_price_feed(run.feed_path) as f:
+        assert read_price_feed(f)['shop'] == create_shop.name
+
+    def offline(*args, **kwargs):
+        raise AssertionError('replay must not fetch the price list')
+
+    monkeypatch.setattr('backend.tasks.fetch_price_feed', offline)
+    call_command('replay_price_import', run.id, stdout=StringIO())
+
+    replay = ImportRun.objects.exclude(id=run.id).get()
+    assert replay.status == 'success'
+    assert replay.feed_path == run.feed_path
+    assert replay.version > run.version
+    assert replay.stats['unchanged'] == replay.stats['goods'] == result['stats']['goods']
+    create_shop.refresh_from_db()
+    assert create_shop.catalog_version == replay.version
+
+
+@pytest.mark.django_db
+def test_purge_price_feed_archive(create_shop, settings, tmp_path):
+    """Очистка архива удаляет старые прайсы и прайсы сверх объема, кроме незавершенных импортов"""
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.PRICE_FEED_ARCHIVE_DAYS = 30
+    settings.PRICE_FEED_ARCHIVE_MAX_BYTES = 250
+    runs = {}
+    for name, status, age in [('new', 'success', 0), ('big', 'success', 1), ('old', 'success', 40),
+                              ('running', 'running', 50)]:
+        path = default_storage.save(f'price_feeds/{name}.yaml.gz', ContentFile(b'x' * 100))
+        runs[name] = ImportRun.objects.create(shop=create_shop, feed_path=path, feed_size=100, status=status)
+        ImportRun.objects.filter(id=runs[name].id).update(created=timezone.now() - timedelta(days=age))
+
+    deleted = purge_price_feed_archive()
+
+    # running и new занимают 200 байт, big уже не помещается, old старше срока
+    assert set(deleted) == {runs['big'].feed_path, runs['old'].feed_path}
+    assert default_storage.exists(runs['new'].feed_path)
+    assert default_storage.exists(runs['running'].feed_path)
+    assert not default_storage.exists(runs['old'].feed_path)
+    assert ImportRun.objects.get(id=runs['old'].id).feed_path == ''
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('use_process', [False, True])
+def test_price_pipeline(create_shop, settings, tmp_path, use_process):
+    """Конвейер отдает прайс целиком и считает скорость и простой этапов"""
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.PRICE_IMPORT_QUEUE_SIZE = 2
+    data = make_price(50)
+    path = default_storage.save('price_feeds/test.feed', ContentFile(dump_yaml(data, allow_unicode=True, sort_keys=False).encode()))
+
+    with PricePipeline(path, batch_size=10, use_process=use_process) as pipeline:
+        assert pipeline.data['shop'] == data['shop']
+        assert pipeline.data['categories'] == data['categories']
+        stats = PriceImporter(create_shop, batch_size=10).run(pipeline.data)
+
+    report = pipeline.report()
+    assert stats['inserted'] == 50
+    assert report['mode'] == ('process' if use_process else 'thread')
+    assert report['read']['items'] == default_storage.size(path)
+    assert report['parse']['items'] == 50
+    assert report['write']['items'] == 50
+    for stage in ('read', 'parse', 'write'):
+        assert set(report[stage]) >= {'items', 'seconds', 'rate', 'input_wait', 'output_wait'}
+    # пик памяти процесса разбора относится только к этому импорту
+    assert ('peak_rss_kb' in report['parse']) == use_process
+
+
+def test_price_pipeline_reports_feed_errors(settings, tmp_path):
+    """Ошибка разбора в конвейере доходит до этапа записи как PriceFeedError"""
+    settings.MEDIA_ROOT = str(tmp_path)
+    path = default_storage.save('price_feeds/broken.feed', ContentFile(b'- not a mapping\n'))
+
+    with pytest.raises(PriceFeedError):
+        with PricePipeline(path):
+            pass
+
+
+@pytest.mark.django_db
+def test_duplicate_import_collapses_into_running_one(create_shop):
+    """Повторный запуск импорта магазина возвращает ИД идущей задачи"""
+    cache.set(price_import_lock_key(create_shop.id), 'running-task')
+
+    task_id, started = start_price_import(create_shop, 'http://unreachable.invalid/shop.yaml')
+    assert (task_id, started) == ('running-task', False)
+
+    result = update_partner_price.apply(
+        kwargs={'shop_id': create_shop.id, 'url': 'http://unreachable.invalid/shop.yaml'}, task_id='other-task').get()
+    assert result == {'status': 'duplicate', 'message': 'Price list import already running', 'task_id': 'running-task'}
+    assert not ImportRun.objects.filter(task_id='other-task').exists()
+
+
+@pytest.mark.django_db
+def test_import_batch(api_client, create_test_user, shop_server, celery_eager):
+    """Пакетный импорт запускает все магазины и отдает общий статус"""
+    create_test_user.is_staff = True
+    create_test_user.save()
+    api_client.force_authenticate(create_test_user)
+    url = f'{shop_server}/download_shop_yaml'
+    shops = [Shop.objects.create(name=f'Shop {index}', url=url) for index in range(3)]
+    no_url = Shop.objects.create(name='Без прайса')
+
+    response = api_client.post(reverse('backend:partner-update-batch'), {
+        'shops': [str(shops[0].id)] + [shop.id for shop in shops[1:]] + [no_url.id], 'concurrency': 2,
+    }, format='json')
+
+    assert response.status_code == 202
+    assert response.json()['Shops'] == [shop.id for shop in shops]
+    assert response.json()['Skipped'] == [no_url.id]
+    batch = ImportBatch.objects.get(id=response.json()['BatchID'])
+    assert batch.concurrency == 2
+    assert batch.pending == []
+    for shop in shops:
+        assert ProductInfo.objects.filter(shop=shop).exists()
+        assert cache.get(price_import_lock_key(shop.id)) is None
+
+    response = api_client.get(reverse('backend:partner-update-batch'), {'batch_id': batch.id})
+    assert response.status_code == 200
+    assert response.json()['finished'] is True
+    assert response.json()['counts'] == {'success': 3}
+
+    response = api_client.post(reverse('backend:partner-update-batch'), {'shops': ['один']}, format='json')
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_schedule_price_refresh(shop_server, celery_eager):
+    """Плановое обновление импортирует прайсы магазинов по расписанию и пропускает неизмененные"""
+    url = f'{shop_server}/download_shop_yaml'
+    due = Shop.objects.create(name='По расписанию', url=url, refresh_interval=60)
+    Shop.objects.create(name='Без расписания', url=url)
+    later = Shop.objects.create(name='Позже', url=url, refresh_interval=60,
+                                next_refresh_at=timezone.now() + timedelta(minutes=30))
+
+    result = schedule_price_refresh.apply().get()
+
+    assert result == {'status': 'success', 'due': 1, 'started': 1}
+    due.refresh_from_db()
+    assert due.feed_hash
+    assert due.next_refresh_at > timezone.now() + timedelta(minutes=59)
+    assert not ProductInfo.objects.filter(shop=later).exists()
+
+    # подошло время, но прайс не изменился
+    Shop.objects.filter(id=due.id).update(next_refresh_at=timezone.now())
+    schedule_price_refresh.apply().get()
+    assert ImportRun.objects.filter(shop=due).values_list('status', flat=True)[0] == 'skipped'
+
+
+@pytest.mark.django_db
+def test_copy_loader_falls_back_to_orm(create_shop, settings):
+    """Загрузчик COPY выбирается только на PostgreSQL, иначе используется ORM"""
+    settings.PRICE_IMPORT_LOADER = 'copy'
+    expected = CopyLoader if connection.vendor == 'postgresql' else OrmLoader
+
+    assert isinstance(get_loader(create_shop, 1, 100), expected)
+    stats = PriceImporter(create_shop).run(make_price(10))
+    assert stats['inserted'] == 10
+    assert ProductParameter.objects.filter(product_info__shop=create_shop).count() == 20
+
+
+@pytest.mark.skipif(connection.vendor != 'postgresql', reason='COPY только в PostgreSQL')
+@pytest.mark.django_db
+def test_copy_loader_handles_bigint_ids(create_shop, settings):
+    """Загрузчик COPY пишет предложения и параметры с id больше 2^31"""
+    settings.PRICE_IMPORT_LOADER = 'copy'
+    with connection.cursor() as cursor:
+        for model in (Product, ProductInfo, Parameter):
+            cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), %s)", [model._meta.db_table, 2 ** 31])
+
+    PriceImporter(create_shop).run(make_price(3))
+    data = make_price(3)
+    data['goods'][0]['price'] = 999
+    data['goods'][1]['parameters']['Цвет'] = 'белый'
+    stats = PriceImporter(create_shop).run(data)
+
+    assert stats['updated'] == 2
+    published = ProductInfo.objects.published().filter(shop=create_shop)
+    assert min(published.values_list('id', flat=True)) > 2 ** 31
+    assert published.get(external_id=1000).price == 999
+    assert {'parameter': 'Цвет', 'value': 'белый'} in published.get(external_id=1001).attributes
+
+
+def test_copy_loader_csv_keeps_empty_strings():
+    """Пустая строка передается в COPY в кавычках и не становится NULL"""
+    class Cursor:
+        def copy_expert(self, sql, file):
+            self.sql = sql
+            self.data = file.read()
+
+    cursor = Cursor()
+    CopyLoader.copy(cursor, 'price_import_offers', [(1, 2, '', 100, 120, 3), (4, 5, 'a "b", c', 1, 2, 0)])
+
+    assert cursor.sql == 'COPY price_import_offers FROM STDIN WITH (FORMAT csv)'
+    assert cursor.data == '1,2,"",100,120,3\n4,5,"a ""b"", c",1,2,0\n'
+
+
+@pytest.mark.django_db
+def test_catalog_version_publish_and_rollback(create_shop, create_order):
+    """Импорт пишет в новую версию каталога, публикация и откат переключают указатель"""
+    PriceImporter(create_shop).run(make_price(3))
+    ids = dict(ProductInfo.objects.values_list('external_id', 'id'))
+    basket = Order.objects.create(user=create_order.user, contact=create_order.contact, state='basket')
+    item = OrderItem.objects.create(order=basket, product_info=ProductInfo.objects.get(external_id=1000), quantity=1)
+
+    version = create_catalog_version(create_shop)
+    data = make_price(3)
+    data['goods'][0]['price'] = 999
+    PriceImporter(create_shop, version=version).run(data)
+
+    # до публикации покупатели видят прежнюю версию
+    published = ProductInfo.objects.published().filter(shop=create_shop)
+    assert published.count() == 3
+    assert published.get(external_id=1000).price == 100
+
+    # в новую версию записано только изменившееся предложение
+    assert ProductInfo.objects.filter(shop=create_shop).count() == 4
+
+    publish_catalog_version(create_shop, version)
+    assert (create_shop.catalog_version, create_shop.previous_version) == (version, 1)
+    assert published.get(external_id=1001).id == ids[1001]
+    assert published.get(external_id=1000).id != ids[1000]
+    assert published.get(external_id=1000).price == 999
+    assert published.get(external_id=1001).product_params.count() == 2
+    item.refresh_from_db()
+    assert item.product_info == published.get(external_id=1000)
+
+    assert rollback_catalog_version(create_shop) is True
+    assert published.get(external_id=1000).price == 100
+    item.refresh_from_db()
+    assert item.product_info.version == 1
+
+    # новая версия отменяет ту, с которой откатились
+    publish_catalog_version(create_shop, create_catalog_version(create_shop))
+    assert set(ProductInfo.objects.filter(shop=create_shop).values_list('id', flat=True)) == set(ids.values())
+    assert published.get(external_id=1000).price == 100
+
+
+@pytest.mark.django_db
+def test_catalog_versions_copy_on_write(create_shop):
+    """Версия хранит только изменившиеся строки, замененные строки удаляются после двух публикаций"""
+    PriceImporter(create_shop).run(make_price(3))
+    old_id = ProductInfo.objects.get(external_id=1000).id
+    data = make_price(3)
+    data['goods'][0]['price'] = 999
+    for goods in (data['goods'], data['goods'][:2]):
+        version = create_catalog_version(create_shop)
+        importer = PriceImporter(create_shop, version=version)
+        importer.run(dict(data, goods=goods))
+        publish_catalog_version(create_shop, version)
+
+    assert importer.stats['removed'] == 1
+    assert importer.stats['unchanged'] == 2
+    published = ProductInfo.objects.published().filter(shop=create_shop)
+    assert published.count() == 3
+    assert published.get(external_id=1002).is_active is False
+    assert published.get(external_id=1000).price == 999
+    # строка 1000 первой версии не нужна ни текущей, ни предыдущей версии
+    assert not ProductInfo.objects.filter(id=old_id).exists()
+    assert ProductInfo.objects.filter(shop=create_shop).count() == 4
+
+
+@pytest.mark.django_db
+def test_import_stores_numeric_parameter_values(create_shop):
+    """Числовые значения параметров пишутся в числовой столбец и копируются в новую версию"""
+    PriceImporter(create_shop).run(make_price(2))
+    version = create_catalog_version(create_shop)
+    data = make_price(2)
+    data['goods'][0]['price'] = 999
+    PriceImporter(create_shop, version=version).run(data)
+
+    numbers = ProductParameter.objects.filter(parameter__name='Память (Гб)').values_list(
+        'product_info__version', 'value_number')
+    assert sorted(numbers) == [(1, 64.0), (1, 65.0), (version, 64.0)]
+    assert not ProductParameter.objects.filter(parameter__name='Цвет', value_number__isnull=False).exists()
+
+    ProductParameter.objects.update(value_number=None)
+    call_command('fill_parameter_numbers')
+    assert ProductParameter.objects.filter(value_number__isnull=False).count() == 3
+
+@pytest.mark.django_db
+def test_storefront_follows_published_version(api_client, create_shop):
+    """Витрина повторяет опубликованную версию, каталог читается одним запросом к ней"""
+    PriceImporter(create_shop).run(make_price(3))
+    entries = CatalogEntry.objects.filter(shop=create_shop)
+    assert set(entries.values_list('product_info_id', flat=True)) == set(
+        ProductInfo.objects.published().filter(shop=create_shop).values_list('id', flat=True))
+    entry = entries.get(external_id=1001)
+    assert entry.product_name == 'Товар 1'
+    assert entry.parameters == [{'parameter': 'Цвет', 'value': 'черный'}, {'parameter': 'Память (Гб)', 'value': '65'}]
+
+    version = create_catalog_version(create_shop)
+    data = make_price(3)
+    data['goods'][0]['price'] = 999
+    PriceImporter(create_shop, version=version).run(data)
+    assert entries.get(external_id=1000).price == 100
+    publish_catalog_version(create_shop, version)
+    assert entries.get(external_id=1000).price == 999
+    assert entries.get(external_id=1001).pk == entry.pk
+    rollback_catalog_version(create_shop)
+    assert entries.get(external_id=1000).price == 100
+
+    url = reverse('backend:product-info')
+    with CaptureQueriesContext(connection) as queries:
+        data = api_client.get(url, {'shop_id': create_shop.id}).json()
+    assert len(data['results']) == 3
+    assert data['results'][0]['product_params'][0] == {'parameter': 'Цвет', 'value': 'черный'}
+    tables = {table for query in queries.captured_queries for table in ('productinfo', 'productparameter', 'product"')
+              if f'backend_{table}' in query['sql']}
+    assert not tables
+
+    create_shop.state = False
+    create_shop.save()
+    assert not entries.filter(shop_state=True).exists()
+    assert api_client.get(url).json()['results'] == []
+
+
+@pytest.mark.django_db
+def test_facet_index_follows_storefront(api_client, create_shop):
+    """Индекс фасетов обновляется с витриной, фильтры и числа считаются по битовым картам"""
+    data = make_price(4)
+    data['goods'][3]['parameters']['Цвет'] = 'белый'
+    PriceImporter(create_shop).run(data)
+    total, facets = count_facets()
+    assert total == 4
+    assert facets[1] == {'parameter': 'Цвет', 'values': [{'value': 'черный', 'count': 3}, {'value': 'белый', 'count': 1}]}
+
+    # в новой версии товар 1000 становится белым, 1003 снят с продажи
+    version = create_catalog_version(create_shop)
+    data = make_price(3)
+    data['goods'][0]['parameters']['Цвет'] = 'белый'
+    PriceImporter(create_shop, version=version).run(data)
+    publish_catalog_version(create_shop, version)
+    selected = {'Цвет': {'белый'}}
+    total, facets = count_facets(selected)
+    assert total == 1
+    assert facets[1]['values'] == [{'value': 'черный', 'count': 2}, {'value': 'белый', 'count': 1}]
+    published = ProductInfo.objects.published().filter(shop=create_shop)
+    assert selection_ids(select_offers(selected)) == [published.get(external_id=1000).id]
+
+    # откат возвращает предложения с меньшими id, чем начало битовых карт
+    rollback_catalog_version(create_shop)
+    selected = {'Цвет': {'черный', 'белый'}, 'Память (Гб)': {'64', '67'}}
+    assert sorted(selection_ids(select_offers(selected, shop_id=create_shop.id, category_id=1))) == sorted(
+        published.filter(external_id=1000).values_list('id', flat=True))
+    assert count_facets(selected)[0] == 2
+
+    url = reverse('backend:product-info')
+    data = api_client.get(url, {'param': ['Цвет=белый'], 'page_size': 1, 'count': 'true'}).json()
+    assert data['count'] == 1
+    assert [item['id'] for item in data['results']] == [published.get(external_id=1003).id]
+    response = api_client.get(reverse('backend:product-facets'), {'param': 'Цвет=черный'})
+    assert response.json()['count'] == 3
+    assert api_client.get(url, {'param': 'Цвет'}).status_code == 400
+
+    create_shop.state = False
+    create_shop.save()
+    assert count_facets() == (0, [])
+    create_shop.state = True
+    create_shop.save()
+    assert count_facets()[0] == 4
+
+
+def test_bitmap_ids():
+    """id из битовой карты выбираются возле курсора в обе стороны"""
+    bits = ids_bitmap([1003, 1010, 1017, 1100], base=1000)
+    assert bitmap_ids(bits, 1000) == [1003, 1010, 1017, 1100]
+    assert bitmap_ids(bits, 1000, after=1010, limit=1) == [1017]
+    assert bitmap_ids(bits, 1000, before=1100, reverse=True) == [1017, 1010, 1003]
+    assert decode_bitmap(encode_bitmap(bits)) == bits
+
+
+def test_generate_price_feed():
+    """Синтетический прайс проходит проверку и меняет заданную долю товаров между ревизиями"""
+    data = generate_price_feed(1000, categories=5, parameters=3)
+    stream = StringIO()
+    write_price_feed(stream, data)
+    stream.seek(0)
+    feed = read_price_feed(stream)
+    goods = list(feed['goods'])
+
+    assert len(feed['categories']) == 5
+    assert len(goods) == 1000
+    assert all(len(item['parameters']) == 3 for item in goods)
+    validator = GoodsValidator([category['id'] for category in feed['categories']])
+    assert len(validator.filter(goods, 0)) == 1000
+    assert goods == list(generate_price_feed(1000, categories=5, parameters=3)['goods'])
+
+    previous = list(generate_price_feed(1000, changed=0.2, revision=1)['goods'])
+    current = list(generate_price_feed(1000, changed=0.2, revision=2)['goods'])
+    changed = sum(a != b for a, b in zip(previous, current))
+    assert 150 < changed < 250
+
+
+@pytest.mark.django_db
+def test_benchmark_price_import(tmp_path):
+    """Команда замера импортирует полный и дельта-прайс и сохраняет результаты в JSON"""
+    output = tmp_path / 'benchmark.json'
+    call_command('benchmark_price_import', '--sizes', '50', '--changed', '0.5', '--output', str(output),
+                 stdout=StringIO())
+
+    report = load_json(output.read_text(encoding='utf-8'))
+    result = report['results'][0]
+    assert result['skus'] == 50
+    assert result['full']['stats']['inserted'] == 50
+    assert 0 < result['delta']['stats']['updated'] < 50
+    assert result['delta']['stats']['inserted'] == 0
+    assert result['full']['phases']['write']['rows'] == 50
+    assert not Shop.objects.filter(name='Benchmark 50').exists()
+    assert not list(tmp_path.rglob('*.gz'))
+
+
+@pytest.mark.django_db
+def test_preview_price_feed_does_not_write(create_shop):
+    """Предпросмотр считает изменения прайса относительно каталога и ничего не записывает"""
+    PriceImporter(create_shop).run(make_price(5))
+    data = make_price(6)
+    data['goods'][0]['price'] *= 2
+    data['goods'][1]['quantity'] += 1
+    data['goods'][2]['category'] = 999
+    del data['goods'][3]
+
+    with CaptureQueriesContext(connection) as queries:
+        preview = preview_price_feed(create_shop, data, price_threshold=50)
+
+    writes = ('INSERT', 'UPDATE', 'DELETE')
+    assert not [query for query in queries if query['sql'].lstrip().upper().startswith(writes)]
+    assert preview['goods'] == 5
+    assert (preview['new'], preview['changed'], preview['unchanged']) == (1, 2, 1)
+    assert preview['invalid'] == 1
+    assert preview['removed'] == 1
+    assert preview['samples']['removed'] == [1003]
+    assert preview['price_moves'] == 1
+    assert preview['samples']['price_moves'][0]['percent'] == 100.0
+
+
+@pytest.mark.django_db
+def test_partner_update_dry_run(api_client, create_test_user, create_shop, shop_server, monkeypatch):
+    """PartnerUpdate с dry_run возвращает сводку изменений без импорта"""
+    create_test_user.is_staff = True
+    create_test_user.save()
+    api_client.force_authenticate(create_test_user)
+    calls = []
+    monkeypatch.setattr('backend.views.preview_partner_price.delay',
+                        lambda *args: calls.append(args) or preview_partner_price.apply(args=args))
+
+    response = api_client.post(reverse('backend:partner-update'), {
+        'shop_id': create_shop.id, 'url': f'{shop_server}/download_shop_yaml', 'dry_run': 'true',
+    }, format='json')
+
+    assert response.status_code == 202
+    assert calls == [(create_shop.id, f'{shop_server}/download_shop_yaml', None)]
+    result = preview_partner_price.apply(args=calls[0]).get()
+    assert result['preview']['new'] == result['preview']['goods'] > 0
+    assert not ProductInfo.objects.filter(shop=create_shop).exists()
+    assert not ImportRun.objects.exists()
+
+
+@pytest.mark.django_db
+def test_admin_uploads_price_file(admin_client, create_shop, celery_eager):
+    """Файл прайса из админки сохраняется в архив и импортируется задачей по пути в хранилище"""
+    url = reverse('admin:update_price', args=[create_shop.id])
+    assert b'multipart/form-data' in admin_client.get(url).content
+    response = admin_client.post(url, {}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+    assert response.status_code == 400
+
+    content = dump_price_feed(make_price(10, shop=create_shop.name), 'csv', compress=True)
+    upload = SimpleUploadedFile('price.csv.gz', content, content_type='application/gzip')
+    response = admin_client.post(url, {'feed_file': upload}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data['started'] is True
+    run = ImportRun.objects.get(task_id=data['task_id'])
+    assert run.status == 'success'
+    assert run.url == ''
+    # уже сжатый файл хранится в архиве как есть
+    with default_storage.open(run.feed_path, 'rb') as f:
+        assert f.read() == content
+    assert ProductInfo.objects.published().filter(shop=create_shop).count() == 10
+
+    status = admin_client.get(data['status_url'], HTTP_ACCEPT='application/json').json()
+    assert status['import_run'] == {'id': run.id, 'status': 'success', 'offset': run.offset, 'metrics': run.metrics}
+    assert cache.get(price_import_lock_key(create_shop.id)) is None
+
+
+@pytest.mark.django_db
+def test_partner_stock_update(api_client, create_test_user, create_shop):
+    """Цены и остатки обновляются одним UPDATE на пачку только в опубликованной версии магазина"""
+    create_test_user.type = 'shop'
+    create_test_user.save()
+    create_shop.user = create_test_user
+    create_shop.save()
+    api_client.force_authenticate(create_test_user)
+    PriceImporter(create_shop).run(make_price(5))
+    data = make_price(5)
+    data['goods'][0]['price'] = 500
+    version = create_catalog_version(create_shop)
+    PriceImporter(create_shop, version=version).run(data)
+    publish_catalog_version(create_shop, version)
+    retired = ProductInfo.objects.get(shop=create_shop, external_id=1000, retired_version=version)
+    url = reverse('backend:partner-stock')
+
+    with CaptureQueriesContext(connection) as queries:
+        response = api_client.post(url, [
+            {'external_id': 1000, 'quantity': 7},
+            {'external_id': 1001, 'price': 101},
+            {'external_id': 1002, 'price': 1, 'price_rrc': 2, 'quantity': 3},
+            {'external_id': 9999, 'quantity': 1},
+            {'external_id': 1003, 'quantity': -1},
+            {'external_id': 1004},
+        ], format='json')
+
+    assert response.status_code == 200
+    result = response.json()
+    assert [row['status'] for row in result['results']] == [
+        'updated', 'unchanged', 'updated', 'not_found', 'invalid', 'invalid']
+    assert (result['updated'], result['unchanged'], result['not_found'], result['invalid']) == (2, 1, 1, 2)
+    writes = [query['sql'] for query in queries.captured_queries
+              if query['sql'].startswith(('UPDATE "backend_productinfo"', 'INSERT INTO "backend_productinfo"'))]
+    assert len(writes) == 1
+
+    published = {info.external_id: info for info in ProductInfo.objects.published().filter(shop=create_shop)}
+    assert (published[1000].price, published[1000].quantity) == (500, 7)
+    assert (published[1002].price, published[1002].price_rrc, published[1002].quantity) == (1, 2, 3)
+    retired.refresh_from_db()
+    assert retired.quantity == 0
+
+    response = api_client.post(url, 'external_id,price,price_rrc,quantity\n1003,,,42\n1003,,,43\n',
+                               content_type='text/csv')
+    assert [row['status'] for row in response.json()['results']] == ['invalid', 'updated']
+    assert ProductInfo.objects.published().get(shop=create_shop, external_id=1003).quantity == 43
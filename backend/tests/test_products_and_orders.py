@@ -1,7 +1,11 @@
 import pytest
 from django.urls import reverse
 from rest_framework import status
-from backend.models import Contact, Order
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from backend.models import Category, Contact, Order, Parameter, Product, ProductInfo, ProductParameter
+from backend.pagination import KeysetPagination
+from backend.serializers import ProductInfoSerializer
 from django.core.files.uploadedfile import SimpleUploadedFile
 
 @pytest.mark.django_db
@@ -11,17 +15,186 @@ def test_product_search(api_client, create_product):
     url = reverse('backend:product-info')
     response = api_client.get(url, {'product': 'Test'})
     assert response.status_code == status.HTTP_200_OK
-    assert len(response.json()) > 0
+    assert len(response.json()['results']) > 0
 
     # Проверяем поиск по магазину
     response = api_client.get(url, {'shop_id': create_product.shop.id})
     assert response.status_code == status.HTTP_200_OK
-    assert len(response.json()) > 0
+    assert len(response.json()['results']) > 0
 
     # Проверяем диапазон цен
     response = api_client.get(url, {'price_min': 500, 'price_max': 1500})
     assert response.status_code == status.HTTP_200_OK
-    assert len(response.json()) > 0
+    assert len(response.json()['results']) > 0
+
+@pytest.mark.django_db
+def test_product_info_keyset_pagination(api_client, create_shop):
+    """Каталог отдается страницами по курсору, с count=false число строк не считается"""
+    category = Category.objects.create(name='Смартфоны')
+    for index in range(5):
+        product = Product.objects.create(name=f'Товар {index}', category=category)
+        ProductInfo.objects.create(product=product, shop=create_shop, external_id=index, quantity=1, price=100,
+                                   price_rrc=120)
+    url = reverse('backend:product-info')
+
+    ids = []
+    page_url = f'{url}?page_size=2&count=false'
+    with CaptureQueriesContext(connection) as queries:
+        while page_url:
+            data = api_client.get(page_url).json()
+            assert 'count' not in data
+            ids.extend(item['id'] for item in data['results'])
+            page_url = data['next']
+    assert ids == sorted(ProductInfo.objects.values_list('id', flat=True))
+    assert not any('COUNT(' in query['sql'] and 'productinfo' in query['sql'] for query in queries.captured_queries)
+
+    data = api_client.get(url, {'page_size': 2}).json()
+    assert data['count'] == 5
+    assert len(data['results']) == 2
+
+
+@pytest.mark.django_db
+def test_product_full_text_search(api_client, create_shop):
+    """Поиск находит предложения по названию, модели и значениям параметров"""
+    category = Category.objects.create(name='Смартфоны')
+    color = Parameter.objects.create(name='Цвет')
+    for index, (name, model, value) in enumerate([('Смартфон Apple iPhone XR', 'apple/iphone/xr', 'черный'),
+                                                  ('Смартфон Xiaomi Mi 9', 'xiaomi/mi9', 'синий')]):
+        product = Product.objects.create(name=name, category=category)
+        info = ProductInfo.objects.create(product=product, shop=create_shop, external_id=index, model=model,
+                                          quantity=1, price=100, price_rrc=120)
+        ProductParameter.objects.create(product_info=info, parameter=color, value=value)
+    url = reverse('backend:product-search')
+
+    def search(text):
+        return [item['model'] for item in api_client.get(url, {'q': text}).json()['results']]
+
+    assert search('iPhone') == ['apple/iphone/xr']
+    assert search('xiaomi/mi9') == ['xiaomi/mi9']
+    assert search('смартфон синий') == ['xiaomi/mi9']
+    assert search('смартфон') == ['apple/iphone/xr', 'xiaomi/mi9']
+    assert search('планшет') == []
+    assert api_client.get(url).json()['Status'] is False
+
+
+@pytest.mark.django_db
+def test_product_search_pages_through_equal_ranks(api_client, create_shop, monkeypatch):
+    """Строки с одинаковой релевантностью листаются по составному ключу (rank, pk) без повторов"""
+    monkeypatch.setattr(KeysetPagination, 'offset_cutoff', 2)
+    category = Category.objects.create(name='Смартфоны')
+    for index in range(7):
+        product = Product.objects.create(name=f'Смартфон {index}', category=category)
+        ProductInfo.objects.create(product=product, shop=create_shop, external_id=index, model=f'phone/{index}',
+                                   quantity=1, price=100, price_rrc=120)
+
+    models, data = [], api_client.get(reverse('backend:product-search'), {'q': 'смартфон', 'page_size': 2}).json()
+    while True:
+        models.extend(item['model'] for item in data['results'])
+        if not data['next'] or len(models) > 7:
+            break
+        data = api_client.get(data['next']).json()
+    assert sorted(models) == [f'phone/{index}' for index in range(7)]
+
+
+@pytest.mark.django_db
+def test_product_numeric_parameter_filters(api_client, create_shop):
+    """Числовые параметры фильтруются по диапазону и сортируются как числа, а не строки"""
+    category = Category.objects.create(name='Планшеты')
+    diagonal = Parameter.objects.create(name='Диагональ (дюйм)')
+    color = Parameter.objects.create(name='Цвет')
+    for index, (size, value) in enumerate([('10.9', 'серый'), ('11', 'черный'), ('9,7', 'черный'), ('нет', 'черный')]):
+        product = Product.objects.create(name=f'Планшет {index}', category=category)
+        info = ProductInfo.objects.create(product=product, shop=create_shop, external_id=index, model=f'tab/{index}',
+                                          quantity=1, price=100, price_rrc=120)
+        ProductParameter.objects.create(product_info=info, parameter=diagonal, value=size)
+        ProductParameter.objects.create(product_info=info, parameter=color, value=value)
+    assert list(ProductParameter.objects.filter(parameter=diagonal).order_by('id').values_list(
+        'value_number', flat=True)) == [10.9, 11, 9.7, None]
+    url = reverse('backend:product-info')
+
+    def models(**params):
+        models, page_url = [], f'{url}?page_size=1'
+        data = api_client.get(page_url, params).json()
+        while True:
+            models.extend(item['model'] for item in data['results'])
+            if not data['next']:
+                return models
+            data = api_client.get(data['next']).json()
+
+    assert models(param='Диагональ (дюйм)>=10') == ['tab/0', 'tab/1']
+    assert models(param=['Диагональ (дюйм)>9', 'Диагональ (дюйм)<11']) == ['tab/0', 'tab/2']
+    assert models(sort='Диагональ (дюйм)') == ['tab/2', 'tab/0', 'tab/1']
+    assert models(sort='-Диагональ (дюйм)') == ['tab/1', 'tab/0', 'tab/2']
+    assert models(param=['Цвет=черный', 'Диагональ (дюйм)<=11']) == ['tab/1', 'tab/2']
+    assert models(param='Цвет=черный', sort='-Диагональ (дюйм)') == ['tab/1', 'tab/2']
+    assert api_client.get(url, {'param': 'Диагональ (дюйм)>большая'}).status_code == 400
+
+    response = api_client.get(reverse('backend:product-facets'), {'param': 'Диагональ (дюйм)>=10'})
+    assert response.json()['count'] == 2
+
+
+@pytest.mark.django_db
+def test_sort_by_parameter_pages_through_ties(api_client, create_shop, monkeypatch):
+    """Сортировка по параметру с одинаковыми значениями листается по составному ключу без повторов и пропусков"""
+    # постраничный вывод по одному полю листал бы одинаковые значения через OFFSET и упирался в этот предел
+    monkeypatch.setattr(KeysetPagination, 'offset_cutoff', 2)
+    category = Category.objects.create(name='Смартфоны')
+    memory = Parameter.objects.create(name='Память')
+    for index in range(9):
+        product = Product.objects.create(name=f'Смартфон {index}', category=category)
+        info = ProductInfo.objects.create(product=product, shop=create_shop, external_id=index, model=f'phone/{index}',
+                                          quantity=1, price=100, price_rrc=120)
+        ProductParameter.objects.create(product_info=info, parameter=memory, value='64' if index == 4 else '128')
+    url = reverse('backend:product-info')
+
+    def pages(sort):
+        models, pages, data = [], 0, api_client.get(url, {'sort': sort, 'page_size': 2}).json()
+        while True:
+            models.extend(item['model'] for item in data['results'])
+            pages += 1
+            assert pages <= 5
+            if not data['next']:
+                return models, data
+            data = api_client.get(data['next']).json()
+
+    tied = [f'phone/{index}' for index in range(9) if index != 4]
+    models, last = pages('Память')
+    assert models == ['phone/4', *tied]
+    models, last = pages('-Память')
+    assert models == [*tied, 'phone/4']
+
+    # обратно по ссылкам previous - те же строки в том же порядке
+    backwards = []
+    while last['previous']:
+        last = api_client.get(last['previous']).json()
+        backwards = [item['model'] for item in last['results']] + backwards
+    assert backwards == tied
+
+
+@pytest.mark.django_db
+def test_product_info_serializer_reads_attributes(create_product):
+    """Параметры предложения читаются из attributes без запросов к ProductParameter"""
+    color = Parameter.objects.create(name='Цвет')
+    memory = Parameter.objects.create(name='Память (Гб)')
+    ProductParameter.objects.create(product_info=create_product, parameter=color, value='черный')
+    param = ProductParameter.objects.create(product_info=create_product, parameter=memory, value='64')
+    param.value = '128'
+    param.save()
+    product_info = ProductInfo.objects.select_related('product').get(id=create_product.id)
+
+    with CaptureQueriesContext(connection) as context:
+        data = ProductInfoSerializer(product_info).data
+
+    assert data['product_params'] == [{'parameter': 'Цвет', 'value': 'черный'},
+                                      {'parameter': 'Память (Гб)', 'value': '128'}]
+    assert not any(ProductParameter._meta.db_table in query['sql'] for query in context.captured_queries)
+
+    # удаление параметра не из админки тоже пересобирает attributes и витрину
+    ProductParameter.objects.filter(product_info=create_product, parameter=color).delete()
+    create_product.refresh_from_db()
+    assert create_product.attributes == [{'parameter': 'Память (Гб)', 'value': '128'}]
+    assert create_product.catalog_entry.parameters == create_product.attributes
+
 
 @pytest.mark.django_db
 def test_basket_operations(api_client, test_token, create_test_user, create_product):
@@ -186,3 +359,22 @@ def test_order_operations(api_client, test_token, create_test_user, create_conta
     ).first()
     assert order is not None
     assert order.contact == create_contact
+
+
+@pytest.mark.django_db
+def test_order_rejects_retired_offers(api_client, test_token, create_test_user, create_contact, create_product):
+    """Позиции на предложениях вне опубликованной версии каталога не оформляются в заказ"""
+    create_test_user.is_active = True
+    create_test_user.save()
+    api_client.credentials(HTTP_AUTHORIZATION=f'Token {test_token.key}')
+    api_client.post(reverse('backend:basket'), {'items': f'[{{"product_info": {create_product.id}, "quantity": 1}}]'})
+    basket = Order.objects.get(user=create_test_user, state='basket')
+
+    # предложение заменено в опубликованной версии, корзина на него не перенесена
+    ProductInfo.objects.filter(id=create_product.id).update(retired_version=1)
+    response = api_client.post(reverse('backend:order'), {'id': str(basket.id), 'contact': create_contact.id})
+
+    assert response.json()['Status'] is False
+    assert response.json()['product_info'] == [create_product.id]
+    basket.refresh_from_db()
+    assert basket.state == 'basket'
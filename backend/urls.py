@@ -3,14 +3,17 @@ from django_rest_passwordreset.views import reset_password_confirm
 
 from backend.views import PartnerUpdate, ConfirmAccount, RegisterAccount, LoginAccount, AccountDetails, CategoryView, \
     ShopView, ProductInfoView, BasketView, ContactView, PartnerState, PartnerOrders, OrderView, PasswordResetView, \
-    TaskStatus, CachedDataView, ProductListView, ProductUpdateView, ProductInfoImageView
+    TaskStatus, CachedDataView, ProductListView, ProductUpdateView, ProductInfoImageView, PartnerUpdateBatch, \
+    PartnerStock, ProductSearchView, ProductFacetsView
 
 app_name = 'backend'
 
 urlpatterns = [
     # Существующие URL
     path('partner/update', PartnerUpdate.as_view(), name='partner-update'),
+    path('partner/update/batch', PartnerUpdateBatch.as_view(), name='partner-update-batch'),
     path('partner/state', PartnerState.as_view(), name='partner-state'),
+    path('partner/stock', PartnerStock.as_view(), name='partner-stock'),
     path('partner/orders', PartnerOrders.as_view(), name='partner-orders'),
     path('user/register', RegisterAccount.as_view(), name='user-register'),
     path('user/register/confirm', ConfirmAccount.as_view(), name='user-register-confirm'),
@@ -21,6 +24,8 @@ urlpatterns = [
     path('categories', CategoryView.as_view(), name='categories'),
     path('shops', ShopView.as_view(), name='shops'),
     path('product_info', ProductInfoView.as_view(), name='product-info'),
+    path('product_info/facets', ProductFacetsView.as_view(), name='product-facets'),
+    path('product_info/search', ProductSearchView.as_view(), name='product-search'),
     path('product_info/<int:pk>', ProductInfoImageView.as_view(), name='product-info-image'),
     path('basket', BasketView.as_view(), name='basket'),
     path('contact', ContactView.as_view(), name='contact'),
@@ -0,0 +1,135 @@
+"""
+Построчная проверка товаров прайса.
+
+Схема товара заранее собирается в кортеж проверок (поле, функция), поэтому
+проверка строки - один проход по этому кортежу без разбора схемы на каждой
+строке. Строки с ошибками откладываются с причинами, остальные импортируются.
+"""
+MAX_POSITIVE_INTEGER = 2147483647
+
+
+def _check_integer(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        return 'должно быть целым числом'
+    if not 0 <= value <= MAX_POSITIVE_INTEGER:
+        return f'должно быть от 0 до {MAX_POSITIVE_INTEGER}'
+
+
+def _check_string(max_length, blank=False):
+    def check(value):
+        if not isinstance(value, str):
+            return 'должно быть строкой'
+        if not blank and not value.strip():
+            return 'не может быть пустым'
+        if len(value) > max_length:
+            return f'длиннее {max_length} символов'
+    return check
+
+
+def _check_parameters(value):
+    if not isinstance(value, dict):
+        return 'должно быть словарем'
+    for name, param_value in value.items():
+        if not isinstance(name, str) or not name or len(name) > 50:
+            return f'недопустимое имя параметра {name!r}'
+        if param_value is None or isinstance(param_value, (dict, list)):
+            return f'параметр {name!r} должен быть скаляром'
+        if len(str(param_value)) > 50:
+            return f'значение параметра {name!r} длиннее 50 символов'
+
+
+# поле товара -> проверка значения, возвращающая причину ошибки или None
+GOODS_SCHEMA = (
+    ('id', _check_integer),
+    ('category', _check_integer),
+    ('name', _check_string(80)),
+    ('model', _check_string(80, blank=True)),
+    ('price', _check_integer),
+    ('price_rrc', _check_integer),
+    ('quantity', _check_integer),
+    ('parameters', _check_parameters),
+)
+
+# поля быстрого обновления предложения (backend.stock), кроме external_id
+STOCK_FIELDS = ('price', 'price_rrc', 'quantity')
+
+
+def check_stock_row(item):
+    """Возвращает список причин, по которым строку обновления цены и остатка нельзя применить"""
+    if not isinstance(item, dict):
+        return ['строка должна быть словарем']
+    if 'external_id' not in item:
+        return ['external_id: обязательное поле']
+
+    reasons = []
+    reason = _check_integer(item['external_id'])
+    if reason:
+        reasons.append(f'external_id: {reason}')
+    if not any(field in item for field in STOCK_FIELDS):
+        reasons.append(f'нужно хотя бы одно из полей {", ".join(STOCK_FIELDS)}')
+    for field in STOCK_FIELDS:
+        if field in item:
+            reason = _check_integer(item[field])
+            if reason:
+                reasons.append(f'{field}: {reason}')
+    unknown = set(item) - {'external_id', *STOCK_FIELDS}
+    if unknown:
+        reasons.append(f'неизвестные поля: {", ".join(sorted(map(str, unknown)))}')
+    return reasons
+
+
+class GoodsValidator:
+    """
+    Проверка товаров прайса по схеме GOODS_SCHEMA.
+
+    Аргументы:
+        categories: ИД категорий, к которым могут относиться товары
+        errors (list): список, в который добавляются отложенные строки
+        max_errors (int): сколько отложенных строк сохранять с причинами
+    """
+
+    def __init__(self, categories, errors=None, max_errors=100):
+        self.categories = set(categories)
+        self.errors = errors if errors is not None else []
+        self.max_errors = max_errors
+
+    def check(self, item):
+        """Возвращает список причин, по которым товар не может быть импортирован"""
+        if not isinstance(item, dict):
+            return ['товар должен быть словарем']
+
+        reasons = []
+        for field, check in GOODS_SCHEMA:
+            if field not in item:
+                reasons.append(f'{field}: обязательное поле')
+                continue
+            reason = check(item[field])
+            if reason is None and field == 'category' and item[field] not in self.categories:
+                reason = f'неизвестная категория {item[field]}'
+            if reason:
+                reasons.append(f'{field}: {reason}')
+        return reasons
+
+    def filter(self, goods, position=0):
+        """
+        Отбирает корректные товары, откладывая остальные с причинами.
+
+        Аргументы:
+            goods (list): пачка товаров
+            position (int): число товаров прайса перед пачкой
+
+        Возвращает:
+            list: товары, прошедшие проверку
+        """
+        valid = []
+        for row, item in enumerate(goods, start=position + 1):
+            reasons = self.check(item)
+            if not reasons:
+                valid.append(item)
+            elif len(self.errors) < self.max_errors:
+                self.errors.append({
+                    'row': row,
+                    'id': item.get('id') if isinstance(item, dict) else None,
+                    'errors': reasons,
+                })
+        return valid
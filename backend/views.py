@@ -1,6 +1,8 @@
 from distutils.util import strtobool
-from celery.result import AsyncResult
+from functools import partial
+from celery.result import AsyncResult, GroupResult
 
+from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
 from django.core.validators import URLValidator
@@ -18,12 +20,18 @@ from rest_framework.views import APIView
 
 from ujson import loads as load_json
 
-from backend.tasks import reset_password_request_token, update_partner_price, generate_thumbnails
+from backend.tasks import reset_password_request_token, generate_thumbnails, start_price_import, \
+    start_import_batch, preview_partner_price
 from backend.models import Shop, Product, Category, Parameter, User, OrderItem, Order, Contact, \
-    ConfirmEmailToken, ProductInfo
+    ConfirmEmailToken, ProductInfo, ImportBatch, ImportRun, CatalogEntry
 from backend.serializers import UserSerializer, CategorySerializer, ShopSerializer, ProductInfoSerializer, \
-    OrderItemSerializer, OrderSerializer, ContactSerializer, PasswordResetSerializer
+    OrderItemSerializer, OrderSerializer, ContactSerializer, PasswordResetSerializer, CatalogEntrySerializer
+from backend.facets import count_facets, parse_parameter_filters, select_offers, selection_ids
+from backend.pagination import KeysetPagination
 from backend.signals import new_order
+from backend.stock import read_stock_csv, update_offer_stock
+from backend.storefront import filter_parameter_ranges, order_by_parameter, parameter_range_ids, \
+    refresh_storefront_shops, search_storefront
 
 from django.core.cache import cache
 from cachalot.api import invalidate
@@ -275,11 +283,20 @@ class ProductInfoView(APIView):
         A class for searching products.
 
         Methods:
-        - get: Retrieve the product information based on the specified filters.
+        - get: Retrieve the product information based on the specified filters,
+          page by page (keyset cursor, see backend.pagination).
 
         Attributes:
-        - None
+        - pagination_ordering: порядок постраничного вывода по ключу витрины
+
+        Каталог читается только из витрины CatalogEntry (backend.storefront).
+        Параметры param вида "Цвет=черный" отбирают предложения по индексу
+        фасетов (backend.facets): значения одного параметра - по ИЛИ,
+        разные параметры - по И. Параметры param вида "Диагональ (дюйм)>=10"
+        (>, >=, <, <=) - диапазоны числовых параметров, sort=имя параметра
+        или sort=-имя - сортировка по числовому параметру.
         """
+    pagination_ordering = 'pk'
 
     def get(self, request: Request, *args, **kwargs):
         """
@@ -291,7 +308,35 @@ class ProductInfoView(APIView):
                Returns:
                - Response: The response containing the product information.
                """
-        query = Q(shop__state=True)
+        try:
+            selected, ranges = parse_parameter_filters(request.query_params.getlist('param'))
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
+        queryset = self.filter_catalog(request)
+        sort = request.query_params.get('sort', '').strip()
+        if sort:
+            queryset = order_by_parameter(queryset, sort.lstrip('-').strip())
+            self.pagination_ordering = ('-sort_value' if sort.startswith('-') else 'sort_value', 'pk')
+        if not selected:
+            return self.paginate(request, filter_parameter_ranges(queryset, ranges))
+
+        # диапазоны при фильтрах фасетов сужают битовые карты
+        restrict = parameter_range_ids(self.filter_catalog(request), ranges) if ranges else None
+        selection = select_offers(selected, request.query_params.get('shop_id'),
+                                  request.query_params.get('category_id'), restrict=restrict)
+        if sort:
+            return self.paginate(request, queryset.filter(pk__in=selection_ids(selection)))
+        paginator = KeysetPagination()
+        page = paginator.paginate_selection(
+            queryset, request, partial(selection_ids, selection),
+            sum(bits.bit_count() for _, bits in selection), view=self)
+        serializer = CatalogEntrySerializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
+
+    @staticmethod
+    def filter_catalog(request):
+        """Строки витрины по фильтрам shop_id и category_id"""
+        query = Q(shop_state=True, is_active=True)
         shop_id = request.query_params.get('shop_id')
         category_id = request.query_params.get('category_id')
 
@@ -299,17 +344,65 @@ class ProductInfoView(APIView):
             query = query & Q(shop_id=shop_id)
 
         if category_id:
-            query = query & Q(product__category_id=category_id)
+            query = query & Q(category_id=category_id)
 
-        # фильтруем и отбрасываем дубликаты
-        queryset = ProductInfo.objects.filter(
-            query).select_related(
-            'shop', 'product__category').prefetch_related(
-            'product_params', 'product_params__parameter').distinct()
+        # в витрине только опубликованные версии каталогов: идущий импорт покупателям не виден
+        return CatalogEntry.objects.filter(query)
 
-        serializer = ProductInfoSerializer(queryset, many=True, context={'request': request})
+    def paginate(self, request, queryset):
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = CatalogEntrySerializer(page, many=True, context={'request': request})
 
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
+
+
+class ProductSearchView(ProductInfoView):
+    """
+    Поиск товаров по названию, модели и значениям параметров.
+
+    Methods:
+    - get: найденные предложения по убыванию релевантности, страницами
+      по курсору; параметр q - строка поиска, shop_id и category_id -
+      те же фильтры, что и у каталога.
+
+    Поиск идет по витрине каталога, см. backend.storefront.search_storefront.
+    """
+
+    def get(self, request: Request, *args, **kwargs):
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
+        if len(text) > settings.CATALOG_SEARCH_MAX_LENGTH:
+            return JsonResponse({'Status': False, 'Errors': 'Слишком длинная строка поиска'}, status=400)
+
+        queryset = search_storefront(self.filter_catalog(request), text)
+        # релевантность у многих строк одинакова: составной ключ (rank, pk), см. backend.pagination;
+        # без ранжирования (не PostgreSQL) rank у всех строк 0 и строки идут по ключу
+        self.pagination_ordering = ('-rank', 'pk')
+        return self.paginate(request, queryset)
+
+
+class ProductFacetsView(APIView):
+    """
+    Фасеты каталога.
+
+    Methods:
+    - get: число предложений у каждого значения каждого параметра с учетом
+      фильтров param, shop_id и category_id (как у каталога) и общее число
+      предложений под фильтрами. Значения выбранного параметра считаются
+      без его собственного фильтра.
+    """
+
+    def get(self, request: Request, *args, **kwargs):
+        try:
+            selected, ranges = parse_parameter_filters(request.query_params.getlist('param'))
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
+        restrict = parameter_range_ids(ProductInfoView.filter_catalog(request), ranges) if ranges else None
+        count, facets = count_facets(selected, request.query_params.get('shop_id'),
+                                     request.query_params.get('category_id'), restrict=restrict)
+        return Response({'count': count, 'facets': facets})
 
 
 class ProductInfoImageView(APIView):
@@ -403,8 +496,7 @@ class BasketView(APIView):
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
         basket = Order.objects.filter(
             user_id=request.user.id, state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_params__parameter').annotate(
+            'ordered_items__product_info__product__category').annotate(
             total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price_rrc'))).distinct()
 
         serializer = OrderSerializer(basket, many=True)
@@ -521,7 +613,11 @@ class BasketView(APIView):
 
 class PartnerUpdate(APIView):
     """
-    Асинхронное обновление прайса от поставщика
+    Асинхронное обновление прайса от поставщика.
+
+    С dry_run=true прайс только сравнивается с каталогом магазина без записи:
+    сводка изменений возвращается в результате задачи (TaskStatus).
+    Порог изменения цены в процентах задается параметром price_threshold.
     """
 
     def post(self, request, *args, **kwargs):
@@ -566,16 +662,31 @@ class PartnerUpdate(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            # Запуск асинхронной задачи с передачей shop_id
-            task = update_partner_price.delay(
-                shop_id=shop.id,
-                url=url
-            )
+            try:
+                dry_run = strtobool(str(request.data.get('dry_run', 'false')))
+                price_threshold = request.data.get('price_threshold')
+                price_threshold = float(price_threshold) if price_threshold not in (None, '') else None
+            except ValueError:
+                return Response(
+                    {'Status': False, 'Errors': 'Неправильно указаны dry_run или price_threshold'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            if dry_run:
+                task = preview_partner_price.delay(shop.id, url, price_threshold)
+                return Response({
+                    'Status': True,
+                    'TaskID': task.id,
+                    'Message': 'Предпросмотр изменений прайса запущен'
+                }, status=status.HTTP_202_ACCEPTED)
+
+            # повторный запрос во время импорта возвращает ИД идущей задачи
+            task_id, started = start_price_import(shop, url)
 
             return Response({
                 'Status': True,
-                'TaskID': task.id,
-                'Message': 'Обновление прайса запущено'
+                'TaskID': task_id,
+                'Message': 'Обновление прайса запущено' if started else 'Обновление прайса уже выполняется'
             }, status=status.HTTP_202_ACCEPTED)
 
         return Response(
@@ -584,6 +695,152 @@ class PartnerUpdate(APIView):
         )
 
 
+class PartnerUpdateBatch(APIView):
+    """
+    Пакетное обновление прайсов нескольких магазинов (для администраторов)
+    """
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'Status': False, 'Error': 'Log in required'}, status=status.HTTP_403_FORBIDDEN)
+
+        if not request.user.is_staff:
+            return Response({'Status': False, 'Error': 'Только для администраторов'}, status=status.HTTP_403_FORBIDDEN)
+
+        shop_ids = request.data.get('shops')
+        if not isinstance(shop_ids, list) or not shop_ids:
+            return Response({'Status': False, 'Errors': 'Не указан список магазинов shops'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            # ИД могут прийти строками ("1"): сравниваются с найденными уже как числа
+            shop_ids = list(dict.fromkeys(int(shop_id) for shop_id in shop_ids))
+        except (TypeError, ValueError):
+            return Response({'Status': False, 'Errors': 'ИД магазинов shops должны быть числами'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            concurrency = int(request.data.get('concurrency') or settings.PRICE_IMPORT_CONCURRENCY)
+            if concurrency < 1:
+                raise ValueError
+        except (TypeError, ValueError):
+            return Response({'Status': False, 'Errors': 'concurrency должно быть положительным числом'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        shops = list(Shop.objects.filter(id__in=shop_ids).exclude(url=None).exclude(url=''))
+        if not shops:
+            return Response({'Status': False, 'Errors': 'Нет магазинов с адресом прайса'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        batch = start_import_batch(shops, concurrency=concurrency, force=bool(request.data.get('force')),
+                                   user=request.user)
+        found = {shop.id for shop in shops}
+        return Response({
+            'Status': True,
+            'BatchID': batch.id,
+            'Shops': sorted(found),
+            # не найдены или без адреса прайса
+            'Skipped': [shop_id for shop_id in shop_ids if shop_id not in found],
+        }, status=status.HTTP_202_ACCEPTED)
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'Status': False, 'Error': 'Log in required'}, status=status.HTTP_403_FORBIDDEN)
+
+        if not request.user.is_staff:
+            return Response({'Status': False, 'Error': 'Только для администраторов'}, status=status.HTTP_403_FORBIDDEN)
+
+        batch_id = request.query_params.get('batch_id')
+        if not batch_id or not batch_id.isdigit():
+            return Response({'Status': False, 'Errors': 'Не указан batch_id'}, status=status.HTTP_400_BAD_REQUEST)
+
+        batch = ImportBatch.objects.filter(id=batch_id).first()
+        if batch is None:
+            return Response({'Status': False, 'Error': 'Пакет не найден'}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response(self.get_batch_status(batch), status=status.HTTP_200_OK)
+
+    @staticmethod
+    def get_batch_status(batch):
+        """Общий статус пакета и статусы импортов по магазинам"""
+        runs = {run.task_id: run for run in ImportRun.objects.filter(task_id__in=batch.tasks.values())}
+        shops = []
+        for shop_id, task_id in batch.tasks.items():
+            run = runs.get(task_id)
+            if run is not None:
+                shops.append({'shop_id': int(shop_id), 'task_id': task_id, 'status': run.status, 'stats': run.stats})
+                continue
+
+            # задача еще не начата или завершилась до создания ImportRun
+            result = AsyncResult(task_id)
+            if not result.ready():
+                state = 'queued'
+            elif isinstance(result.result, dict):
+                state = result.result.get('status', 'success')
+            else:
+                state = 'failed'
+            shops.append({'shop_id': int(shop_id), 'task_id': task_id, 'status': state, 'stats': {}})
+
+        shops.extend({'shop_id': shop_id, 'task_id': None, 'status': 'pending', 'stats': {}}
+                     for shop_id in batch.pending)
+
+        counts = {}
+        for shop in shops:
+            counts[shop['status']] = counts.get(shop['status'], 0) + 1
+        return {
+            'batch_id': batch.id,
+            'created': batch.created,
+            'concurrency': batch.concurrency,
+            'total': len(shops),
+            'counts': counts,
+            'finished': all(shop['status'] in ('success', 'skipped', 'error', 'failed') for shop in shops),
+            'shops': shops,
+        }
+
+
+class PartnerStock(APIView):
+    """
+    Быстрое обновление цен и остатков предложений магазина без импорта прайса.
+
+    Тело запроса - JSON-список строк {"external_id", "price", "price_rrc", "quantity"}
+    (или {"items": [...]}) либо CSV (Content-Type: text/csv) с заголовком
+    external_id,price,price_rrc,quantity. Поля, кроме external_id, можно не
+    указывать. Администраторы указывают магазин параметром shop_id.
+    В ответе - исход каждой строки (см. backend.stock).
+    """
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'Status': False, 'Error': 'Log in required'}, status=status.HTTP_403_FORBIDDEN)
+
+        if request.user.type != 'shop' and not request.user.is_staff:
+            return Response({'Status': False, 'Error': 'Только для магазинов и администраторов'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        if request.user.is_staff:
+            shop = Shop.objects.filter(id=request.query_params.get('shop_id') or 0).first()
+        else:
+            shop = Shop.objects.filter(user=request.user).first()
+        if shop is None:
+            return Response({'Status': False, 'Error': 'Магазин не найден'}, status=status.HTTP_404_NOT_FOUND)
+
+        if request.content_type.startswith('text/csv'):
+            try:
+                rows = read_stock_csv(request.body.decode('utf-8'))
+            except UnicodeDecodeError:
+                return Response({'Status': False, 'Errors': 'CSV должен быть в кодировке UTF-8'},
+                                status=status.HTTP_400_BAD_REQUEST)
+        else:
+            rows = request.data.get('items') if isinstance(request.data, dict) else request.data
+        if not isinstance(rows, list) or not rows:
+            return Response({'Status': False, 'Errors': 'Не указаны строки обновления'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > settings.PARTNER_STOCK_MAX_ROWS:
+            return Response({'Status': False, 'Errors': f'Больше {settings.PARTNER_STOCK_MAX_ROWS} строк в запросе'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(dict(update_offer_stock(shop, rows), Status=True), status=status.HTTP_200_OK)
+
+
 class PartnerState(APIView):
     """
        A class for managing partner state.
@@ -634,7 +891,9 @@ class PartnerState(APIView):
         state = request.data.get('state')
         if state:
             try:
-                Shop.objects.filter(user_id=request.user.id).update(state=strtobool(state))
+                shops = Shop.objects.filter(user_id=request.user.id)
+                shops.update(state=strtobool(state))
+                refresh_storefront_shops(shops)
                 return JsonResponse({'Status': True})
             except ValueError as error:
                 return JsonResponse({'Status': False, 'Errors': str(error)})
@@ -649,8 +908,9 @@ class PartnerOrders(APIView):
     - get: Retrieve the orders associated with the authenticated partner.
 
     Attributes:
-    - None
+    - pagination_ordering: порядок постраничного вывода, новые заказы первыми
     """
+    pagination_ordering = '-id'
 
     def get(self, request, *args, **kwargs):
         """
@@ -670,12 +930,13 @@ class PartnerOrders(APIView):
 
         order = Order.objects.filter(
             ordered_items__product_info__shop__user_id=request.user.id).exclude(state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_params__parameter').select_related('contact').annotate(
+            'ordered_items__product_info__product__category').select_related('contact').annotate(
             total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
 
-        serializer = OrderSerializer(order, many=True)
-        return Response(serializer.data)
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(order, request, view=self)
+        serializer = OrderSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 
 class ContactView(APIView):
@@ -805,8 +1066,9 @@ class OrderView(APIView):
     - delete: Delete a specific order.
 
     Attributes:
-    - None
+    - pagination_ordering: порядок постраничного вывода, новые заказы первыми
     """
+    pagination_ordering = '-id'
 
     # получить мои заказы
     def get(self, request, *args, **kwargs):
@@ -823,12 +1085,13 @@ class OrderView(APIView):
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
         order = Order.objects.filter(
             user_id=request.user.id).exclude(state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_params__parameter').select_related('contact').annotate(
+            'ordered_items__product_info__product__category').select_related('contact').annotate(
             total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
 
-        serializer = OrderSerializer(order, many=True)
-        return Response(serializer.data)
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(order, request, view=self)
+        serializer = OrderSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
     # разместить заказ из корзины
     def post(self, request, *args, **kwargs):
@@ -846,6 +1109,15 @@ class OrderView(APIView):
 
         if {'id', 'contact'}.issubset(request.data):
             if request.data['id'].isdigit():
+                # позиции на предложениях, снятых с продажи или не перенесенных в опубликованную
+                # версию каталога (см. backend.catalog.move_baskets), в заказ не оформляются
+                unavailable = list(OrderItem.objects.filter(
+                    order__user_id=request.user.id, order_id=request.data['id']).exclude(
+                    product_info__in=ProductInfo.objects.published().filter(is_active=True)).values_list(
+                    'product_info_id', flat=True))
+                if unavailable:
+                    return JsonResponse({'Status': False, 'Errors': 'Товары больше не продаются, удалите их из корзины',
+                                         'product_info': unavailable})
                 try:
                     print(f"user_id {request.user.id}")
                     print(Order.objects.get(id=request.data['id']))
@@ -890,8 +1162,41 @@ class TaskStatus(APIView):
             response_data['error'] = str(task_result.result)
             response_data['traceback'] = task_result.traceback
 
+        # параллельный импорт прайса: прогресс по частям и итог
+        elif isinstance(task_result.result, dict) and task_result.result.get('callback_id'):
+            response_data.update(self.get_import_progress(task_result.result))
+
+        # импорт прайса: контрольная точка и показатели, в том числе идущего импорта
+        run = ImportRun.objects.filter(task_id=task_id).order_by('-id').first()
+        if run is not None:
+            response_data['import_run'] = {
+                'id': run.id,
+                'status': run.status,
+                'offset': run.offset,
+                'metrics': run.metrics,
+            }
+
         return Response(response_data, status=status.HTTP_200_OK)
 
+    @staticmethod
+    def get_import_progress(result):
+        data = {}
+        group_result = GroupResult.restore(result['group_id']) if result.get('group_id') else None
+        if group_result is not None:
+            data['progress'] = {
+                'chunks': len(group_result.results),
+                'completed': group_result.completed_count(),
+                'failed': sum(1 for chunk in group_result.results if chunk.failed()),
+            }
+
+        callback = AsyncResult(result['callback_id'])
+        data['import'] = {'status': callback.status}
+        if callback.failed():
+            data['import']['error'] = str(callback.result)
+        elif callback.ready():
+            data['import']['result'] = callback.result
+        return data
+
 
 class CachedDataView(APIView):
     def get(self, request):
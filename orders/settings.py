@@ -46,6 +46,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'django_rest_passwordreset',
     'rest_framework',
     'rest_framework.authtoken',
@@ -223,7 +224,8 @@ EMAIL_USE_SSL = os.getenv('EMAIL_USE_SSL', True) # EMAIL_PORT = 465
 SERVER_EMAIL = EMAIL_HOST_USER
 
 REST_FRAMEWORK = {
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    # постраничный вывод по курсору, без OFFSET и COUNT(*) (см. backend.pagination)
+    'DEFAULT_PAGINATION_CLASS': 'backend.pagination.KeysetPagination',
     'PAGE_SIZE': 40,
 
     'DEFAULT_RENDERER_CLASSES': (
@@ -349,6 +351,8 @@ SILKY_INTERCEPT_PERCENT = 100  # Профилировать все запрос
 SILKY_MAX_REQUEST_BODY_SIZE = -1  # Сохранять все тела запросов
 SILKY_MAX_RESPONSE_BODY_SIZE = -1  # Сохранять все тела ответов
 SILKY_META = True
+# тела загрузок файлов (прайсы в админке) Silk не читает: иначе файл целиком попадает в память
+SILKY_INTERCEPT_FUNC = lambda request: not request.content_type.startswith('multipart/form-data')  # noqa: E731
 
 # Настройки для отладки
 if DEBUG:
@@ -375,3 +379,39 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_BROKER_URL = 'redis://redis:6379/0'
 CELERY_RESULT_BACKEND = 'redis://redis:6379/1'
+
+# Импорт прайс-листов
+PRICE_IMPORT_BATCH_SIZE = int(os.getenv('PRICE_IMPORT_BATCH_SIZE', 1000))  # товаров в одной пачке
+PRICE_FEED_MAX_BYTES = int(os.getenv('PRICE_FEED_MAX_BYTES', 200 * 1024 * 1024))  # предельный размер прайса
+PRICE_FEED_SPOOL_SIZE = 8 * 1024 * 1024  # прайс до этого размера держится в памяти, больше - на диске
+PRICE_FEED_TIMEOUT = (5, 60)  # таймауты соединения и чтения, секунды
+PRICE_FEED_POOL_SIZE = 10  # соединений в пуле на один хост
+PRICE_IMPORT_CHUNK_SIZE = int(os.getenv('PRICE_IMPORT_CHUNK_SIZE', 20000))  # товаров в части параллельного импорта
+PRICE_IMPORT_MAX_ERRORS = int(os.getenv('PRICE_IMPORT_MAX_ERRORS', 100))  # отложенных строк в отчете об ошибках
+PRICE_IMPORT_LOADER = os.getenv('PRICE_IMPORT_LOADER', 'orm')  # orm или copy (COPY FROM STDIN, только PostgreSQL)
+PRICE_IMPORT_QUEUE_SIZE = 8  # кусков файла и пачек товаров в очередях между этапами конвейера
+PRICE_IMPORT_PARSE_PROCESS = os.getenv('PRICE_IMPORT_PARSE_PROCESS', 'true').lower() == 'true'  # разбор в отдельном процессе
+PRICE_IMPORT_CONCURRENCY = int(os.getenv('PRICE_IMPORT_CONCURRENCY', 4))  # одновременных импортов в пакете
+PRICE_IMPORT_LOCK_TIMEOUT = 2 * 60 * 60  # срок блокировки импорта магазина, секунды
+PRICE_IMPORT_BATCH_POLL = 5  # интервал запуска очередных импортов пакета, секунды
+PRICE_REFRESH_JITTER = 300  # наибольшая случайная задержка планового обновления прайса, секунды
+PRICE_FEED_ARCHIVE_DAYS = int(os.getenv('PRICE_FEED_ARCHIVE_DAYS', 30))  # срок хранения архива прайсов, дни
+PRICE_FEED_ARCHIVE_MAX_BYTES = int(os.getenv('PRICE_FEED_ARCHIVE_MAX_BYTES', 5 * 1024 ** 3))  # объем архива прайсов
+PRICE_IMPORT_TRACEMALLOC = os.getenv('PRICE_IMPORT_TRACEMALLOC', 'false').lower() == 'true'  # пик памяти через tracemalloc
+PRICE_PREVIEW_PRICE_THRESHOLD = 10  # порог изменения цены в предпросмотре прайса, проценты
+PRICE_PREVIEW_SAMPLE_SIZE = 20  # примеров товаров каждого вида в предпросмотре прайса
+PARTNER_STOCK_BATCH_SIZE = 1000  # строк быстрого обновления цен и остатков на один UPDATE
+PARTNER_STOCK_MAX_ROWS = 50000  # строк быстрого обновления цен и остатков в одном запросе
+CATALOG_SEARCH_MAX_LENGTH = 100  # символов в строке поиска по каталогу
+
+# Плановое обновление прайсов с адресов Shop.url и очистка архива прайсов
+CELERY_BEAT_SCHEDULE = {
+    'schedule-price-refresh': {
+        'task': 'backend.tasks.schedule_price_refresh',
+        'schedule': 60.0,
+    },
+    'purge-price-feeds': {
+        'task': 'backend.tasks.purge_price_feeds',
+        'schedule': 24 * 60 * 60.0,
+    },
+}